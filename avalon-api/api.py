@@ -1,18 +1,32 @@
 """This script is the RESTful web service used in Avalon"""
 
 import argparse
+import os
 
+import rethinkdb as r
 from flask import Flask, jsonify
-from flask_restx import Api
 from flask.logging import create_logger
 
 from avalonBG import __version__ as api_version
-from avalonBG.mp3 import create_mp3
 
 from api_utils import HTTPError
+from archive import ARCHIVE_DIR, ARCHIVE_MIN_AGE, GAME_ARCHIVE, GAME_ARCHIVER
+from compression import COMPRESSION_BLUEPRINT
+from db_indexes import db_create_missing_indexes
+from db_pool import DB_POOL, DB_POOL_BLUEPRINT
+from game_feed import GAME_FEED_HUB
+from health import HEALTH_BLUEPRINT
+from json_encoding import FastJSONEncoder
+from metrics import METRICS, METRICS_BLUEPRINT, timed_json_encoder
+from mp3_cache import MP3_CACHE
+from openapi import AvalonApi
+from profiling import MAX_PROFILES, PROFILE_DIR, PROFILING_BLUEPRINT, REQUEST_PROFILER
 from pylib import AVALON_BLUEPRINT, DATABASE_NAMESPACE, GAMES_NAMESPACE, \
                   MP3_NAMESPACE, PLAYERS_NAMESPACE, RULES_NAMESPACE
 from quests import QUESTS_BLUEPRINT, QUESTS_NAMESPACE
+from rules_cache import RULES_CACHE
+from sharding import SHARD_ROUTER, SHARDING_BLUEPRINT, SHARDING_MODES
+from storage import STORAGE_ENGINES, create_engine
 
 # from db_utils import db_connect
 
@@ -20,15 +34,26 @@ from quests import QUESTS_BLUEPRINT, QUESTS_NAMESPACE
 APP = Flask(__name__)
 
 
-API = Api(
+API = AvalonApi(
     QUESTS_BLUEPRINT,
     version=api_version,
     title="Avalon API",
     description="A simple Avalon API"
 )
 
+# first: the profiles include all the other hooks (its after_request runs last)
+APP.register_blueprint(PROFILING_BLUEPRINT)
+# then the requests of the games owned by other nodes are forwarded before anything else
+APP.register_blueprint(SHARDING_BLUEPRINT)
 APP.register_blueprint(AVALON_BLUEPRINT)
 APP.register_blueprint(QUESTS_BLUEPRINT)
+APP.register_blueprint(DB_POOL_BLUEPRINT)
+APP.register_blueprint(HEALTH_BLUEPRINT)
+APP.register_blueprint(METRICS_BLUEPRINT)
+# after the metrics: the latency of the requests includes their compression
+APP.register_blueprint(COMPRESSION_BLUEPRINT)
+
+APP.json_encoder = timed_json_encoder(FastJSONEncoder)
 
 API.add_namespace(DATABASE_NAMESPACE)
 API.add_namespace(GAMES_NAMESPACE)
@@ -45,12 +70,22 @@ LOG = create_logger(APP)
 @APP.errorhandler(HTTPError)
 def handle_invalid_usage(error):
 
+    METRICS.count_error(error.status_code)
+
     response = jsonify(error.__dict__)
     response.status_code = error.status_code
 
     return response
 
 
+@API.errorhandler(HTTPError)
+def handle_api_invalid_usage(error):
+
+    METRICS.count_error(error.status_code)
+
+    return error.__dict__, error.status_code
+
+
 if __name__ == '__main__':
 
     PARSER = argparse.ArgumentParser()
@@ -58,8 +93,85 @@ if __name__ == '__main__':
     # optional arguments
     PARSER.add_argument("-host", type=str, help="app host", default="0.0.0.0")
     PARSER.add_argument("-port", type=int, help="app port", default=5000)
+    PARSER.add_argument(
+        "-storage",
+        type=str,
+        help="storage engine: 'rethinkdb', 'memory' (single process) or 'sqlite'",
+        choices=STORAGE_ENGINES,
+        default="rethinkdb"
+    )
+    PARSER.add_argument("-sqlite_path", type=str, help="database file of the sqlite engine", default="avalon.db")
     PARSER.add_argument("-host_db", type=str, help="db host", default="rethinkdb")
     PARSER.add_argument("-port_db", type=int, help="db port", default=28015)
+    PARSER.add_argument("-pool_size_db", type=int, help="max number of db connections", default=10)
+    PARSER.add_argument("-pool_timeout_db", type=float, help="max wait for a db connection (s)", default=5.0)
+    PARSER.add_argument(
+        "-server",
+        type=str,
+        help="'production' (multi-worker WSGI server), 'asgi' (multi-worker asyncio server) "
+             "or 'development' (Flask debug server)",
+        choices=("production", "asgi", "development"),
+        default="production"
+    )
+    PARSER.add_argument("-workers", type=int, help="number of worker processes", default=os.cpu_count() or 1)
+    PARSER.add_argument(
+        "-threads",
+        type=int,
+        help="number of threads per worker (asgi: threads serving the synchronous routes)",
+        default=4
+    )
+    PARSER.add_argument(
+        "-max_subscribers",
+        type=int,
+        help="subscribers to the games per worker of the production server, each one holds a thread "
+             "(default: half of -threads; asgi: no limit)",
+        default=None
+    )
+    PARSER.add_argument("-keepalive", type=int, help="keep-alive timeout (s)", default=5)
+    PARSER.add_argument("-graceful_timeout", type=int, help="graceful shutdown timeout (s)", default=30)
+    PARSER.add_argument("-archive_dir", type=str, help="directory of the archived games", default=ARCHIVE_DIR)
+    PARSER.add_argument(
+        "-archive_interval",
+        type=float,
+        help="seconds between two archives of the completed games (0: never)",
+        default=0.0
+    )
+    PARSER.add_argument(
+        "-archive_min_age",
+        type=float,
+        help="seconds since their creation before the completed games are archived",
+        default=ARCHIVE_MIN_AGE
+    )
+    PARSER.add_argument("-node_url", type=str, help="url of this node, as listed in -nodes", default=None)
+    PARSER.add_argument(
+        "-nodes",
+        type=str,
+        nargs="*",
+        help="urls of the nodes sharing the games (until a list is PUT on /nodes; none: no sharding)",
+        default=[]
+    )
+    PARSER.add_argument(
+        "-nodes_token",
+        type=str,
+        help="admin token of PUT /nodes (Authorization: Bearer <token>; none: the node list cannot be PUT)",
+        default=os.environ.get("AVALON_NODES_TOKEN")
+    )
+    PARSER.add_argument(
+        "-shard_mode",
+        type=str,
+        help="requests of the games owned by other nodes: 'forward' or 'redirect' (307)",
+        choices=SHARDING_MODES,
+        default="forward"
+    )
+    PARSER.add_argument(
+        "-profile_rate",
+        type=float,
+        help="fraction of the requests profiled (0: only the ones with the header X-Avalon-Profile)",
+        default=0.0
+    )
+    PARSER.add_argument("-profile", action="store_true", help="enable the request profiler")
+    PARSER.add_argument("-profile_dir", type=str, help="directory of the request profiles", default=PROFILE_DIR)
+    PARSER.add_argument("-profile_max", type=int, help="profiles kept on disk", default=MAX_PROFILES)
 
     # parse arguments
     ARGS = PARSER.parse_args()
@@ -68,9 +180,94 @@ if __name__ == '__main__':
     # HANDLER.setLevel(logging.INFO)
     # APP.logger.addHandler(HANDLER)
 
-    create_mp3(output_mp3_path="resources")
+    DB_POOL.configure(
+        engine=create_engine(
+            ARGS.storage,
+            host_db=ARGS.host_db,
+            port_db=ARGS.port_db,
+            sqlite_path=ARGS.sqlite_path
+        ),
+        max_size=ARGS.pool_size_db,
+        timeout=ARGS.pool_timeout_db
+    )
+
+    # each worker would have its own data
+    if not DB_POOL.engine.multi_process and ARGS.server != "development" and ARGS.workers > 1:
+        LOG.warning("The storage engine '%s' is not shared by processes: 1 worker only", ARGS.storage)
+        ARGS.workers = 1
+
+    # each node of a cluster has its own memory store
+    if ARGS.nodes and not DB_POOL.engine.multi_process:
+        PARSER.error("the nodes of a cluster share the database: -storage rethinkdb or sqlite")
+    try:
+        SHARD_ROUTER.configure(
+            node_url=ARGS.node_url, nodes=ARGS.nodes, mode=ARGS.shard_mode, token=ARGS.nodes_token
+        )
+    except ValueError as error:
+        PARSER.error(str(error))
+
+    # loaded before the workers are forked so that they share it
+    RULES_CACHE.get()
+
+    # the listings read through the secondary indexes, which a database older than them doesn't have
+    CONNECTION = DB_POOL.connect()
+    try:
+        for index in db_create_missing_indexes(CONNECTION):
+            LOG.warning("Missing index %s created", index)
+    except r.errors.ReqlError as error:
+        LOG.warning("Missing indexes not created: %s", error)
+    finally:
+        CONNECTION.close()
+
+    # the server accepts requests while the missing mp3 files are generated
+    MP3_CACHE.warm_async()
+
+    # the settings file is shared by the workers: PUT /profiles/settings toggles the profiler of all of them
+    REQUEST_PROFILER.configure(profile_dir=ARGS.profile_dir, max_profiles=ARGS.profile_max)
+    # the settings of a previous run are reset (no directory is created while the profiler is off)
+    if ARGS.profile or os.path.exists(REQUEST_PROFILER.settings_path):
+        try:
+            REQUEST_PROFILER.save_settings(enabled=ARGS.profile, sample_rate=ARGS.profile_rate)
+        except ValueError as error:
+            PARSER.error(str(error))
+
+    GAME_ARCHIVE.configure(archive_dir=ARGS.archive_dir)
+    # started by each worker after the fork (serving.post_fork)
+    GAME_ARCHIVER.configure(interval=ARGS.archive_interval, min_age=ARGS.archive_min_age)
 
     # print(APP.before_first_request_funcs)
 
     # Start the RESTful web service used in Avalon
-    APP.run(host=ARGS.host, port=ARGS.port, debug=True)
+    if ARGS.server == "production":
+        # imported here: gunicorn is only needed to serve the application (not by its importers)
+        from serving import run_production  # pylint: disable=C0415
+
+        # the other requests keep at least half of the threads
+        GAME_FEED_HUB.configure(
+            max_thread_subscribers=ARGS.max_subscribers if ARGS.max_subscribers is not None else ARGS.threads // 2
+        )
+        run_production(
+            APP,
+            host=ARGS.host,
+            port=ARGS.port,
+            workers=ARGS.workers,
+            threads=ARGS.threads,
+            keepalive=ARGS.keepalive,
+            graceful_timeout=ARGS.graceful_timeout
+        )
+    elif ARGS.server == "asgi":
+        # imported here: the asyncio driver of RethinkDB is only needed by this server
+        from asgi import AvalonAsgi  # pylint: disable=C0415
+        from serving import run_asgi  # pylint: disable=C0415
+
+        run_asgi(
+            AvalonAsgi(APP, threads=ARGS.threads),
+            host=ARGS.host,
+            port=ARGS.port,
+            workers=ARGS.workers,
+            keepalive=ARGS.keepalive,
+            graceful_timeout=ARGS.graceful_timeout
+        )
+    else:
+        GAME_ARCHIVER.start()
+        APP.run(host=ARGS.host, port=ARGS.port, debug=True)
@@ -1,3 +1,8 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
 class HTTPError(Exception):
     """Class HTTPError related to exception"""
 
@@ -6,3 +11,31 @@ class HTTPError(Exception):
         self.status_code = status_code
         self.payload = payload
         Exception.__init__(self, message, status_code)
+
+
+class PhaseTimer(threading.local):
+    """Time spent by the current thread in each phase (db, serialization...) of the current request"""
+
+    def __init__(self):
+        super().__init__()
+        self.phases = {}
+
+    def reset(self):
+        """Forget the time spent in the previous request"""
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        """Add <seconds> to the time spent in <phase>"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, phase):
+        """Add the time spent in the block to <phase>"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+
+PHASE_TIMER = PhaseTimer()
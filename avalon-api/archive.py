@@ -0,0 +1,302 @@
+"""This module contains the archive of the completed games of the RESTful web service of Avalon.
+The archiver moves them (with their players and quests) out of the tables read by the live endpoints, into
+gzip-compressed JSON lines (one file per day of creation, one gzip member per batch), indexed by game id in
+SQLite so that an archived game can still be fetched.
+
+    python archive.py -storage sqlite -min_age 0
+"""
+
+import argparse
+import contextlib
+import fcntl
+import functools
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+import rethinkdb as r
+
+from avalonBG.exception import AvalonBGError
+
+from db_pool import DB_POOL, RDB
+from game_cache import GAME_CACHE
+from game_events import db_delete_game_events
+
+
+LOG = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "archive"
+
+# games moved per batch
+ARCHIVE_BATCH_SIZE = 500
+
+# seconds between the creation of a game and its archive (the players still read the final state)
+ARCHIVE_MIN_AGE = 3600.0
+
+GZIP_LEVEL = 9
+
+# decoded batches kept in memory for the reads of archived games
+READ_CACHE_SIZE = 16
+
+INDEX_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS games "
+    "(id TEXT PRIMARY KEY, file TEXT, offset INTEGER, length INTEGER, archived_at REAL)"
+)
+
+
+def game_completed_query(game):
+    """Return the query telling if <game> (finished) cannot change anymore: the red team won or Merlin was guessed"""
+    return game["result"]["status"].not_().or_(game["result"].has_fields("guess_merlin_id"))
+
+
+def db_completed_games(before, limit):
+    """Return at most <limit> completed games created before the time <before>, with their players and quests"""
+    return list(
+        RDB.table("games").get_all("finished", index="status")
+        .filter(lambda game: game["created_at"].lt(before).and_(game_completed_query(game)))
+        .limit(limit)
+        .map(lambda game: game.merge({
+            "version": game["version"].default(0),
+            "players": game["players"].map(lambda key: RDB.table("players").get(key)),
+            "quests": game["quests"].map(lambda key: RDB.table("quests").get(key))
+        }))
+        .run()
+    )
+
+
+def db_delete_games(games):
+    """Delete <games> and their events (the games first: no game refers to deleted players or quests)"""
+    game_ids = [game["id"] for game in games]
+    RDB.table("games").get_all(RDB.args(game_ids)).delete().run()
+    db_delete_game_events(game_ids)
+    for table in ("players", "quests"):
+        keys = [row["id"] for game in games for row in game[table] if row is not None]
+        if keys:
+            RDB.table(table).get_all(RDB.args(keys)).delete().run()
+
+
+def archive_day(game):
+    """Return the day of creation of <game> (UTC), which names its archive file"""
+    return time.strftime("%Y-%m-%d", time.gmtime(game["created_at"]))
+
+
+class GameArchive:
+    """Files of the archived games and their index"""
+
+    def __init__(self, archive_dir=ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self._read_batch = functools.lru_cache(maxsize=READ_CACHE_SIZE)(self._read_batch)
+
+    def configure(self, **kwargs):
+        """Change the settings given in <kwargs>"""
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self._read_batch.cache_clear()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.archive_dir, "index.sqlite")
+
+    @contextlib.contextmanager
+    def _index(self):
+        # one connection per use: the archive is read by the threads of every worker
+        connection = sqlite3.connect(self.index_path, timeout=5.0)
+        try:
+            with connection:
+                connection.execute(INDEX_SCHEMA)
+                yield connection
+        finally:
+            connection.close()
+
+    def write(self, games):
+        """Append <games> to the files of their day of creation, then index them"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        by_day = defaultdict(list)
+        for game in games:
+            by_day[archive_day(game)].append(game)
+
+        archived_at = time.time()
+        entries = []
+        for day, day_games in sorted(by_day.items()):
+            name = "games-{}.jsonl.gz".format(day)
+            body = gzip.compress(
+                "".join(json.dumps(game, separators=(",", ":")) + "\n" for game in day_games).encode(),
+                compresslevel=GZIP_LEVEL
+            )
+            # a gzip file can be made of several members: each batch is appended as a member
+            with open(os.path.join(self.archive_dir, name), "ab") as archive_file:
+                offset = archive_file.seek(0, os.SEEK_END)
+                archive_file.write(body)
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+
+            entries += [(game["id"], name, offset, len(body), archived_at) for game in day_games]
+
+        with self._index() as connection:
+            connection.executemany("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)", entries)
+
+    def get(self, game_id):
+        """Return the archived game <game_id>, or None"""
+        if not os.path.exists(self.index_path):
+            return None
+
+        with self._index() as connection:
+            row = connection.execute("SELECT file, offset, length FROM games WHERE id = ?", (game_id,)).fetchone()
+        if row is None:
+            return None
+
+        return self._read_batch(*row).get(game_id)
+
+    def _read_batch(self, name, offset, length):
+        """Return the games of the gzip member at <offset> of the file <name>, by id"""
+        with open(os.path.join(self.archive_dir, name), "rb") as archive_file:
+            archive_file.seek(offset)
+            lines = gzip.decompress(archive_file.read(length)).decode().splitlines()
+
+        return {game["id"]: game for game in map(json.loads, lines)}
+
+    def stats(self):
+        """Return the number of archived games and the size of the archive files"""
+        if not os.path.exists(self.index_path):
+            return {"games": 0, "files": 0, "bytes": 0}
+
+        with self._index() as connection:
+            (nb_games,) = connection.execute("SELECT COUNT(*) FROM games").fetchone()
+        names = [name for name in os.listdir(self.archive_dir) if name.endswith(".jsonl.gz")]
+
+        return {
+            "games": nb_games,
+            "files": len(names),
+            "bytes": sum(os.path.getsize(os.path.join(self.archive_dir, name)) for name in names)
+        }
+
+
+GAME_ARCHIVE = GameArchive()
+
+
+@contextlib.contextmanager
+def archive_lock(archive_dir):
+    """Yield whether this process holds the lock of the archiver (one archiver at a time, whatever the workers)"""
+    os.makedirs(archive_dir, exist_ok=True)
+    with open(os.path.join(archive_dir, "archiver.lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def archive_games(archive=GAME_ARCHIVE, min_age=ARCHIVE_MIN_AGE, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the completed games created more than <min_age> seconds ago to <archive>, <batch_size> at a time.
+    Return the number of archived games (0 if another process is archiving)."""
+    nb_archived = 0
+    with archive_lock(archive.archive_dir) as locked:
+        if not locked:
+            return 0
+
+        while True:
+            games = db_completed_games(before=time.time() - min_age, limit=batch_size)
+            if not games:
+                break
+
+            # written before being deleted: a failure leaves the games in both places, archived again later
+            archive.write(games)
+            db_delete_games(games)
+            for game in games:
+                GAME_CACHE.invalidate(game["id"])
+
+            nb_archived += len(games)
+            if len(games) < batch_size:
+                break
+
+    return nb_archived
+
+
+class GameArchiver:
+    """Background thread archiving the completed games every <interval> seconds (0: never)"""
+
+    def __init__(self, archive=GAME_ARCHIVE, interval=0.0, min_age=ARCHIVE_MIN_AGE, batch_size=ARCHIVE_BATCH_SIZE):
+        self.archive = archive
+        self.interval = interval
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure(self, **kwargs):
+        """Change the settings given in <kwargs>"""
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def start(self):
+        """Start the thread (in each worker: the lock of the archive lets one of them work at a time)"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread after its current run"""
+        self._stop.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            connection = None
+            try:
+                # the archiver holds its own connection, not one of the pool
+                connection = DB_POOL.connect().repl()
+                nb_archived = archive_games(self.archive, min_age=self.min_age, batch_size=self.batch_size)
+                if nb_archived:
+                    LOG.info("%s games archived", nb_archived)
+            except (r.errors.ReqlError, AvalonBGError, OSError, sqlite3.Error) as error:
+                LOG.warning("Archive of the completed games failed: %s", error)
+            finally:
+                if connection is not None:
+                    connection.close(noreply_wait=False)
+
+
+GAME_ARCHIVER = GameArchiver()
+
+
+if __name__ == "__main__":
+
+    from db_indexes import db_create_missing_indexes
+    from storage import STORAGE_ENGINES, create_engine
+
+    PARSER = argparse.ArgumentParser()
+
+    # optional arguments
+    PARSER.add_argument("-archive_dir", type=str, help="directory of the archive", default=ARCHIVE_DIR)
+    PARSER.add_argument(
+        "-min_age", type=float, help="seconds since the creation of the archived games", default=ARCHIVE_MIN_AGE
+    )
+    PARSER.add_argument("-batch_size", type=int, help="games moved per batch", default=ARCHIVE_BATCH_SIZE)
+    PARSER.add_argument("-storage", type=str, help="storage engine", choices=STORAGE_ENGINES, default="rethinkdb")
+    PARSER.add_argument("-host_db", type=str, help="database host", default="rethinkdb")
+    PARSER.add_argument("-port_db", type=int, help="database port", default=28015)
+    PARSER.add_argument("-sqlite_path", type=str, help="SQLite database file", default="avalon.db")
+
+    # parse arguments
+    ARGS = PARSER.parse_args()
+
+    DB_POOL.configure(engine=create_engine(ARGS.storage, ARGS.host_db, ARGS.port_db, ARGS.sqlite_path))
+    DB_POOL.checkout().repl()
+    # the completed games are read through the index 'status'
+    db_create_missing_indexes()
+    GAME_ARCHIVE.configure(archive_dir=ARGS.archive_dir)
+
+    print("{} games archived".format(archive_games(min_age=ARGS.min_age, batch_size=ARGS.batch_size)))
+    print(json.dumps(GAME_ARCHIVE.stats()))
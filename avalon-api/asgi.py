@@ -0,0 +1,574 @@
+"""This module contains the ASGI application of the RESTful web service of Avalon.
+The reads of games, quests and mp3 files and the subscriptions are coroutines (asyncio RethinkDB driver),
+so that waiting clients don't hold a thread; the other routes are served by the Flask application in threads."""
+
+import asyncio
+import io
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import rethinkdb as r
+from flask import json
+from werkzeug.http import http_date, parse_etags, parse_range_header, quote_etag
+
+from avalonBG.exception import AvalonBGError
+from avalonBG.quests import check_quest_number
+
+from api_utils import HTTPError
+from archive import GAME_ARCHIVE
+from compression import encode_body
+from db_pool import DB_POOL
+from game_cache import GAME_CACHE, game_etag, game_exists, game_query, game_quest, game_version_query
+from game_feed import GAME_FEED_HUB, SUBSCRIBER_QUEUE_SIZE, format_event
+from metrics import METRICS
+from mp3_cache import MP3_CACHE, Mp3GenerationError, game_roles_query
+from projection import fields_etag, parse_fields, project
+from pylib import MP3_MAX_AGE, MP3_RETRY_AFTER
+from sharding import FORWARDED_HEADER, SHARD_ROUTER, misrouted
+from storage import RethinkDBEngine
+
+
+RDB_ASYNC = r.RethinkDB()
+RDB_ASYNC.set_loop_type("asyncio")
+
+# size of the chunks of the mp3 files and of the request bodies
+CHUNK_SIZE = 1 << 16
+
+# messages of a response of the Flask application waiting to be sent
+WSGI_QUEUE_SIZE = 16
+
+# seconds between two keep-alive comments of a subscription
+HEARTBEAT = 15.0
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-expose-headers", b"ETag, X-Game-Version")
+]
+
+
+class AsyncDatabase:
+    """Runs the queries of the coroutines: on one asyncio connection to RethinkDB (queries are multiplexed),
+    or in threads with a connection of the pool for the other storage engines"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._connection = None
+        self._lock = None
+
+    async def run(self, query):
+        """Return the result of <query> (sequences as lists)"""
+        if not isinstance(DB_POOL.engine, RethinkDBEngine):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self._run_pooled, query)
+
+        connection = await self._connect()
+        try:
+            result = await query.run(connection)
+            if isinstance(result, r.net.Cursor):
+                result = [item async for item in result]
+        except r.errors.ReqlDriverError:
+            self._connection = None
+            raise
+
+        return result
+
+    async def close(self):
+        """Close the asyncio connection"""
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            await connection.close(noreply_wait=False)
+
+    async def _connect(self):
+        if self._connection is not None and self._connection.is_open():
+            return self._connection
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._connection is None or not self._connection.is_open():
+                self._connection = await RDB_ASYNC.connect(host=DB_POOL.engine.host, port=DB_POOL.engine.port)
+
+        return self._connection
+
+    @staticmethod
+    def _run_pooled(query):
+        connection = DB_POOL.checkout()
+        discard = False
+        try:
+            result = query.run(connection)
+            return list(result) if isinstance(result, r.net.Cursor) else result
+        except r.errors.ReqlDriverError:
+            discard = True
+            raise
+        finally:
+            DB_POOL.checkin(connection, discard=discard)
+
+
+class AsyncSubscriber:
+    """Queue of a coroutine filled by the thread of a changefeed (the oldest events are dropped)"""
+
+    def __init__(self, loop, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put_nowait(self, event):
+        """Called by the changefeed thread"""
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the event loop is closed
+            pass
+
+    def get_nowait(self):
+        """Never needed: put_nowait doesn't raise queue.Full"""
+        return self.queue.get_nowait()
+
+    def _put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+
+class Request:
+    """HTTP request of an ASGI scope"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {}
+        for key, value in scope["headers"]:
+            key = key.decode("latin-1").lower()
+            value = value.decode("latin-1")
+            self.headers[key] = "{},{}".format(self.headers[key], value) if key in self.headers else value
+
+    @property
+    def args(self):
+        """Return the query parameters (first value of each one)"""
+        return {key: values[0] for key, values in parse_qs(self.scope.get("query_string", b"").decode()).items()}
+
+    @property
+    def if_none_match(self):
+        """Return the ETags sent in If-None-Match"""
+        return parse_etags(self.headers.get("if-none-match"))
+
+
+async def send_response(send, status, body=b"", content_type="application/json", headers=()):
+    """Send a whole response"""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode())
+        ] + CORS_HEADERS + [(key.encode(), str(value).encode()) for key, value in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def wait_disconnect(receive):
+    """Return when the client has disconnected"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def build_environ(scope, body):
+    """Return the WSGI environ of an ASGI HTTP scope"""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope["http_version"]),
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+
+    for key, value in scope["headers"]:
+        key = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        environ[key] = "{},{}".format(environ[key], value) if key in environ else value
+
+    return environ
+
+
+class AvalonAsgi:
+    """ASGI application: coroutines for the I/O-bound reads, the Flask application (in threads) for the rest"""
+
+    def __init__(self, flask_app, threads=4):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+        self.database = AsyncDatabase(self.executor)
+        self.routes = [
+            (re.compile(r"^/games/(?P<game_id>[^/]+)$"), "/games/<string:game_id>", self.get_game),
+            (re.compile(r"^/games/(?P<game_id>[^/]+)/quests/(?P<quest_number>[0-9]+)$"),
+             "/games/<string:game_id>/quests/<int:quest_number>", self.get_quest),
+            (re.compile(r"^/games/(?P<game_id>[^/]+)/mp3$"), "/games/<string:game_id>/mp3", self.get_mp3),
+            (re.compile(r"^/games/(?P<game_id>[^/]+)/subscribe$"), "/games/<string:game_id>/subscribe",
+             self.subscribe)
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Start and stop the application"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.database.close()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        """Serve a request with a coroutine if it has one, else with the Flask application"""
+        if scope["method"] == "GET":
+            if SHARD_ROUTER.refresh_due:
+                await asyncio.get_running_loop().run_in_executor(self.executor, SHARD_ROUTER.refresh)
+            for pattern, rule, handler in self.routes:
+                match = pattern.match(scope["path"])
+                if match is None:
+                    continue
+                request = Request(scope)
+                # the Flask application forwards (or redirects) the requests of the games owned by other nodes
+                if misrouted(match["game_id"], FORWARDED_HEADER.lower() in request.headers) is None:
+                    await self.serve(rule, handler, request, match.groupdict(), receive, send)
+                    return
+                break
+
+        await self.serve_wsgi(scope, receive, send)
+
+    async def serve(self, rule, handler, request, args, receive, send):
+        """Run a coroutine handler, turning the errors into JSON responses, and record its latency"""
+        start = time.perf_counter()
+        try:
+            status = await handler(request, send, receive, **args)
+        except AvalonBGError as error:
+            status = await self.send_error(send, HTTPError(str(error), status_code=400))
+        except HTTPError as error:
+            status = await self.send_error(send, error)
+        except r.errors.ReqlError as error:
+            status = await self.send_error(send, HTTPError("Database error: {}".format(error), status_code=500))
+
+        METRICS.observe_request(
+            route=rule,
+            method=request.method,
+            status=status,
+            latency=time.perf_counter() - start,
+            phases={}
+        )
+
+    async def send_error(self, send, error):
+        """Send an HTTPError as the Flask application does"""
+        METRICS.count_error(error.status_code)
+        await send_response(send, error.status_code, self.dumps(error.__dict__))
+
+        return error.status_code
+
+    async def retry_later(self, send, message, retry_after):
+        """Send a 503 asking the client to retry after <retry_after> seconds"""
+        error = HTTPError(message, status_code=503)
+        METRICS.count_error(error.status_code)
+        await send_response(send, 503, self.dumps(error.__dict__), headers=[("Retry-After", retry_after)])
+
+        return 503
+
+    def dumps(self, data):
+        """Encode <data> with the JSON encoder of the Flask application"""
+        return json.dumps(data, app=self.flask_app).encode() + b"\n"
+
+    async def versioned(self, request, send, etag, load):
+        """Send the data returned by <load>, or 304 if the client already has it"""
+        if request.if_none_match.contains_weak(etag):
+            await send_response(send, 304, headers=[("ETag", quote_etag(etag))])
+            return 304
+
+        body, encoding = encode_body(self.dumps(await load()), request.headers.get("accept-encoding"))
+        headers = [("Vary", "Accept-Encoding"), ("ETag", quote_etag(etag, weak=encoding is not None))]
+        if encoding is not None:
+            headers.append(("Content-Encoding", encoding))
+
+        await send_response(send, 200, body, headers=headers)
+        return 200
+
+    async def load_game(self, game_id, version):
+        """Return the game <game_id> at <version> from the cache or the database"""
+        game = GAME_CACHE.lookup(game_id, version)
+        if game is None:
+            game = game_exists(game_id, await self.database.run(game_query(game_id)))
+            GAME_CACHE.put(game)
+
+        return game
+
+    async def get_version(self, game_id):
+        """Return the version of the game <game_id>"""
+        return game_exists(game_id, await self.database.run(game_version_query(game_id)))
+
+    async def get_game(self, request, send, receive, game_id):
+        """Fetch the game <game_id>"""
+        # pylint: disable=W0613
+        field_names = parse_fields(request.args.get("fields"))
+        try:
+            version = await self.get_version(game_id)
+        except AvalonBGError:
+            game = await asyncio.get_running_loop().run_in_executor(self.executor, GAME_ARCHIVE.get, game_id)
+            if game is None:
+                raise
+
+            async def load_archived():
+                return project(game, field_names)
+
+            etag = game_etag(game_id, game["version"], *fields_etag(field_names))
+            return await self.versioned(request, send, etag, load_archived)
+
+        async def load():
+            return project(await self.load_game(game_id, version), field_names)
+
+        return await self.versioned(request, send, game_etag(game_id, version, *fields_etag(field_names)), load)
+
+    async def get_quest(self, request, send, receive, game_id, quest_number):
+        """Fetch the quest <quest_number> of the game <game_id>"""
+        # pylint: disable=W0613
+        quest_number = int(quest_number)
+        check_quest_number(quest_number=quest_number)
+        field_names = parse_fields(request.args.get("fields"))
+        version = await self.get_version(game_id)
+
+        async def load():
+            return project(game_quest(await self.load_game(game_id, version), quest_number), field_names)
+
+        etag = game_etag(game_id, version, "quests", quest_number, *fields_etag(field_names))
+        return await self.versioned(request, send, etag, load)
+
+    async def get_mp3(self, request, send, receive, game_id):
+        """Fetch the mp3 file depending on roles in the game <game_id>"""
+        # pylint: disable=W0613
+        try:
+            roles = await self.database.run(game_roles_query(game_id))
+        except r.errors.ReqlNonExistenceError as error:
+            raise AvalonBGError("Game's id {} does not exist!".format(game_id)) from error
+
+        try:
+            # shielded: the generation goes on for the next requests
+            mp3_file = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(MP3_CACHE.get_future(roles))),
+                timeout=MP3_CACHE.wait_timeout
+            )
+        except asyncio.TimeoutError:
+            return await self.retry_later(send, "Mp3 file is being generated, retry later!", MP3_RETRY_AFTER)
+        except Mp3GenerationError as error:
+            return await self.retry_later(send, str(error), error.retry_after)
+
+        headers = [
+            ("ETag", quote_etag(mp3_file.etag)),
+            ("Cache-Control", "public, max-age={}".format(MP3_MAX_AGE)),
+            ("Expires", http_date(time.time() + MP3_MAX_AGE)),
+            ("Content-Disposition", "inline; filename=roles.mp3"),
+            ("Accept-Ranges", "bytes")
+        ]
+        if request.if_none_match.contains_weak(mp3_file.etag):
+            await send_response(send, 304, headers=headers)
+            return 304
+
+        loop = asyncio.get_running_loop()
+        with open(mp3_file.path, "rb") as infile:
+            length = await loop.run_in_executor(self.executor, infile.seek, 0, io.SEEK_END)
+
+            status, start, stop = 200, 0, length
+            content_range = parse_range_header(request.headers.get("range"))
+            if content_range is not None:
+                bounds = content_range.range_for_length(length)
+                if bounds is None:
+                    await send_response(send, 416, headers=[("Content-Range", "bytes */{}".format(length))])
+                    return 416
+                status, (start, stop) = 206, bounds
+                headers.append(("Content-Range", "bytes {}-{}/{}".format(start, stop - 1, length)))
+
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"audio/mpeg"), (b"content-length", str(stop - start).encode())]
+                + CORS_HEADERS + [(key.encode(), str(value).encode()) for key, value in headers]
+            })
+
+            await loop.run_in_executor(self.executor, infile.seek, start)
+            while start < stop:
+                chunk = await loop.run_in_executor(self.executor, infile.read, min(CHUNK_SIZE, stop - start))
+                if not chunk:
+                    break
+                start += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": start < stop})
+
+        return status
+
+    async def subscribe(self, request, send, receive, game_id):
+        """Stream the game <game_id>, then each of its updates, as server-sent events"""
+        # pylint: disable=W0613
+        await self.get_version(game_id)
+
+        subscriber = AsyncSubscriber(asyncio.get_running_loop())
+        GAME_FEED_HUB.subscribe(game_id, subscriber=subscriber)
+        try:
+            # read after subscribing so that no update is missed
+            game = await self.load_game(game_id, await self.get_version(game_id))
+        except (AvalonBGError, r.errors.ReqlError):
+            GAME_FEED_HUB.unsubscribe(game_id, subscriber)
+            raise
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no")
+            ] + CORS_HEADERS
+        })
+
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await self.stream_events(send, game, subscriber, disconnected)
+        finally:
+            disconnected.cancel()
+            GAME_FEED_HUB.unsubscribe(game_id, subscriber)
+
+        return 200
+
+    @staticmethod
+    async def stream_events(send, game, subscriber, disconnected):
+        """Send the game, then its updates, until it is deleted or the client disconnects"""
+        await send({"type": "http.response.body", "body": format_event("game", game).encode(), "more_body": True})
+        version = game["version"]
+
+        while not disconnected.done():
+            next_event = asyncio.ensure_future(subscriber.queue.get())
+            done, _ = await asyncio.wait({next_event, disconnected}, timeout=HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if next_event not in done:
+                next_event.cancel()
+                if not disconnected.done():
+                    await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+                continue
+
+            event, data = next_event.result()
+            if event == "game":
+                # an update may have been published before the initial state was read
+                if data["version"] <= version:
+                    continue
+                version = data["version"]
+
+            await send({
+                "type": "http.response.body",
+                "body": format_event(event, data).encode(),
+                "more_body": event != "deleted"
+            })
+            if event == "deleted":
+                return
+
+    async def serve_wsgi(self, scope, receive, send):
+        """Serve the request with the Flask application in a thread, streaming its response"""
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        loop = asyncio.get_running_loop()
+        response = WsgiResponse(loop)
+        # the whole response is produced by one thread: the contexts of Flask, the default connection of the
+        # thread and the phase timer are thread-local
+        task = loop.run_in_executor(self.executor, self.run_wsgi, build_environ(scope, body), response)
+
+        try:
+            message = await response.queue.get()
+            while message is not None:
+                await send(message)
+                message = await response.queue.get()
+        finally:
+            response.abort()
+            await task
+
+    def run_wsgi(self, environ, response):
+        """Call the Flask application and put its response (ASGI messages) in the queue of <response>"""
+        status_headers = {}
+
+        def start_response(status, headers, exc_info=None):
+            # pylint: disable=W0613
+            status_headers["status"] = int(status.split(" ", 1)[0])
+            status_headers["headers"] = headers
+
+        iterable = self.flask_app.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in iterable:
+                # the status is known once the first chunk is produced
+                if not chunk:
+                    continue
+                if not started:
+                    response.start(status_headers["status"], status_headers["headers"])
+                    started = True
+                if not response.put({"type": "http.response.body", "body": chunk, "more_body": True}):
+                    return
+            if not started:
+                response.start(status_headers["status"], status_headers["headers"])
+            response.put({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            response.put(None)
+
+
+class WsgiResponse:
+    """Messages of a WSGI response, put by the thread running it and sent by the coroutine of the request.
+    The queue is bounded: the thread waits for the client."""
+
+    def __init__(self, loop, maxsize=WSGI_QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.aborted = False
+
+    def start(self, status, headers):
+        """Put the start of the response"""
+        return self.put({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers]
+        })
+
+    def put(self, message):
+        """Called by the thread: put <message> (None: end of the response), return False if it was aborted"""
+        if self.aborted:
+            return False
+
+        asyncio.run_coroutine_threadsafe(self.queue.put(message), self.loop).result()
+        return True
+
+    def abort(self):
+        """Called by the coroutine: stop the thread (the client is gone or the response is sent)"""
+        self.aborted = True
+        # wakes up the thread if it waits for room in the queue
+        while not self.queue.empty():
+            self.queue.get_nowait()
@@ -0,0 +1,88 @@
+"""This module contains the tests of the ASGI application serving the Flask application in threads.
+
+    python -m unittest asgi_test
+"""
+
+import asyncio
+import json
+import unittest
+
+from api import APP
+from asgi import AvalonAsgi
+from db_pool import DB_POOL
+from storage import create_engine
+
+
+NB_GAMES = 30
+
+
+def http_scope(path, query_string=b""):
+    """Return the ASGI scope of GET <path>"""
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query_string,
+        "headers": [],
+        "http_version": "1.1"
+    }
+
+
+async def receive():
+    return {"type": "http.request", "body": b""}
+
+
+class StreamedResponseTest(unittest.TestCase):
+    """Streamed responses of the Flask application (NDJSON listings) served by several threads"""
+
+    @classmethod
+    def setUpClass(cls):
+        DB_POOL.configure(engine=create_engine("memory"), max_size=8)
+        with APP.test_client() as client:
+            client.put("/restart_db", json=["games", "players", "quests"])
+            cls.game_ids = {
+                client.put("/games", json={
+                    "players": [{"name": "player{}".format(index), "avatar_index": index} for index in range(5)],
+                    "roles": []
+                }).get_json()["id"]
+                for _ in range(NB_GAMES)
+            }
+
+    def serve(self, threads, send):
+        """Serve the NDJSON listing of the games with <threads> threads"""
+        application = AvalonAsgi(APP, threads=threads)
+        try:
+            asyncio.run(application.http(http_scope("/games", b"format=ndjson&limit=2"), receive, send))
+        finally:
+            application.executor.shutdown(wait=True)
+
+    def test_ndjson_several_threads(self):
+        for threads in (1, 4, 8):
+            messages = []
+
+            async def send(message, messages=messages):
+                messages.append(message)
+
+            self.serve(threads, send)
+
+            self.assertEqual(messages[0]["status"], 200)
+            rows = b"".join(message.get("body", b"") for message in messages[1:]).splitlines()
+            self.assertEqual({json.loads(row)["id"] for row in rows}, self.game_ids)
+            self.assertFalse(messages[-1].get("more_body", False))
+
+    def test_client_disconnected(self):
+        sent = []
+
+        async def send(message):
+            if len(sent) == 3:
+                raise ConnectionError("client disconnected")
+            sent.append(message)
+
+        # the thread stops and closes the response (in the thread which opened its contexts)
+        with self.assertRaises(ConnectionError):
+            self.serve(4, send)
+        self.assertEqual(len(sent), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
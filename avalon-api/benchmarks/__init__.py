@@ -0,0 +1 @@
+"""Benchmarks of the RESTful web service of Avalon (run from avalon-api: python -m benchmarks.<name>)"""
@@ -0,0 +1,118 @@
+"""This script measures the bytes and the CPU time per response of the large reads of the RESTful web service
+of Avalon (tables of games and players, games), for each JSON encoder and each content encoding.
+
+    python -m benchmarks.json_compression -games 200 -requests 50
+"""
+
+import argparse
+import json
+import random
+import time
+
+from flask.json import JSONEncoder
+
+from api import APP
+from benchmarks.load_test import TABLES, Recorder, play_game
+from compression import ENCODINGS
+from db_pool import DB_POOL
+from json_encoding import FastJSONEncoder
+from metrics import timed_json_encoder
+from storage import create_engine
+
+
+ENCODERS = {
+    "json": JSONEncoder,
+    "orjson": FastJSONEncoder
+}
+
+
+def create_games(client, nb_games, seed):
+    """Play <nb_games> games (without their mp3 files) and return their ids"""
+    response = client.put("/restart_db", json=TABLES)
+    if response.status_code >= 400:
+        raise RuntimeError("PUT /restart_db: {}".format(response.get_data(as_text=True)))
+
+    recorder = Recorder()
+    for index in range(nb_games):
+        play_game(client, recorder, random.Random(seed + index), mp3=False)
+
+    return [game["id"] for game in client.get("/games").get_json()]
+
+
+def measure(client, urls, accept_encoding):
+    """Return the mean bytes and CPU milliseconds per response of GET <urls>"""
+    nb_bytes = 0
+    start = time.process_time()
+    for url in urls:
+        response = client.get(url, headers={"Accept-Encoding": accept_encoding})
+        if response.status_code != 200:
+            raise RuntimeError("GET {}: {}".format(url, response.status_code))
+        nb_bytes += len(response.get_data())
+    cpu = time.process_time() - start
+
+    return {"bytes": nb_bytes / len(urls), "cpu_ms": 1000 * cpu / len(urls)}
+
+
+def run(nb_games, nb_requests, seed):
+    """Return the statistics of each endpoint, encoder and content encoding"""
+    DB_POOL.configure(engine=create_engine("memory"), max_size=1)
+    json_encoder = APP.json_encoder
+
+    results = {}
+    with APP.test_client() as client:
+        game_ids = create_games(client, nb_games, seed)
+        endpoints = {
+            "GET /games": ["/games"] * nb_requests,
+            "GET /players": ["/players"] * nb_requests,
+            "GET /games/<id>": [
+                "/games/{}".format(game_id) for game_id in random.Random(seed).choices(game_ids, k=nb_requests)
+            ]
+        }
+
+        try:
+            for encoder_name, encoder_class in ENCODERS.items():
+                APP.json_encoder = timed_json_encoder(encoder_class)
+                for encoding in ("identity",) + ENCODINGS:
+                    for endpoint, urls in endpoints.items():
+                        # warm up the caches
+                        measure(client, urls[:1], encoding)
+                        results.setdefault(endpoint, {})["{} {}".format(encoder_name, encoding)] = \
+                            measure(client, urls, encoding)
+        finally:
+            APP.json_encoder = json_encoder
+
+    return results
+
+
+def print_results(results):
+    """Print the statistics as a table, with the ratios to the stdlib encoder without compression"""
+    print("{:<16}{:<20}{:>12}{:>10}{:>12}{:>10}".format("endpoint", "configuration", "bytes", "ratio", "cpu_ms", "ratio"))
+    for endpoint, configurations in results.items():
+        reference = configurations["json identity"]
+        for configuration, stats in configurations.items():
+            print("{:<16}{:<20}{:>12.0f}{:>10.2f}{:>12.3f}{:>10.2f}".format(
+                endpoint, configuration, stats["bytes"], stats["bytes"] / reference["bytes"],
+                stats["cpu_ms"], stats["cpu_ms"] / reference["cpu_ms"]
+            ))
+
+
+if __name__ == "__main__":
+
+    PARSER = argparse.ArgumentParser()
+
+    # optional arguments
+    PARSER.add_argument("-games", type=int, help="number of games in the database", default=100)
+    PARSER.add_argument("-requests", type=int, help="number of requests per endpoint and configuration", default=50)
+    PARSER.add_argument("-seed", type=int, help="seed of the random choices", default=0)
+    PARSER.add_argument("-output", type=str, help="write the results to this JSON file")
+
+    # parse arguments
+    ARGS = PARSER.parse_args()
+
+    RESULTS = run(nb_games=ARGS.games, nb_requests=ARGS.requests, seed=ARGS.seed)
+
+    print_results(RESULTS)
+
+    if ARGS.output:
+        with open(ARGS.output, "w") as outfile:
+            json.dump(RESULTS, outfile, indent=4)
@@ -0,0 +1,312 @@
+"""This script plays full games through the RESTful web service of Avalon, against a local storage engine,
+and reports the throughput, latency and allocations per endpoint.
+
+    python -m benchmarks.load_test -games 200 -concurrency 8 -output results.json
+    python -m benchmarks.load_test -games 200 -concurrency 8 -baseline results.json
+"""
+
+import argparse
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from api import APP
+from db_pool import DB_POOL
+from mp3_cache import MP3_CACHE, all_mp3_roles_keys
+from storage import create_engine
+
+
+TABLES = ["games", "players", "quests"]
+
+# valid for any number of players
+ROLE_SETS = ([], ["oberon"], ["perceval", "morgan"], ["perceval", "morgan", "mordred"])
+
+# probability to refuse a team before sending it on a quest
+UNSEND_RATE = 0.2
+
+
+class GameFailed(Exception):
+    """Class GameFailed related to a request of a game which returned an error"""
+
+
+def percentile(sorted_values, rank):
+    """Return the <rank>th percentile (nearest rank) of <sorted_values>"""
+    if not sorted_values:
+        return 0.0
+
+    index = max(0, min(len(sorted_values) - 1, int(round(rank / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    """Latency, errors and allocations of the requests per endpoint"""
+
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._errors = {}
+        self._allocated = {}
+
+    def call(self, client, endpoint, method, url, **kwargs):
+        """Send a request and record it under <endpoint>"""
+        if self.allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        latency = time.perf_counter() - start
+
+        with self._lock:
+            self._latencies.setdefault(endpoint, []).append(latency)
+            if response.status_code >= 400:
+                self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+            if self.allocations:
+                self._allocated.setdefault(endpoint, []).append(tracemalloc.get_traced_memory()[1] - before)
+
+        return response
+
+    def results(self, duration):
+        """Return the statistics of each endpoint"""
+        results = {}
+        for endpoint, latencies in sorted(self._latencies.items()):
+            latencies = sorted(latencies)
+            results[endpoint] = {
+                "requests": len(latencies),
+                "errors": self._errors.get(endpoint, 0),
+                "throughput": len(latencies) / duration,
+                "mean_ms": 1000 * sum(latencies) / len(latencies),
+                "p50_ms": 1000 * percentile(latencies, 50),
+                "p99_ms": 1000 * percentile(latencies, 99),
+                "max_ms": 1000 * latencies[-1]
+            }
+            allocated = self._allocated.get(endpoint)
+            if allocated:
+                results[endpoint]["alloc_peak_kib"] = sum(allocated) / len(allocated) / 1024
+
+        return results
+
+
+def play_game(client, recorder, rng, mp3=True, batch_votes=False):
+    """Play a game from its creation to the guess of Merlin (fetching its mp3 file if <mp3>).
+    With <batch_votes>, the votes of each quest and the next team are sent in one request."""
+
+    def call(endpoint, method, url, **kwargs):
+        response = recorder.call(client, endpoint, method, url, **kwargs)
+        if response.status_code >= 400:
+            raise GameFailed("{} {}: {} {}".format(method, url, response.status_code, response.get_data(as_text=True)))
+        return response
+
+    nb_players = rng.randint(5, 10)
+    game = call("PUT /games", "PUT", "/games", json={
+        "players": [{"name": "player{}".format(index), "avatar_index": index} for index in range(nb_players)],
+        "roles": rng.choice(ROLE_SETS)
+    }).get_json()
+
+    game_id = game["id"]
+    players = game["players"]
+    blue_ids = [player["id"] for player in players if player["team"] == "blue"]
+    teams = {player["id"]: player["team"] for player in players}
+
+    if mp3:
+        call("GET /games/<id>/mp3", "GET", "/games/{}/mp3".format(game_id))
+
+    next_team = None
+    while "result" not in game:
+        quest_number = game["current_quest"]
+        quest_url = "/games/{}/quests/{}".format(game_id, quest_number)
+
+        team = next_team
+        if team is None:
+            if game["nb_quest_unsend"] < 4 and rng.random() < UNSEND_RATE:
+                call("POST /games/<id>/quest_unsend", "POST", "/games/{}/quest_unsend".format(game_id))
+
+            team = rng.sample(list(teams), game["quests"][quest_number]["nb_players_to_send"])
+            call("PUT /games/<id>/quests/<n>", "PUT", quest_url, json=team)
+
+        votes = {player_id: teams[player_id] == "blue" or rng.random() < 0.5 for player_id in team}
+
+        if batch_votes:
+            ballot = {"votes": votes}
+            next_team = None
+            if quest_number < 4:
+                next_team = rng.sample(list(teams), game["quests"][quest_number + 1]["nb_players_to_send"])
+                ballot["next_team"] = next_team
+            game = call("POST /games/<id>/quests/<n>/votes", "POST", quest_url + "/votes", json=ballot).get_json()
+            continue
+
+        for player_id, vote in votes.items():
+            call("POST /games/<id>/quests/<n>", "POST", quest_url, json={player_id: vote})
+
+        game = call("GET /games/<id>", "GET", "/games/{}".format(game_id)).get_json()
+
+    if game["result"]["status"]:
+        assassin_id = next(player["id"] for player in players if player.get("assassin"))
+        call("POST /games/<id>/guess_merlin", "POST", "/games/{}/guess_merlin".format(game_id),
+             json={assassin_id: rng.choice(blue_ids)})
+
+
+def prepare_mp3_files(output_mp3_path):
+    """Make the mp3 files available: generated if ffmpeg is installed, else placeholders (the audio doesn't matter)"""
+    MP3_CACHE.output_mp3_path = output_mp3_path
+
+    if shutil.which("ffmpeg"):
+        MP3_CACHE.warm()
+        return
+
+    print("ffmpeg not found: /mp3 serves placeholder files", file=sys.stderr)
+    for key in all_mp3_roles_keys():
+        MP3_CACHE.path(key).write_bytes(key.encode() * 4096)
+
+
+def run(engine, nb_games, concurrency, seed, allocations, batch_votes=False):
+    """Play <nb_games> games, <concurrency> at a time, and return the statistics per endpoint"""
+    DB_POOL.configure(engine=engine, max_size=concurrency)
+
+    recorder = Recorder(allocations=allocations)
+    failures = []
+
+    with APP.test_client() as client:
+        response = client.put("/restart_db", json=TABLES)
+        if response.status_code >= 400:
+            raise GameFailed("PUT /restart_db: {}".format(response.get_data(as_text=True)))
+
+    local = threading.local()
+
+    def play(index):
+        if not hasattr(local, "client"):
+            local.client = APP.test_client()
+        try:
+            play_game(local.client, recorder, random.Random(seed + index), batch_votes=batch_votes)
+        except GameFailed as error:
+            failures.append(str(error))
+
+    if allocations:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(play, range(nb_games)))
+    duration = time.perf_counter() - start
+
+    if allocations:
+        tracemalloc.stop()
+
+    endpoints = recorder.results(duration)
+    nb_requests = sum(stats["requests"] for stats in endpoints.values())
+
+    return {
+        "storage": engine.name,
+        "games": nb_games,
+        "concurrency": concurrency,
+        "batch_votes": batch_votes,
+        "failed_games": len(failures),
+        "first_failure": failures[0] if failures else None,
+        "duration_s": duration,
+        "requests": nb_requests,
+        "throughput": nb_requests / duration,
+        "endpoints": endpoints
+    }
+
+
+def print_results(results):
+    """Print the statistics as a table"""
+    columns = ["requests", "errors", "throughput", "mean_ms", "p50_ms", "p99_ms", "max_ms", "alloc_peak_kib"]
+
+    print("{} games ({} failed) on {}, concurrency {}: {} requests in {:.2f} s, {:.1f} req/s".format(
+        results["games"], results["failed_games"], results["storage"], results["concurrency"],
+        results["requests"], results["duration_s"], results["throughput"]
+    ))
+    if results["first_failure"]:
+        print("first failure: {}".format(results["first_failure"]))
+
+    width = max(len(endpoint) for endpoint in results["endpoints"]) if results["endpoints"] else 10
+    print("{:<{}}".format("endpoint", width) + "".join("{:>16}".format(column) for column in columns))
+    for endpoint, stats in results["endpoints"].items():
+        print("{:<{}}".format(endpoint, width) + "".join(
+            "{:>16}".format("-" if column not in stats else "{:.2f}".format(stats[column])
+                            if isinstance(stats[column], float) else stats[column])
+            for column in columns
+        ))
+
+
+def compare(results, baseline, max_regression):
+    """Return the regressions of p99 latency (and of the throughput) larger than <max_regression> (0.2 = 20%)"""
+    regressions = []
+
+    if results["throughput"] < baseline["throughput"] * (1 - max_regression):
+        regressions.append("throughput: {:.1f} req/s < {:.1f} req/s".format(
+            results["throughput"], baseline["throughput"]
+        ))
+
+    for endpoint, stats in results["endpoints"].items():
+        reference = baseline["endpoints"].get(endpoint)
+        if reference is not None and stats["p99_ms"] > reference["p99_ms"] * (1 + max_regression):
+            regressions.append("{} p99: {:.2f} ms > {:.2f} ms".format(endpoint, stats["p99_ms"], reference["p99_ms"]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    PARSER = argparse.ArgumentParser()
+
+    # optional arguments
+    PARSER.add_argument("-games", type=int, help="number of games to play", default=100)
+    PARSER.add_argument("-concurrency", type=int, help="number of games played at the same time", default=4)
+    PARSER.add_argument(
+        "-storage",
+        type=str,
+        help="storage engine: 'memory' or 'sqlite' (temporary file)",
+        choices=("memory", "sqlite"),
+        default="memory"
+    )
+    PARSER.add_argument("-seed", type=int, help="seed of the random choices of the players", default=0)
+    PARSER.add_argument(
+        "-allocations",
+        action="store_true",
+        help="measure the memory allocated by each request (slower, forces a concurrency of 1)"
+    )
+    PARSER.add_argument(
+        "-batch_votes",
+        action="store_true",
+        help="send the votes of each quest (and the next team) in one request"
+    )
+    PARSER.add_argument("-output", type=str, help="write the results to this JSON file")
+    PARSER.add_argument("-baseline", type=str, help="JSON results to compare with (exit status 1 on regression)")
+    PARSER.add_argument("-max_regression", type=float, help="tolerated regression (0.2 = 20%%)", default=0.2)
+
+    # parse arguments
+    ARGS = PARSER.parse_args()
+
+    with tempfile.TemporaryDirectory() as TMP_DIR:
+        prepare_mp3_files(Path(TMP_DIR))
+        RESULTS = run(
+            engine=create_engine(ARGS.storage, sqlite_path=Path(TMP_DIR, "avalon.db").as_posix()),
+            nb_games=ARGS.games,
+            concurrency=1 if ARGS.allocations else ARGS.concurrency,
+            seed=ARGS.seed,
+            allocations=ARGS.allocations,
+            batch_votes=ARGS.batch_votes
+        )
+
+    print_results(RESULTS)
+
+    if ARGS.output:
+        with open(ARGS.output, "w") as outfile:
+            json.dump(RESULTS, outfile, indent=4)
+
+    if ARGS.baseline:
+        with open(ARGS.baseline) as infile:
+            REGRESSIONS = compare(RESULTS, json.load(infile), ARGS.max_regression)
+        for REGRESSION in REGRESSIONS:
+            print("regression: {}".format(REGRESSION))
+        sys.exit(1 if REGRESSIONS or RESULTS["failed_games"] else 0)
@@ -0,0 +1,181 @@
+"""This script measures the cold start of the RESTful web service of Avalon: the import of the application, the time
+until a new server (in-memory storage) answers its first request, and the first and cached requests of the OpenAPI
+specification.
+
+    python -m benchmarks.startup -repeats 5 -output startup.json
+    python -m benchmarks.startup -repeats 5 -baseline startup.json
+"""
+
+import argparse
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+
+API_SCRIPT = Path(__file__).resolve().parent.parent / "api.py"
+
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import api; print(time.perf_counter() - start)"
+
+# seconds to wait for a server to answer
+START_TIMEOUT = 30.0
+
+POLL_INTERVAL = 0.005
+
+
+def free_port():
+    """Return a TCP port nobody listens to"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import():
+    """Return the seconds taken to import the application in a new interpreter"""
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", IMPORT_SCRIPT],
+        cwd=API_SCRIPT.parent,
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+
+    return float(output.strip().splitlines()[-1])
+
+
+def timed_get(url, headers=None):
+    """Return the status of GET <url>, its ETag and its latency (ms)"""
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as response:
+            response.read()
+            status, etag = response.status, response.headers.get("ETag")
+    except urllib.error.HTTPError as error:
+        status, etag = error.code, error.headers.get("ETag")
+
+    return status, etag, (time.perf_counter() - start) * 1000
+
+
+def measure_server(server, work_dir):
+    """Start a server and return the seconds until its first response and the latencies of the specification"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-W", "ignore", str(API_SCRIPT), "-storage", "memory", "-server", server,
+         "-workers", "1", "-port", str(port)],
+        cwd=work_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    base_url = "http://127.0.0.1:{}".format(port)
+
+    try:
+        while True:
+            try:
+                timed_get(base_url + "/metrics")
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None or time.perf_counter() - start > START_TIMEOUT:
+                    raise RuntimeError("The {} server did not start".format(server)) from None
+                time.sleep(POLL_INTERVAL)
+        first_request = time.perf_counter() - start
+
+        _, etag, first_spec = timed_get(base_url + "/swagger.json")
+        _, _, spec = timed_get(base_url + "/swagger.json")
+        status, _, cached_spec = timed_get(base_url + "/swagger.json", headers={"If-None-Match": etag or ""})
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "first_request_s": first_request,
+        "first_spec_ms": first_spec,
+        "spec_ms": spec,
+        "not_modified_spec_ms": cached_spec if status == 304 else None
+    }
+
+
+def run(servers, repeats):
+    """Return the medians of <repeats> measures"""
+    imports = [measure_import() for _ in range(repeats)]
+
+    results = {"repeats": repeats, "import_s": statistics.median(imports), "servers": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for server in servers:
+            measures = [measure_server(server, work_dir) for _ in range(repeats)]
+            results["servers"][server] = {
+                key: None if None in values else statistics.median(values)
+                for key, values in ((key, [measure[key] for measure in measures]) for key in measures[0])
+            }
+
+    return results
+
+
+def print_results(results):
+    """Print the measures as a table"""
+    columns = ["first_request_s", "first_spec_ms", "spec_ms", "not_modified_spec_ms"]
+
+    print("import of the application: {:.3f} s (median of {})".format(results["import_s"], results["repeats"]))
+    print("{:<12}".format("server") + "".join("{:>22}".format(column) for column in columns))
+    for server, stats in results["servers"].items():
+        print("{:<12}".format(server) + "".join(
+            "{:>22}".format("-" if stats[column] is None else "{:.3f}".format(stats[column])) for column in columns
+        ))
+
+
+def compare(results, baseline, max_regression):
+    """Return the measures slower than in <baseline> by more than <max_regression> (0.2 = 20%)"""
+    regressions = []
+
+    if results["import_s"] > baseline["import_s"] * (1 + max_regression):
+        regressions.append("import: {:.3f} s > {:.3f} s".format(results["import_s"], baseline["import_s"]))
+
+    for server, stats in results["servers"].items():
+        reference = baseline["servers"].get(server, {})
+        for key, value in stats.items():
+            if value is not None and reference.get(key) is not None and value > reference[key] * (1 + max_regression):
+                regressions.append("{} {}: {:.3f} > {:.3f}".format(server, key, value, reference[key]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    PARSER = argparse.ArgumentParser()
+
+    # optional arguments
+    PARSER.add_argument("-repeats", type=int, help="number of measures (their median is reported)", default=5)
+    PARSER.add_argument(
+        "-servers",
+        type=str,
+        nargs="+",
+        help="servers to start",
+        choices=("production", "asgi"),
+        default=["production", "asgi"]
+    )
+    PARSER.add_argument("-output", type=str, help="write the results to this JSON file")
+    PARSER.add_argument("-baseline", type=str, help="JSON results to compare with (exit status 1 on regression)")
+    PARSER.add_argument("-max_regression", type=float, help="tolerated regression (0.2 = 20%%)", default=0.2)
+
+    # parse arguments
+    ARGS = PARSER.parse_args()
+
+    RESULTS = run(servers=ARGS.servers, repeats=ARGS.repeats)
+    print_results(RESULTS)
+
+    if ARGS.output:
+        with open(ARGS.output, "w") as outfile:
+            json.dump(RESULTS, outfile, indent=4)
+
+    if ARGS.baseline:
+        with open(ARGS.baseline) as infile:
+            REGRESSIONS = compare(RESULTS, json.load(infile), ARGS.max_regression)
+        for REGRESSION in REGRESSIONS:
+            print("regression: {}".format(REGRESSION))
+        sys.exit(1 if REGRESSIONS else 0)
@@ -0,0 +1,79 @@
+"""This module contains the compression of the responses of the RESTful web service of Avalon,
+negotiated with Accept-Encoding: brotli (when it is installed) or gzip"""
+
+import gzip
+
+from flask import Blueprint, request
+from werkzeug.http import parse_accept_header
+
+from api_utils import PHASE_TIMER
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# smaller bodies are sent as they are (they already fit in a TCP packet)
+MIN_SIZE = 1024
+
+GZIP_LEVEL = 6
+
+# fast qualities of brotli compress better than gzip in less time
+BROTLI_QUALITY = 4
+
+# by order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/plain", "text/html")
+
+
+def negotiate_encoding(accept_encoding):
+    """Return the preferred encoding accepted by the header <accept_encoding>, or None"""
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+
+def compress(body, encoding):
+    """Return <body> (bytes) compressed with <encoding>"""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encode_body(body, accept_encoding):
+    """Return <body> compressed for a client sending <accept_encoding>, and its encoding (None if left as it is)"""
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= MIN_SIZE else None
+    if encoding is None:
+        return body, None
+
+    return compress(body, encoding), encoding
+
+
+COMPRESSION_BLUEPRINT = Blueprint("compression", __name__)
+
+
+@COMPRESSION_BLUEPRINT.after_app_request
+def compress_response(response):
+    """Compress the JSON and text responses (files and streamed responses are sent as they are)"""
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough or response.is_streamed \
+            or response.status_code < 200 or response.status_code in (204, 304) \
+            or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    with PHASE_TIMER.timed("compression"):
+        body, encoding = encode_body(response.get_data(), request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+
+    # the compressed body is another representation: its ETag can only be weak
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
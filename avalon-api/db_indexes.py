@@ -0,0 +1,136 @@
+"""This module contains the secondary indexes of the tables used in the RESTful web service of Avalon,
+so that the players and quests of a game, and the games by status or creation time, are read without
+reading the whole tables (the documents are tagged when they are created: by db_tag_new_game after
+rules_cache.game_put, by simulation.game_documents for the games created in batch)"""
+
+import time
+
+import rethinkdb as r
+
+from avalonBG.exception import AvalonBGError
+
+from db_pool import RDB
+
+
+# indexes created by PUT /restart_db (and at startup when they are missing)
+INDEXES = {
+    "events": ("game_id",),
+    "games": ("status", "created_at"),
+    "players": ("game_id",),
+    "quests": ("game_id",)
+}
+
+GAME_STATUSES = ("active", "finished")
+
+GAMES_PARAMS = {
+    "status": "Only fetch the games with this status ({})".format(" or ".join(GAME_STATUSES)),
+    "since": "Only fetch the games created after this time (seconds since the epoch)"
+}
+
+
+def db_create_indexes(tables):
+    """Create the secondary indexes of <tables> (just created) and wait until they are ready"""
+    for table_name in tables:
+        names = INDEXES.get(table_name, ())
+        for name in names:
+            RDB.table(table_name).index_create(name).run()
+        if names:
+            RDB.table(table_name).index_wait(*names).run()
+
+
+def db_create_missing_indexes(connection=None):
+    """Create the secondary indexes missing from the existing tables (a database created before them, or without
+    PUT /restart_db), wait until they are ready and return their names"""
+    created = []
+    tables = RDB.table_list().run(connection)
+    for table_name, names in INDEXES.items():
+        if table_name not in tables:
+            continue
+
+        existing = RDB.table(table_name).index_list().run(connection)
+        missing = [name for name in names if name not in existing]
+        for name in missing:
+            try:
+                RDB.table(table_name).index_create(name).run(connection)
+            except r.errors.ReqlOpFailedError:
+                # created meanwhile by another node
+                pass
+        if missing:
+            RDB.table(table_name).index_wait(*missing).run(connection)
+            created.extend("{}.{}".format(table_name, name) for name in missing)
+
+    return created
+
+
+def db_tag_new_game(game):
+    """Tag the documents of the <game> created by rules_cache.game_put (with its players and quests):
+    the players and quests with the id of the game, the game with its status and creation time.
+    Return the game with its tags."""
+    game_id = game["id"]
+    created_at = time.time()
+
+    players = [dict(player, game_id=game_id) for player in game["players"]]
+    quests = [
+        dict(quest, game_id=game_id, quest_number=quest_number) for quest_number, quest in enumerate(game["quests"])
+    ]
+
+    # one query per table: the rows are merged with their tags
+    RDB.table("players").insert(
+        [{"id": player["id"], "game_id": game_id} for player in players], conflict="update"
+    ).run()
+    RDB.table("quests").insert(
+        [{"id": quest["id"], "game_id": game_id, "quest_number": quest["quest_number"]} for quest in quests],
+        conflict="update"
+    ).run()
+    RDB.table("games").get(game_id).update({"status": "active", "created_at": created_at}).run()
+
+    return dict(game, players=players, quests=quests, status="active", created_at=created_at)
+
+
+def game_rows_selection(table_name, game_id):
+    """Return the query of the rows of <table_name> ('players' or 'quests') of the game <game_id>"""
+    return RDB.table(table_name).get_all(game_id, index="game_id")
+
+
+def parse_since(value):
+    """Check the query parameter 'since'"""
+    try:
+        return float(value)
+    except ValueError as error:
+        raise AvalonBGError("'since' should be a number!") from error
+
+
+def games_selection(status=None, since=None):
+    """Return the query of the games with <status> created after <since> (None if all the games are selected)"""
+    if status is not None and status not in GAME_STATUSES:
+        raise AvalonBGError("'status' should be {}!".format(" or ".join(map(repr, GAME_STATUSES))))
+
+    if since is not None:
+        since = parse_since(since)
+
+    if status is not None:
+        selection = RDB.table("games").get_all(status, index="status")
+        if since is not None:
+            selection = selection.filter(RDB.row["created_at"].gt(since))
+        return selection
+
+    if since is not None:
+        return RDB.table("games").between(since, RDB.maxval, left_bound="open", index="created_at")
+
+    return None
+
+
+def db_get_game_rows(table_name, game_id):
+    """Return the rows of <table_name> ('players' or 'quests') of the game <game_id> (the quests in their order)"""
+    rows = list(game_rows_selection(table_name, game_id).run())
+    if rows:
+        if table_name == "quests":
+            rows.sort(key=lambda row: row["quest_number"])
+        return rows
+
+    # the game doesn't exist, or it was created before its rows were tagged
+    game = RDB.table("games").get(game_id).run()
+    if game is None:
+        raise AvalonBGError("Game's id '{}' does not exist!".format(game_id))
+
+    return list(RDB.table(table_name).get_all(RDB.args(game[table_name])).run())
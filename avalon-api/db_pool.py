@@ -0,0 +1,190 @@
+"""This module contains the pool of database connections used in the RESTful web service of Avalon"""
+
+import threading
+import time
+from collections import deque
+
+import rethinkdb as r
+from rethinkdb.ast import Repl
+from flask import Blueprint, g, jsonify
+
+from api_utils import PHASE_TIMER, HTTPError
+from storage import RethinkDBEngine
+
+
+RDB = r.RethinkDB()
+
+
+class ConnectionPool:
+    """Bounded and thread-safe pool of connections to the storage engine"""
+
+    def __init__(self, engine=None, max_size=10, timeout=5.0, idle_check=30.0):
+        self.engine = RethinkDBEngine() if engine is None else engine
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_check = idle_check
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._generation = 0
+        self._stats = {}
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connects": 0,
+            "reconnects": 0
+        }
+
+    def configure(self, **kwargs):
+        """Update the settings of the pool and drop the connections opened with the previous ones"""
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise AttributeError("Unknown pool setting '{}'!".format(key))
+            setattr(self, key, value)
+
+        self.close()
+
+    def connect(self):
+        """Open a new connection, outside of the pool (used for long-lived queries)"""
+        return self.engine.connect()
+
+    def checkout(self):
+        """Take a connection from the pool, waiting at most <timeout> seconds for a free one"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        connection, last_used = None, None
+
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    # LIFO: the most recently used connection is the least likely to be stale
+                    connection, last_used = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise HTTPError("Database connection pool exhausted!", status_code=503)
+
+                waited = True
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - start
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time_total"] += wait_time
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+        try:
+            if connection is None:
+                connection = self._open()
+            elif not self._is_healthy(connection, last_used):
+                connection.close(noreply_wait=False)
+                connection = self._open(reconnect=True)
+        except r.errors.ReqlDriverError as error:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise HTTPError("Database is unavailable!", status_code=503) from error
+
+        connection.pool_generation = self._generation
+        return connection
+
+    def checkin(self, connection, discard=False):
+        """Give a connection back to the pool, closing it if it is broken"""
+        with self._cond:
+            if getattr(connection, "pool_generation", None) != self._generation:
+                # the pool has been closed since this connection was checked out
+                connection.close(noreply_wait=False)
+            elif discard or not connection.is_open():
+                self._size -= 1
+                connection.close(noreply_wait=False)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """Close the idle connections and forget the ones in use"""
+        with self._cond:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                connection.close(noreply_wait=False)
+            self._size = 0
+            self._generation += 1
+            self._reset_stats()
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return the size of the pool and the time spent waiting for a connection"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                {
+                    "max_size": self.max_size,
+                    "size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle)
+                }
+            )
+
+        return stats
+
+    def _open(self, reconnect=False):
+        connection = self.connect()
+        with self._cond:
+            self._stats["reconnects" if reconnect else "connects"] += 1
+        return connection
+
+    def _is_healthy(self, connection, last_used):
+        if not connection.is_open():
+            return False
+
+        if time.monotonic() - last_used < self.idle_check:
+            return True
+
+        try:
+            RDB.expr(1).run(connection)
+        except r.errors.ReqlError:
+            return False
+
+        return True
+
+
+DB_POOL = ConnectionPool()
+
+DB_POOL_BLUEPRINT = Blueprint("db_pool", __name__)
+
+
+def db_checkout():
+    """Check out a connection for the current request and make it the default one of the thread"""
+    with PHASE_TIMER.timed("db_pool_wait"):
+        g.db_connection = DB_POOL.checkout().repl()
+
+
+def db_checkin(error=None):
+    """Give the connection of the current request back to the pool"""
+    connection = g.pop("db_connection", None)
+    if connection is None:
+        return
+
+    Repl.clear()
+    DB_POOL.checkin(connection, discard=isinstance(error, r.errors.ReqlDriverError))
+
+
+@DB_POOL_BLUEPRINT.route("/db_pool/stats")
+def db_pool_stats():
+    """Fetch the statistics of the pool of database connections"""
+    return jsonify(DB_POOL.stats())
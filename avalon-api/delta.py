@@ -0,0 +1,65 @@
+"""This module contains the JSON-Patch (RFC 6902) diffs between two versions of a game"""
+
+import copy
+
+
+def escape_pointer(key):
+    """Escape a key of a JSON pointer"""
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def unescape_pointer(token):
+    """Unescape a key of a JSON pointer"""
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def json_diff(base, new, path=""):
+    """Return the operations ('add', 'remove' and 'replace') which turn <base> into <new>"""
+    if isinstance(base, dict) and isinstance(new, dict):
+        patch = []
+        for key in base:
+            if key not in new:
+                patch.append({"op": "remove", "path": "{}/{}".format(path, escape_pointer(key))})
+        for key, value in new.items():
+            key_path = "{}/{}".format(path, escape_pointer(key))
+            if key not in base:
+                patch.append({"op": "add", "path": key_path, "value": value})
+            else:
+                patch.extend(json_diff(base[key], value, key_path))
+        return patch
+
+    if isinstance(base, list) and isinstance(new, list) and len(base) == len(new):
+        patch = []
+        for index, (base_item, new_item) in enumerate(zip(base, new)):
+            patch.extend(json_diff(base_item, new_item, "{}/{}".format(path, index)))
+        return patch
+
+    if type(base) is type(new) and base == new:
+        return []
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def apply_patch(doc, patch):
+    """Return a copy of <doc> with the operations of <patch> applied"""
+    doc = copy.deepcopy(doc)
+
+    for operation in patch:
+        if not operation["path"]:
+            doc = copy.deepcopy(operation["value"])
+            continue
+
+        tokens = [unescape_pointer(token) for token in operation["path"].split("/")[1:]]
+        parent = doc
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+
+        key = int(tokens[-1]) if isinstance(parent, list) else tokens[-1]
+        if operation["op"] == "remove":
+            del parent[key]
+        elif operation["op"] == "add" and isinstance(parent, list):
+            parent.insert(key, copy.deepcopy(operation["value"]))
+        else:
+            parent[key] = copy.deepcopy(operation["value"])
+
+    return doc
@@ -0,0 +1,308 @@
+"""This module contains the read-through cache of the games used in the RESTful web service of Avalon"""
+
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from flask import jsonify, make_response, request
+
+from avalonBG.exception import AvalonBGError
+from avalonBG.quests import check_quest_number
+
+from db_pool import RDB
+from delta import json_diff
+from game_events import catch_up, db_append_event, db_game_events, db_game_state, event_id
+from projection import FIELDS_PARAMS, project, request_fields
+
+
+# versions of a game kept to compute the delta of a mutation
+HISTORY_SIZE = 8
+
+# query parameters of the mutations
+DELTA_PARAMS = dict(
+    FIELDS_PARAMS,
+    base_version="Return the diff (JSON Patch) between this version of the game and the updated one"
+)
+
+
+def game_exists(game_id, value):
+    """Return <value>, read from the game <game_id>, which is None if the game does not exist"""
+    if value is None:
+        raise AvalonBGError("Game's id {} does not exist!".format(game_id))
+
+    return value
+
+
+def game_version_query(game_id):
+    """Return the query of the version of the game <game_id> (0 if it has never been updated)"""
+    return RDB.table("games").get(game_id).do(
+        lambda game: RDB.branch(game.eq(None), None, game["version"].default(0))
+    )
+
+
+def game_query(game_id):
+    """Return the query of the game <game_id> with its players and quests, in one round trip"""
+    return RDB.table("games").get(game_id).do(
+        lambda game: RDB.branch(
+            game.eq(None),
+            None,
+            game.merge({
+                "version": game["version"].default(0),
+                "players": game["players"].map(lambda key: RDB.table("players").get(key)),
+                "quests": game["quests"].map(lambda key: RDB.table("quests").get(key))
+            })
+        )
+    )
+
+
+def db_get_game_version(game_id):
+    """Return the version of the game <game_id>"""
+    return game_exists(game_id, game_version_query(game_id).run())
+
+
+def db_bump_game_version(game_id):
+    """Increment the version of the game <game_id>, update its status (index 'status') and return both with the
+    game read after the bump, in one round trip"""
+    result = RDB.table("games").get(game_id).update(
+        {
+            "version": RDB.row["version"].default(0).add(1),
+            "status": RDB.branch(RDB.row.has_fields("result"), "finished", "active")
+        },
+        return_changes="always"
+    ).do(lambda result: {"changes": result["changes"], "game": game_query(game_id)}).run()
+
+    changes = result["changes"]
+    if not changes or changes[0]["new_val"] is None:
+        raise AvalonBGError("Game's id {} does not exist!".format(game_id))
+
+    return changes[0]["new_val"]["version"], changes[0]["new_val"]["status"], result["game"]
+
+
+def game_etag(game_id, version, *parts):
+    """Return the ETag of the game <game_id> (or of one of its <parts>) at <version>"""
+    return ":".join(str(part) for part in (game_id, version) + parts)
+
+
+def not_modified(etag):
+    """Return an empty 304 response"""
+    response = make_response("", 304)
+    response.set_etag(etag)
+
+    return response
+
+
+def versioned_response(data, etag):
+    """Return <data> with its ETag, or 304 if the client already has it"""
+    response = jsonify(data)
+    response.set_etag(etag)
+
+    return response.make_conditional(request)
+
+
+class GameCache:
+    """Bounded cache of the games (players and quests resolved), validated by their version"""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._games = OrderedDict()
+        self._history = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, game_id, version):
+        """Return the game <game_id> at <version>, only reading it from the database when it has changed"""
+        game = self.lookup(game_id, version)
+        if game is None:
+            game = game_exists(game_id, game_query(game_id).run())
+            self.put(game)
+
+        return game
+
+    def lookup(self, game_id, version):
+        """Return the game <game_id> if it is cached at <version>, else None"""
+        with self._lock:
+            game = self._games.get(game_id)
+            if game is None or game["version"] != version:
+                return None
+
+            self._games.move_to_end(game_id)
+            return game
+
+    def put(self, game):
+        """Store a game which has just been read or written"""
+        with self._lock:
+            cached = self._games.get(game["id"])
+            if cached is not None and cached["version"] > game["version"]:
+                return
+
+            self._games[game["id"]] = game
+            self._games.move_to_end(game["id"])
+            while len(self._games) > self.max_size:
+                self._games.popitem(last=False)
+
+            history = self._history.setdefault(game["id"], deque(maxlen=HISTORY_SIZE))
+            if not history or history[-1]["version"] < game["version"]:
+                history.append(game)
+            self._history.move_to_end(game["id"])
+            while len(self._history) > self.max_size:
+                self._history.popitem(last=False)
+
+    def get_version(self, game_id, version):
+        """Return the game <game_id> at <version> if it is still known, else None"""
+        with self._lock:
+            for game in self._history.get(game_id, ()):
+                if game["version"] == version:
+                    return game
+
+        return None
+
+    def updated(self, game_id):
+        """Bump the version of the game <game_id> after a mutation and return the version, the status and the game
+        read after the bump (None if another mutation bumped it meanwhile: this version of the game is not known)"""
+        version, status, game = db_bump_game_version(game_id)
+        self.put(game)
+
+        return version, status, game if game["version"] == version else None
+
+    def invalidate(self, game_id):
+        """Forget the game <game_id>"""
+        with self._lock:
+            self._games.pop(game_id, None)
+
+    def retain(self, keep):
+        """Forget the games whose id doesn't satisfy <keep> (games moved to another node)"""
+        with self._lock:
+            for games in (self._games, self._history):
+                for game_id in [game_id for game_id in games if not keep(game_id)]:
+                    del games[game_id]
+
+    def clear(self):
+        """Forget all the games"""
+        with self._lock:
+            self._games.clear()
+            self._history.clear()
+
+
+GAME_CACHE = GameCache()
+
+
+def game_delta(game_id, base_version, version):
+    """Return the diff between the versions <base_version> and <version> of the game <game_id>,
+    or the whole game if <base_version> is not known anymore"""
+    game = GAME_CACHE.get(game_id=game_id, version=version)
+    base_game = GAME_CACHE.get_version(game_id=game_id, version=base_version)
+
+    if base_game is None:
+        return {"version": game["version"], "game": game}
+
+    return {
+        "version": game["version"],
+        "base_version": base_version,
+        "patch": json_diff(base_game, game)
+    }
+
+
+def log_mutation(game_id, version, game):
+    """Append to the event log the mutation (the current request) which made the version <version> of the game,
+    <game> (None if it is not known: the log misses this version and the clients catch up with a snapshot).
+    The event is a patch from the previous version if it is cached, else a snapshot."""
+    if game is None:
+        return
+
+    db_append_event(
+        game_id,
+        version,
+        game=game,
+        previous=GAME_CACHE.get_version(game_id=game_id, version=version - 1),
+        kind="{} {}".format(request.method, request.url_rule.rule)
+    )
+
+
+@contextmanager
+def game_mutation(game_id):
+    """Run a mutation of the game <game_id>. If it fails after a write, the game is versioned all the same."""
+    try:
+        yield
+    except Exception:
+        db_check_game_version(game_id)
+        raise
+
+
+def db_check_game_version(game_id):
+    """Bump the version of the game <game_id> if it is not the known game of its version anymore
+    (a failed mutation wrote it)"""
+    game = game_query(game_id).run()
+    if game is None:
+        return
+
+    known = GAME_CACHE.get_version(game_id=game_id, version=game["version"])
+    if known is None:
+        known = db_game_state(game_id, game["version"])
+    if known != game:
+        version, _, game = GAME_CACHE.updated(game_id)
+        log_mutation(game_id, version, game)
+
+
+def game_events_since(game_id, since):
+    """Return the version of the game <game_id> and the events which bring a client from the version <since>
+    (None: no version) to it. If the log cannot, the only event is a snapshot of the game."""
+    version = db_get_game_version(game_id=game_id)
+    since = -1 if since is None else since
+
+    logged = db_game_events(game_id, since)
+    events = catch_up(logged, since)
+    if events is None or (logged[-1]["seq"] if logged else since) != version:
+        events = [{
+            "id": event_id(game_id, version),
+            "game_id": game_id,
+            "seq": version,
+            "type": "snapshot",
+            "snapshot": GAME_CACHE.get(game_id=game_id, version=version)
+        }]
+
+    return version, events
+
+
+def mutation_response(game_id, data, game=None):
+    """Bump the version of the game <game_id>, log the mutation and return <data> with the new version.
+    <game> is the updated game when the mutation returns it: it gets the new version and status (the game cached
+    and logged is read after the bump). If the client sends 'base_version', return the diff of the game since
+    this version instead of <data>, else only the 'fields' of <data> it asks for."""
+    version, status, current = GAME_CACHE.updated(game_id)
+    log_mutation(game_id, version, current)
+    if game is not None:
+        game.update(version=version, status=status)
+
+    # the mutation is already done, an invalid 'base_version' is ignored
+    base_version = request.args.get("base_version", type=int)
+    if base_version is not None:
+        data = game_delta(game_id=game_id, base_version=base_version, version=version)
+    else:
+        try:
+            data = project(data, request_fields())
+        except AvalonBGError:
+            pass
+
+    response = jsonify(data)
+    response.headers["X-Game-Version"] = version
+
+    return response
+
+
+def cached_quest_get(game_id, quest_number, version):
+    """Same as avalonBG.quests.quest_get, reading the game from the cache"""
+    check_quest_number(quest_number=quest_number)
+
+    return game_quest(GAME_CACHE.get(game_id=game_id, version=version), quest_number)
+
+
+def game_quest(game, quest_number):
+    """Return the quest <quest_number> of <game> if its vote is finished"""
+    quest = game["quests"][quest_number]
+
+    if "status" not in quest:
+        raise AvalonBGError("The vote number '{}' has not started!".format(quest_number))
+
+    if quest["status"] is None:
+        raise AvalonBGError("The vote number '{}' is not finished!".format(quest_number))
+
+    return quest
@@ -0,0 +1,121 @@
+"""This module contains the event log of the games of the RESTful web service of Avalon.
+Each mutation of a game appends an event numbered by the new version of the game: the JSON-Patch from the
+previous version (delta.json_diff), and a snapshot of the whole game every SNAPSHOT_INTERVAL versions (only the
+snapshot when the previous version is not cached: the mutations don't fold the log). The state of a game is rebuilt by folding its events from the latest snapshot,
+and the clients catch up from the version they have with GET /games/<game_id>/events?since=<version>."""
+
+import logging
+import time
+
+import rethinkdb as r
+
+from db_indexes import db_create_indexes
+from db_pool import RDB
+from delta import apply_patch, json_diff
+
+
+LOG = logging.getLogger(__name__)
+
+EVENTS_TABLE = "events"
+
+# versions between two snapshots (folding a game reads at most this number of patches)
+SNAPSHOT_INTERVAL = 10
+
+EVENTS_PARAMS = {
+    "since": "Version of the game the client has (without it, the events start with a snapshot)"
+}
+
+
+def event_id(game_id, seq):
+    """Return the primary key of the event <seq> of the game <game_id> (one event per version)"""
+    return "{}:{}".format(game_id, seq)
+
+
+def db_restart_event_log(tables):
+    """Recreate the table of the events when the games are (PUT /restart_db)"""
+    if "games" not in tables:
+        return
+
+    if EVENTS_TABLE in RDB.table_list().run():
+        RDB.table_drop(EVENTS_TABLE).run()
+    RDB.table_create(EVENTS_TABLE).run()
+    db_create_indexes(tables=[EVENTS_TABLE])
+
+
+def db_game_events(game_id, since=-1):
+    """Return the events of the game <game_id> after the version <since>, in order"""
+    events = RDB.table(EVENTS_TABLE).get_all(game_id, index="game_id").filter(RDB.row["seq"].gt(since)).run()
+
+    return sorted(events, key=lambda event: event["seq"])
+
+
+def fold_events(events):
+    """Return the game rebuilt from <events> (in order) and its version, or (None, None) if a version is missing"""
+    game, seq = None, None
+    for event in events:
+        if "snapshot" in event:
+            game = event["snapshot"]
+        elif game is not None and event["seq"] == seq + 1:
+            game = apply_patch(game, event["patch"])
+        else:
+            return None, None
+        seq = event["seq"]
+
+    return game, seq
+
+
+def db_game_state(game_id, version):
+    """Return the game <game_id> at <version> rebuilt from its event log, or None"""
+    events = [event for event in db_game_events(game_id) if event["seq"] <= version]
+    snapshots = [index for index, event in enumerate(events) if "snapshot" in event]
+    if not snapshots:
+        return None
+
+    game, seq = fold_events(events[snapshots[-1]:])
+    return game if seq == version else None
+
+
+def db_append_event(game_id, seq, game, previous, kind):
+    """Append the event <seq> of the game <game_id>: the mutation <kind> changed the game <previous>
+    (at the version seq - 1, None if unknown: the event is a snapshot, the log is not folded to find it)
+    into <game>"""
+    event = {"id": event_id(game_id, seq), "game_id": game_id, "seq": seq, "type": kind, "at": time.time()}
+    if previous is not None:
+        event["patch"] = json_diff(previous, game)
+    if previous is None or seq % SNAPSHOT_INTERVAL == 0:
+        event["snapshot"] = game
+
+    # the log is a history of the games (not their state): its failures don't fail the mutations
+    try:
+        result = RDB.table(EVENTS_TABLE).insert(event).run()
+    except r.errors.ReqlOpFailedError as error:
+        LOG.warning("Event %s of the game %s not logged: %s", seq, game_id, error)
+        return
+    if result["errors"]:
+        LOG.warning("Event %s of the game %s not logged: %s", seq, game_id, result["first_error"])
+
+
+def catch_up(events, since):
+    """Return the events (after the version <since>, in order) which rebuild the game for a client at <since>
+    (-1: none), each one with either its patch or its snapshot, or None if a version is missing"""
+    needed, seq = [], since
+    for event in events:
+        patchable = seq >= 0 and event["seq"] == seq + 1 and "patch" in event
+        if "snapshot" in event and (since < 0 or not patchable):
+            # the events before a snapshot are not needed to rebuild the game
+            needed = [{key: value for key, value in event.items() if key != "patch"}]
+        elif patchable:
+            needed.append({key: value for key, value in event.items() if key != "snapshot"})
+        else:
+            return None
+        seq = event["seq"]
+
+    return needed
+
+
+def db_delete_game_events(game_ids):
+    """Delete the events of the games <game_ids>"""
+    try:
+        RDB.table(EVENTS_TABLE).get_all(RDB.args(game_ids), index="game_id").delete().run()
+    except r.errors.ReqlOpFailedError as error:
+        LOG.warning("Events of %s games not deleted: %s", len(game_ids), error)
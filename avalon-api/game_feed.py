@@ -0,0 +1,189 @@
+"""This module contains the push of game updates (RethinkDB changefeeds fanned out to server-sent events).
+A subscriber served by the threads of the Flask application holds one of them while it is connected: their number
+is capped per worker (the coroutines of the ASGI server are not)."""
+
+import logging
+import queue
+import threading
+import time
+
+import rethinkdb as r
+from flask import json
+
+from avalonBG.exception import AvalonBGError
+
+from db_pool import DB_POOL, RDB
+from game_cache import GAME_CACHE
+
+
+# seconds between two checks of the stop flag of a changefeed
+FEED_POLL_INTERVAL = 1.0
+
+# seconds before reopening a changefeed which failed
+FEED_RETRY_DELAY = 1.0
+
+# events kept for a subscriber which doesn't read them (each event holds the whole game)
+SUBSCRIBER_QUEUE_SIZE = 8
+
+LOG = logging.getLogger(__name__)
+
+
+class TooManySubscribersError(Exception):
+    """Class TooManySubscribersError related to a subscription refused because the subscribers already hold
+    too many threads of the worker"""
+
+
+class GameFeed:
+    """One changefeed on a game, shared by all its subscribers"""
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.subscribers = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="feed-{}".format(game_id), daemon=True)
+
+    def start(self):
+        """Open the changefeed in a background thread"""
+        self._thread.start()
+
+    def stop(self):
+        """Close the changefeed (within FEED_POLL_INTERVAL seconds)"""
+        self._stop.set()
+
+    def publish(self, event):
+        """Give <event> to every subscriber, dropping their oldest event if they are late"""
+        for subscriber in list(self.subscribers):
+            while True:
+                try:
+                    subscriber.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                # the changefeed holds its own connection, not one of the pool
+                connection = DB_POOL.connect().repl()
+                cursor = RDB.table("games").get(self.game_id).changes().run(connection)
+                self._follow(cursor)
+            except (r.errors.ReqlError, AvalonBGError) as error:
+                if not self._stop.is_set():
+                    LOG.warning("Changefeed of the game %s failed: %s", self.game_id, error)
+                    self.publish(("error", {"message": str(error)}))
+                    time.sleep(FEED_RETRY_DELAY)
+            finally:
+                if connection is not None:
+                    connection.close(noreply_wait=False)
+
+    def _follow(self, cursor):
+        while not self._stop.is_set():
+            try:
+                change = cursor.next(wait=FEED_POLL_INTERVAL)
+            except r.errors.ReqlTimeoutError:
+                continue
+
+            game = change["new_val"]
+            if game is None:
+                self.publish(("deleted", {"id": self.game_id}))
+                self.stop()
+                return
+
+            self.publish(("game", GAME_CACHE.get(game_id=self.game_id, version=game.get("version", 0))))
+
+
+class GameFeedHub:
+    """Changefeeds of the games which have subscribers"""
+
+    def __init__(self, max_thread_subscribers=None):
+        self.max_thread_subscribers = max_thread_subscribers
+        self._feeds = {}
+        self._thread_subscribers = set()
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        """Change the settings given in <kwargs>"""
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def subscribe(self, game_id, subscriber=None):
+        """Return a queue receiving the updates of the game <game_id>, read by a thread (at most
+        <max_thread_subscribers> at a time, None: no limit, else TooManySubscribersError).
+        <subscriber> replaces the queue: it needs put_nowait (raising queue.Full) and get_nowait."""
+        with self._lock:
+            if subscriber is None:
+                if self.max_thread_subscribers is not None \
+                        and len(self._thread_subscribers) >= self.max_thread_subscribers:
+                    raise TooManySubscribersError(
+                        "Too many subscribers on this worker ({}), retry later!".format(self.max_thread_subscribers)
+                    )
+                subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+                self._thread_subscribers.add(subscriber)
+
+            feed = self._feeds.get(game_id)
+            if feed is None:
+                feed = self._feeds[game_id] = GameFeed(game_id)
+                feed.start()
+            feed.subscribers.add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, game_id, subscriber):
+        """Stop sending the updates of the game <game_id> to <subscriber> (nothing if it is already stopped)"""
+        with self._lock:
+            self._thread_subscribers.discard(subscriber)
+            feed = self._feeds.get(game_id)
+            if feed is None:
+                return
+
+            feed.subscribers.discard(subscriber)
+            if not feed.subscribers:
+                feed.stop()
+                del self._feeds[game_id]
+
+    def stats(self):
+        """Return the number of subscribers of each game"""
+        with self._lock:
+            return {game_id: len(feed.subscribers) for game_id, feed in self._feeds.items()}
+
+
+GAME_FEED_HUB = GameFeedHub()
+
+
+def format_event(event, data):
+    """Return a server-sent event"""
+    lines = ["event: {}".format(event)]
+    if isinstance(data, dict) and "version" in data:
+        lines.append("id: {}".format(data["version"]))
+    lines.append("data: {}".format(json.dumps(data)))
+
+    return "\n".join(lines) + "\n\n"
+
+
+def game_events(game_id, game, subscriber, heartbeat=15.0):
+    """Yield the current state of the game <game_id>, then its updates, as server-sent events.
+    The caller unsubscribes <subscriber> when the response ends: the generator may never start."""
+    yield format_event("game", game)
+    version = game["version"]
+
+    while True:
+        try:
+            event, data = subscriber.get(timeout=heartbeat)
+        except queue.Empty:
+            yield ": keep-alive\n\n"
+            continue
+
+        if event == "game":
+            # an update may have been published before the initial state was read
+            if data["version"] <= version:
+                continue
+            version = data["version"]
+
+        yield format_event(event, data)
+
+        if event == "deleted":
+            return
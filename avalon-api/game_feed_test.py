@@ -0,0 +1,80 @@
+"""This module contains the tests of the subscriptions to the games served by the threads of the Flask application:
+each one holds a slot of the worker until its response is closed, even before its first event.
+
+    python -m unittest game_feed_test
+"""
+
+import unittest
+
+from api import APP
+from db_pool import DB_POOL
+from game_feed import GAME_FEED_HUB
+from storage import create_engine
+
+
+MAX_SUBSCRIBERS = 2
+
+
+class SubscriptionsTest(unittest.TestCase):
+    """Subscriptions closed before being read (memory engine)"""
+
+    @classmethod
+    def setUpClass(cls):
+        DB_POOL.configure(engine=create_engine("memory"), max_size=MAX_SUBSCRIBERS + 2)
+        cls.client = APP.test_client()
+        cls.client.put("/restart_db", json=["games", "players", "quests"])
+        cls.game_id = cls.client.put("/games", json={
+            "players": [{"name": "player{}".format(index), "avatar_index": index} for index in range(5)],
+            "roles": []
+        }).get_json()["id"]
+
+        cls.max_thread_subscribers = GAME_FEED_HUB.max_thread_subscribers
+        GAME_FEED_HUB.configure(max_thread_subscribers=MAX_SUBSCRIBERS)
+
+    @classmethod
+    def tearDownClass(cls):
+        GAME_FEED_HUB.configure(max_thread_subscribers=cls.max_thread_subscribers)
+        DB_POOL.close()
+
+    def assert_released(self):
+        """The subscriptions hold no slot of the worker and no changefeed"""
+        self.assertEqual(GAME_FEED_HUB.stats(), {})
+        self.assertEqual(GAME_FEED_HUB._thread_subscribers, set())  # pylint: disable=W0212
+
+    def test_closed_before_read(self):
+        for _ in range(MAX_SUBSCRIBERS + 1):
+            response = self.client.get("/games/{}/subscribe".format(self.game_id), buffered=False)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(GAME_FEED_HUB.stats(), {self.game_id: 1})
+            response.close()
+            self.assert_released()
+
+    def test_head(self):
+        for _ in range(MAX_SUBSCRIBERS + 1):
+            response = self.client.head("/games/{}/subscribe".format(self.game_id), buffered=True)
+            self.assertEqual(response.status_code, 200)
+            self.assert_released()
+
+    def test_read_then_closed(self):
+        response = self.client.get("/games/{}/subscribe".format(self.game_id), buffered=False)
+        self.assertTrue(next(response.response).startswith(b"event: game\n"))
+        response.close()
+        self.assert_released()
+
+    def test_too_many_subscribers(self):
+        responses = [
+            self.client.get("/games/{}/subscribe".format(self.game_id), buffered=False)
+            for _ in range(MAX_SUBSCRIBERS)
+        ]
+        refused = self.client.get("/games/{}/subscribe".format(self.game_id))
+        self.assertEqual(refused.status_code, 503)
+        self.assertIn("Retry-After", refused.headers)
+
+        # the streams of this thread keep their request contexts stacked: the last one is closed first
+        for response in reversed(responses):
+            response.close()
+        self.assert_released()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+"""This module contains the readiness probe of the RESTful web service of Avalon"""
+
+from flask import Blueprint, jsonify
+
+from mp3_cache import MP3_CACHE
+
+
+HEALTH_BLUEPRINT = Blueprint("health", __name__)
+
+
+@HEALTH_BLUEPRINT.route("/ready")
+def ready():
+    """Fetch the status of the assets, 503 until all of them are available"""
+    mp3_status = MP3_CACHE.status()
+
+    response = jsonify({"ready": mp3_status["ready"], "mp3": mp3_status})
+    response.status_code = 200 if mp3_status["ready"] else 503
+
+    return response
@@ -0,0 +1,34 @@
+"""This module contains the JSON encoder of the RESTful web service of Avalon: orjson when it is installed,
+else (or for what orjson cannot encode) the encoder of Flask"""
+
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# dates and dataclasses are left to JSONEncoder.default, which formats them as Flask does
+ORJSON_OPTIONS = 0 if orjson is None else \
+    orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+class FastJSONEncoder(JSONEncoder):
+    """JSON encoder of Flask delegating to orjson (non-ASCII characters are sent as UTF-8, not escaped)"""
+
+    def encode(self, o):
+        if orjson is None or self.indent not in (None, 2):
+            return super().encode(o)
+
+        options = ORJSON_OPTIONS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            options |= orjson.OPT_INDENT_2
+
+        try:
+            return orjson.dumps(o, default=self.default, option=options).decode()
+        except orjson.JSONEncodeError:
+            # integers of more than 64 bits, circular references...: the error (if any) is the one of Flask
+            return super().encode(o)
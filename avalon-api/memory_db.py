@@ -0,0 +1,840 @@
+"""This module contains an in-process stand-in for RethinkDB: the subset of ReQL used by avalonBG and the API,
+evaluated against documents kept in memory"""
+
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+
+import rethinkdb as r
+from rethinkdb import ql2_pb2
+
+from api_utils import PHASE_TIMER
+
+
+TERM_NAMES = {
+    value: name for name, value in vars(ql2_pb2.Term.TermType).items() if name.isupper()
+}
+
+DEFAULT_DB = "test"
+
+
+def term_name(term):
+    """Return the name of the type of <term> (literals have none)"""
+    term_type = getattr(term, "term_type", None)
+    return "DATUM" if term_type is None else TERM_NAMES[term_type]
+
+
+class MinVal:
+    """r.minval, lower than any value"""
+
+
+class MaxVal:
+    """r.maxval, greater than any value"""
+
+
+class TableRef:
+    """Table of a query (not fetched yet)"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class SingleSelection:
+    """Document selected with get (None if it doesn't exist)"""
+
+    def __init__(self, table, key, doc):
+        self.table = table
+        self.key = key
+        self.doc = doc
+
+
+class Selection:
+    """Documents selected in a table (get_all, between, filter...)"""
+
+    def __init__(self, table, docs):
+        self.table = table
+        self.docs = docs
+
+
+class Function:
+    """ReQL function with its scope"""
+
+    def __init__(self, var_ids, body, scope):
+        self.var_ids = var_ids
+        self.body = body
+        self.scope = scope
+
+
+class Changefeed:
+    """Changes of a table (or a document) since the query was run"""
+
+    def __init__(self, store, table, key=None):
+        self.store = store
+        self.table = table
+        self.key = key
+        self.changes = queue.Queue()
+
+    def next(self, wait=True):
+        """Return the next change, waiting at most <wait> seconds (forever if True)"""
+        try:
+            if wait is True:
+                return self.changes.get()
+            return self.changes.get(timeout=None if wait is None else max(wait, 0))
+        except queue.Empty as error:
+            raise r.errors.ReqlTimeoutError() from error
+
+    def __iter__(self):
+        while True:
+            yield self.next()
+
+    def close(self):
+        """Stop receiving the changes"""
+        self.store.unwatch(self)
+
+
+def copy_value(value):
+    """Copy a JSON value (faster than copy.deepcopy)"""
+    if isinstance(value, dict):
+        return {key: copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    return value
+
+
+def type_rank(value):
+    """Order of the types when values of different types are compared (as in ReQL)"""
+    if value is MinVal or isinstance(value, MinVal):
+        return 0
+    if isinstance(value, list):
+        return 1
+    if isinstance(value, bool):
+        return 2
+    if value is None:
+        return 3
+    if isinstance(value, (int, float)):
+        return 4
+    if isinstance(value, dict):
+        return 5
+    if isinstance(value, str):
+        return 6
+    return 7
+
+
+def sort_key(value):
+    """Key used to sort or compare values of any type"""
+    rank = type_rank(value)
+    if rank == 1:
+        return (rank, [sort_key(item) for item in value])
+    if rank == 5:
+        return (rank, sorted((key, sort_key(item)) for key, item in value.items()))
+    if rank in (0, 3, 7):
+        return (rank, 0)
+    return (rank, value)
+
+
+def index_key(value):
+    """Hashable key of a value in a secondary index (values of different types are different keys)"""
+    rank = type_rank(value)
+    if rank in (1, 5):
+        return (rank, repr(sort_key(value)))
+    return sort_key(value)
+
+
+def truthy(value):
+    """Only false and null are false in ReQL"""
+    return value is not False and value is not None
+
+
+def merge(base, update):
+    """Merge <update> into <base> recursively, as ReQL update does"""
+    if not isinstance(base, dict) or not isinstance(update, dict):
+        return copy_value(update)
+
+    merged = dict(base)
+    for key, value in update.items():
+        merged[key] = merge(base.get(key), value)
+
+    return merged
+
+
+def get_field(value, key):
+    """Return value[key] raising the errors of ReQL"""
+    if value is None:
+        raise r.errors.ReqlNonExistenceError("Cannot perform bracket on a `null` value.")
+    if isinstance(value, dict):
+        if key not in value:
+            raise r.errors.ReqlNonExistenceError("No attribute `{}` in object.".format(key))
+        return value[key]
+    if isinstance(value, list):
+        if isinstance(key, int):
+            try:
+                return value[key]
+            except IndexError as error:
+                raise r.errors.ReqlNonExistenceError("Index out of bounds.") from error
+        return [item[key] for item in value if isinstance(item, dict) and key in item]
+    raise r.errors.ReqlQueryLogicError("Cannot perform bracket on a non-object non-sequence.")
+
+
+def pluck(value, keys):
+    """Keep only <keys> of an object (or of each object of a sequence)"""
+    if isinstance(value, list):
+        return [pluck(item, keys) for item in value]
+    return {key: value[key] for key in keys if key in value}
+
+
+def without(value, keys):
+    """Remove <keys> of an object (or of each object of a sequence)"""
+    if isinstance(value, list):
+        return [without(item, keys) for item in value]
+    return {key: item for key, item in value.items() if key not in keys}
+
+
+class Evaluator:
+    """Evaluate a ReQL term against a store"""
+
+    # pylint: disable=C0116,R0201,R0904
+
+    def __init__(self, store):
+        self.store = store
+
+    def run(self, term):
+        """Return the result of <term>, as the driver would"""
+        return self.value(self.eval(term, {}))
+
+    def value(self, result):
+        """Fetch the documents of a selection"""
+        if isinstance(result, SingleSelection):
+            return copy_value(result.doc)
+        if isinstance(result, Selection):
+            return [copy_value(doc) for doc in result.docs]
+        if isinstance(result, TableRef):
+            return self.store.scan(result.name)
+        return result
+
+    def eval(self, term, scope):
+        name = term_name(term)
+        handler = getattr(self, "term_" + name.lower(), None)
+        if handler is None:
+            raise r.errors.ReqlDriverCompileError("Term {} is not supported by the in-memory database.".format(name))
+        return handler(term, scope)
+
+    def args(self, term, scope):
+        values = []
+        for arg in term._args:  # pylint: disable=W0212
+            if term_name(arg) == "ARGS":
+                values.extend(self.value(self.eval(arg._args[0], scope)))  # pylint: disable=W0212
+            else:
+                values.append(self.eval(arg, scope))
+        return values
+
+    def optargs(self, term, scope):
+        return {key: self.value(self.eval(value, scope)) for key, value in term.optargs.items()}
+
+    def values(self, term, scope):
+        return [self.value(arg) for arg in self.args(term, scope)]
+
+    def call(self, function, *arguments):
+        if not isinstance(function, Function):
+            return function
+
+        scope = dict(function.scope)
+        for var_id, argument in zip(function.var_ids, arguments):
+            scope[var_id] = argument
+        if arguments:
+            scope["implicit"] = arguments[0]
+
+        return self.value(self.eval(function.body, scope))
+
+    # values
+
+    def term_datum(self, term, scope):
+        return term.data
+
+    def term_make_array(self, term, scope):
+        return self.values(term, scope)
+
+    def term_make_obj(self, term, scope):
+        return self.optargs(term, scope)
+
+    def term_func(self, term, scope):
+        var_ids = self.value(self.eval(term._args[0], scope))  # pylint: disable=W0212
+        return Function(var_ids, term._args[1], scope)  # pylint: disable=W0212
+
+    def term_var(self, term, scope):
+        return scope[term._args[0].data]  # pylint: disable=W0212
+
+    def term_implicit_var(self, term, scope):
+        return scope["implicit"]
+
+    def term_funcall(self, term, scope):
+        function, *arguments = self.values(term, scope)
+        return self.call(function, *arguments)
+
+    def term_minval(self, term, scope):
+        return MinVal
+
+    def term_maxval(self, term, scope):
+        return MaxVal
+
+    def term_error(self, term, scope):
+        raise r.errors.ReqlUserError(*self.values(term, scope))
+
+    def term_default(self, term, scope):
+        try:
+            value = self.value(self.eval(term._args[0], scope))  # pylint: disable=W0212
+        except r.errors.ReqlNonExistenceError:
+            value = None
+        if value is None:
+            return self.call(self.value(self.eval(term._args[1], scope)))  # pylint: disable=W0212
+        return value
+
+    def term_branch(self, term, scope):
+        args = term._args  # pylint: disable=W0212
+        for index in range(0, len(args) - 1, 2):
+            if truthy(self.value(self.eval(args[index], scope))):
+                return self.value(self.eval(args[index + 1], scope))
+        return self.value(self.eval(args[-1], scope))
+
+    # operators
+
+    def compare(self, term, scope, operator):
+        keys = [sort_key(value) for value in self.values(term, scope)]
+        return all(operator(left, right) for left, right in zip(keys, keys[1:]))
+
+    def term_eq(self, term, scope):
+        return self.compare(term, scope, lambda left, right: left == right)
+
+    def term_ne(self, term, scope):
+        return not self.term_eq(term, scope)
+
+    def term_lt(self, term, scope):
+        return self.compare(term, scope, lambda left, right: left < right)
+
+    def term_le(self, term, scope):
+        return self.compare(term, scope, lambda left, right: left <= right)
+
+    def term_gt(self, term, scope):
+        return self.compare(term, scope, lambda left, right: left > right)
+
+    def term_ge(self, term, scope):
+        return self.compare(term, scope, lambda left, right: left >= right)
+
+    def term_not(self, term, scope):
+        return not truthy(self.values(term, scope)[0])
+
+    def term_and(self, term, scope):
+        value = True
+        for arg in term._args:  # pylint: disable=W0212
+            value = self.value(self.eval(arg, scope))
+            if not truthy(value):
+                return value
+        return value
+
+    def term_or(self, term, scope):
+        value = False
+        for arg in term._args:  # pylint: disable=W0212
+            value = self.value(self.eval(arg, scope))
+            if truthy(value):
+                return value
+        return value
+
+    def term_add(self, term, scope):
+        first, *others = self.values(term, scope)
+        for other in others:
+            first = first + other
+        return first
+
+    def term_sub(self, term, scope):
+        first, *others = self.values(term, scope)
+        for other in others:
+            first = first - other
+        return first
+
+    # documents and sequences
+
+    def term_bracket(self, term, scope):
+        value, key = self.values(term, scope)
+        return get_field(value, key)
+
+    term_get_field = term_bracket
+
+    def term_nth(self, term, scope):
+        value, index = self.values(term, scope)
+        return get_field(list(value), index)
+
+    def term_pluck(self, term, scope):
+        value, *keys = self.values(term, scope)
+        if value is None:
+            raise r.errors.ReqlNonExistenceError("Cannot perform pluck on a `null` value.")
+        return pluck(value, keys)
+
+    def term_without(self, term, scope):
+        value, *keys = self.values(term, scope)
+        return without(value, keys)
+
+    def term_merge(self, term, scope):
+        value, *others = self.values(term, scope)
+        for other in others:
+            value = merge(value, self.call(other, value))
+        return value
+
+    def term_has_fields(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        keys = self.values(term, scope)[1:]
+        value = self.value(selection)
+        if isinstance(value, dict):
+            return all(key in value for key in keys)
+        docs = [doc for doc in value if all(key in doc for key in keys)]
+        if isinstance(selection, (Selection, TableRef)):
+            return Selection(self.table_name(selection), docs)
+        return docs
+
+    def term_keys(self, term, scope):
+        return list(self.values(term, scope)[0])
+
+    def term_contains(self, term, scope):
+        sequence, *values = self.values(term, scope)
+        return all(value in sequence for value in values)
+
+    def term_append(self, term, scope):
+        sequence, value = self.values(term, scope)
+        return list(sequence) + [value]
+
+    def term_count(self, term, scope):
+        return len(self.value(self.eval(term._args[0], scope)))  # pylint: disable=W0212
+
+    def term_limit(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        limit = self.value(self.eval(term._args[1], scope))  # pylint: disable=W0212
+        return self.slice_selection(selection, 0, limit)
+
+    def term_skip(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        skip = self.value(self.eval(term._args[1], scope))  # pylint: disable=W0212
+        return self.slice_selection(selection, skip, None)
+
+    def slice_selection(self, selection, start, stop):
+        if isinstance(selection, (Selection, TableRef)):
+            return Selection(self.table_name(selection), self.docs(selection)[start:stop])
+        return self.value(selection)[start:stop]
+
+    def term_map(self, term, scope):
+        sequence, function = self.values(term, scope)
+        return [self.call(function, item) for item in sequence]
+
+    def term_filter(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        predicate = self.value(self.eval(term._args[1], scope))  # pylint: disable=W0212
+
+        def keep(doc):
+            if isinstance(predicate, dict):
+                return all(doc.get(key) == value for key, value in predicate.items())
+            try:
+                return truthy(self.call(predicate, doc))
+            except r.errors.ReqlNonExistenceError:
+                return False
+
+        if isinstance(selection, (Selection, TableRef)):
+            return Selection(self.table_name(selection), [doc for doc in self.docs(selection) if keep(doc)])
+        return [item for item in self.value(selection) if keep(item)]
+
+    def term_order_by(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        orderings = [self.eval(arg, scope) for arg in term._args[1:]]  # pylint: disable=W0212
+        index = term.optargs.get("index")
+        if index is not None:
+            orderings.insert(0, self.eval(index, scope))
+
+        docs = self.docs(selection) if isinstance(selection, (Selection, TableRef)) else self.value(selection)
+        for ordering in reversed(orderings):
+            descending = isinstance(ordering, tuple)
+            field = ordering[1] if descending else ordering
+            docs = sorted(docs, key=lambda doc, field=field: sort_key(self.order_value(doc, field)),
+                          reverse=descending)
+
+        if isinstance(selection, (Selection, TableRef)):
+            return Selection(self.table_name(selection), docs)
+        return docs
+
+    def order_value(self, doc, field):
+        if isinstance(field, Function):
+            return self.call(field, doc)
+        return doc.get(field)
+
+    def term_desc(self, term, scope):
+        return ("desc", self.values(term, scope)[0])
+
+    def term_asc(self, term, scope):
+        return self.values(term, scope)[0]
+
+    # tables
+
+    def table_name(self, selection):
+        if isinstance(selection, TableRef):
+            return selection.name
+        return selection.table
+
+    def docs(self, selection):
+        if isinstance(selection, TableRef):
+            return self.store.scan(selection.name, copy=False)
+        return selection.docs
+
+    def term_db(self, term, scope):
+        return ("db", self.values(term, scope)[0])
+
+    def term_table(self, term, scope):
+        name = self.values(term, scope)[-1]
+        if name not in self.store.tables():
+            raise r.errors.ReqlOpFailedError("Table `{}.{}` does not exist.".format(DEFAULT_DB, name))
+        return TableRef(name)
+
+    def term_table_list(self, term, scope):
+        return sorted(self.store.tables())
+
+    def term_table_create(self, term, scope):
+        name = self.values(term, scope)[-1]
+        if name in self.store.tables():
+            raise r.errors.ReqlOpFailedError("Table `{}.{}` already exists.".format(DEFAULT_DB, name))
+        self.store.create_table(name)
+        return {"tables_created": 1}
+
+    def term_table_drop(self, term, scope):
+        name = self.values(term, scope)[-1]
+        if name not in self.store.tables():
+            raise r.errors.ReqlOpFailedError("Table `{}.{}` does not exist.".format(DEFAULT_DB, name))
+        self.store.drop_table(name)
+        return {"tables_dropped": 1}
+
+    def term_index_create(self, term, scope):
+        table, name = self.args(term, scope)[:2]
+        self.store.create_index(self.table_name(table), self.value(name))
+        return {"created": 1}
+
+    def term_index_list(self, term, scope):
+        return sorted(self.store.indexes(self.table_name(self.args(term, scope)[0])))
+
+    def term_index_wait(self, term, scope):
+        table, *names = self.args(term, scope)
+        names = [self.value(name) for name in names] or self.store.indexes(self.table_name(table))
+        return [{"index": name, "ready": True} for name in names]
+
+    def term_get(self, term, scope):
+        table, key = self.args(term, scope)
+        return SingleSelection(table.name, key, self.store.get(table.name, self.value(key), copy=False))
+
+    def term_get_all(self, term, scope):
+        table, *keys = self.args(term, scope)
+        keys = [self.value(key) for key in keys]
+        index = self.optargs(term, scope).get("index", "id")
+        return Selection(table.name, self.store.get_all(table.name, keys, index))
+
+    def term_between(self, term, scope):
+        selection, lower, upper = [self.value(arg) if not isinstance(arg, TableRef) else arg
+                                   for arg in self.args(term, scope)]
+        optargs = self.optargs(term, scope)
+        index = optargs.get("index", "id")
+        left_open = optargs.get("left_bound", "closed") == "open"
+        right_closed = optargs.get("right_bound", "open") == "closed"
+
+        lower_key, upper_key = sort_key(lower), sort_key(upper)
+
+        def keep(doc):
+            if index not in doc:
+                return False
+            key = sort_key(doc[index])
+            if key < lower_key or (left_open and key == lower_key):
+                return False
+            return key < upper_key or (right_closed and key == upper_key)
+
+        return Selection(self.table_name(selection), [doc for doc in self.docs(selection) if keep(doc)])
+
+    def term_changes(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        if isinstance(selection, SingleSelection):
+            return self.store.watch(selection.table, selection.key)
+        return self.store.watch(self.table_name(selection))
+
+    # writes
+
+    def term_insert(self, term, scope):
+        table, docs = self.args(term, scope)
+        docs = self.value(docs)
+        if isinstance(docs, dict):
+            docs = [docs]
+        optargs = self.optargs(term, scope)
+        conflict = optargs.get("conflict", "error")
+
+        result = self.write_result()
+        generated_keys = []
+        with self.store.transaction():
+            for doc in docs:
+                doc = copy_value(doc)
+                if "id" not in doc:
+                    doc["id"] = str(uuid.uuid4())
+                    generated_keys.append(doc["id"])
+
+                old_doc = self.store.get(table.name, doc["id"], copy=False)
+                if old_doc is not None and conflict == "error":
+                    self.write_error(result, "Duplicate primary key `id`")
+                    continue
+                if old_doc is not None and conflict == "update":
+                    doc = merge(old_doc, doc)
+
+                self.store.put(table.name, doc)
+                result["inserted" if old_doc is None else "replaced"] += 1
+                self.add_change(result, optargs, old_doc, doc)
+
+        if generated_keys:
+            result["generated_keys"] = generated_keys
+
+        return self.finish(result, optargs)
+
+    def term_update(self, term, scope):
+        return self.write(term, scope, lambda doc, update: merge(doc, update), skip_missing=True)
+
+    def term_replace(self, term, scope):
+        return self.write(term, scope, lambda doc, new_doc: new_doc, skip_missing=False)
+
+    def term_delete(self, term, scope):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        optargs = self.optargs(term, scope)
+
+        result = self.write_result()
+        with self.store.transaction():
+            for table, key in self.selected_keys(selection):
+                old_doc = self.store.get(table, key, copy=False)
+                if old_doc is None:
+                    result["skipped"] += 1
+                    continue
+                self.store.delete(table, key)
+                result["deleted"] += 1
+                self.add_change(result, optargs, old_doc, None)
+
+        return self.finish(result, optargs)
+
+    def write(self, term, scope, apply, skip_missing):
+        selection = self.eval(term._args[0], scope)  # pylint: disable=W0212
+        optargs = self.optargs(term, scope)
+
+        result = self.write_result()
+        with self.store.transaction():
+            for table, key in self.selected_keys(selection):
+                # read again inside the transaction: the write is atomic
+                old_doc = self.store.get(table, key, copy=False)
+                if old_doc is None and skip_missing:
+                    result["skipped"] += 1
+                    continue
+
+                try:
+                    value = self.call(self.value(self.eval(term._args[1], scope)),  # pylint: disable=W0212
+                                      copy_value(old_doc))
+                    new_doc = apply(old_doc, value)
+                except r.errors.ReqlRuntimeError as error:
+                    self.write_error(result, error.message)
+                    continue
+
+                if new_doc is None:
+                    if old_doc is not None:
+                        self.store.delete(table, key)
+                        result["deleted"] += 1
+                    else:
+                        result["skipped"] += 1
+                elif new_doc.get("id") != key:
+                    self.write_error(result, "Primary key `id` cannot be changed")
+                    continue
+                elif new_doc == old_doc:
+                    result["unchanged"] += 1
+                elif old_doc is None:
+                    self.store.put(table, new_doc)
+                    result["inserted"] += 1
+                else:
+                    self.store.put(table, new_doc)
+                    result["replaced"] += 1
+
+                self.add_change(result, optargs, old_doc, new_doc)
+
+        return self.finish(result, optargs)
+
+    def selected_keys(self, selection):
+        if isinstance(selection, SingleSelection):
+            return [(selection.table, selection.key)]
+        return [(self.table_name(selection), doc["id"]) for doc in self.docs(selection)]
+
+    @staticmethod
+    def write_result():
+        return {"deleted": 0, "errors": 0, "inserted": 0, "replaced": 0, "skipped": 0, "unchanged": 0}
+
+    @staticmethod
+    def write_error(result, message):
+        result["errors"] += 1
+        result.setdefault("first_error", message)
+
+    @staticmethod
+    def add_change(result, optargs, old_doc, new_doc):
+        return_changes = optargs.get("return_changes", False)
+        if return_changes == "always" or (return_changes and old_doc != new_doc):
+            result.setdefault("changes", []).append(
+                {"old_val": copy_value(old_doc), "new_val": copy_value(new_doc)}
+            )
+
+    @staticmethod
+    def finish(result, optargs):
+        if optargs.get("return_changes", False) and "changes" not in result:
+            result["changes"] = []
+        return result
+
+
+class MemoryStore:
+    """Tables of documents kept in memory, shared by all the connections of the process"""
+
+    def __init__(self):
+        self._tables = {}
+        self._indexes = {}
+        self._watchers = []
+        self._pending_changes = threading.local()
+        self._lock = threading.RLock()
+
+    def tables(self):
+        return list(self._tables)
+
+    def create_table(self, name):
+        with self._lock:
+            self._tables[name] = {}
+            self._indexes[name] = {}
+
+    def drop_table(self, name):
+        with self._lock:
+            self._tables.pop(name, None)
+            self._indexes.pop(name, None)
+
+    def indexes(self, table):
+        return list(self._indexes.get(table, ()))
+
+    def create_index(self, table, name):
+        with self._lock:
+            if name in self._indexes[table]:
+                raise r.errors.ReqlOpFailedError("Index `{}` already exists on table `{}`.".format(name, table))
+            # secondary index: key of the value of the field <name> -> keys of the documents
+            entries = self._indexes[table][name] = {}
+            for key, doc in self._tables[table].items():
+                if name in doc:
+                    entries.setdefault(index_key(doc[name]), set()).add(key)
+
+    def get(self, table, key, copy=True):
+        doc = self._tables[table].get(key)
+        return copy_value(doc) if copy else doc
+
+    def get_all(self, table, keys, index="id"):
+        if index != "id":
+            entries = self._indexes[table].get(index)
+            if entries is None:
+                raise r.errors.ReqlOpFailedError("Index `{}` was not found on table `{}`.".format(index, table))
+            keys = [key for value in keys for key in sorted(entries.get(index_key(value), ()))]
+
+        docs = (self._tables[table].get(key) for key in keys)
+        return [doc for doc in docs if doc is not None]
+
+    def scan(self, table, copy=True):
+        docs = list(self._tables[table].values())
+        return [copy_value(doc) for doc in docs] if copy else docs
+
+    def put(self, table, doc):
+        old_doc = self._tables[table].get(doc["id"])
+        self._tables[table][doc["id"]] = doc
+        self._reindex(table, doc["id"], old_doc, doc)
+        self._changed(table, doc["id"], old_doc, doc)
+
+    def delete(self, table, key):
+        old_doc = self._tables[table].pop(key, None)
+        self._reindex(table, key, old_doc, None)
+        self._changed(table, key, old_doc, None)
+
+    def _reindex(self, table, key, old_doc, new_doc):
+        for name, entries in self._indexes[table].items():
+            if old_doc is not None and name in old_doc:
+                old_key = index_key(old_doc[name])
+                if new_doc is not None and name in new_doc and index_key(new_doc[name]) == old_key:
+                    continue
+                entries[old_key].discard(key)
+                if not entries[old_key]:
+                    del entries[old_key]
+            if new_doc is not None and name in new_doc:
+                entries.setdefault(index_key(new_doc[name]), set()).add(key)
+
+    @contextmanager
+    def transaction(self):
+        """Apply the writes of the block atomically, then publish their changes"""
+        with self._lock:
+            outermost = not hasattr(self._pending_changes, "changes")
+            if outermost:
+                self._pending_changes.changes = []
+            try:
+                yield
+            finally:
+                if outermost:
+                    changes = self._pending_changes.changes
+                    del self._pending_changes.changes
+                    self._publish(changes)
+
+    def watch(self, table, key=None):
+        changefeed = Changefeed(self, table, key)
+        with self._lock:
+            self._watchers.append(changefeed)
+        return changefeed
+
+    def unwatch(self, changefeed):
+        with self._lock:
+            if changefeed in self._watchers:
+                self._watchers.remove(changefeed)
+
+    def _changed(self, table, key, old_doc, new_doc):
+        changes = getattr(self._pending_changes, "changes", None)
+        if changes is None:
+            self._publish([(table, key, old_doc, new_doc)])
+        else:
+            changes.append((table, key, old_doc, new_doc))
+
+    def _publish(self, changes):
+        for table, key, old_doc, new_doc in changes:
+            for changefeed in self._watchers:
+                if changefeed.table == table and changefeed.key in (None, key):
+                    changefeed.changes.put({"old_val": copy_value(old_doc), "new_val": copy_value(new_doc)})
+
+
+class StoreConnection:
+    """Connection evaluating the queries in the process (it can be made the default connection with repl)"""
+
+    def __init__(self, store):
+        self.store = store
+        self._evaluator = Evaluator(store)
+        self._open = True
+
+    def repl(self):
+        r.ast.Repl.set(self)
+        return self
+
+    def is_open(self):
+        return self._open
+
+    def close(self, noreply_wait=False):
+        # pylint: disable=W0613
+        self._open = False
+
+    def reconnect(self, noreply_wait=False, timeout=None):
+        # pylint: disable=W0613
+        self._open = True
+        return self
+
+    def use(self, db):
+        # pylint: disable=W0613
+        return None
+
+    def _start(self, term, **global_optargs):
+        # pylint: disable=W0613
+        if not self._open:
+            raise r.errors.ReqlDriverError("Connection is closed.")
+
+        with PHASE_TIMER.timed("db"):
+            return self._evaluator.run(term)
+
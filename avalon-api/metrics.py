@@ -0,0 +1,178 @@
+"""This module contains the metrics (Prometheus text format) of the RESTful web service of Avalon.
+Metrics are kept per process: each gunicorn worker exposes its own ones."""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Blueprint, Response, g, request
+
+from api_utils import PHASE_TIMER
+from db_pool import DB_POOL
+from game_feed import GAME_FEED_HUB
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """Return the lines of the histogram in Prometheus text format"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels, le=format_bound(bound)), cumulative))
+        lines.append("{}_sum{} {}".format(name, format_labels(labels), self.sum))
+        lines.append("{}_count{} {}".format(name, format_labels(labels), self.count))
+
+        return lines
+
+
+def format_bound(bound):
+    """Return the label 'le' of a bucket"""
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def format_labels(labels, **extra_labels):
+    """Return labels in Prometheus text format"""
+    labels = dict(labels, **extra_labels)
+    if not labels:
+        return ""
+
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in sorted(labels.items())
+    ))
+
+
+class Metrics:
+    """Latency of the requests per route and method, split into phases (db, serialization...), and errors"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._phases = {}
+        self._responses = {}
+        self._errors = {}
+
+    def observe_request(self, route, method, status, latency, phases):
+        """Record a request which took <latency> seconds, <phases> of which in each phase"""
+        with self._lock:
+            key = (route, method)
+            self._requests.setdefault(key, Histogram()).observe(latency)
+            for phase, seconds in phases.items():
+                self._phases.setdefault((phase,) + key, Histogram()).observe(seconds)
+
+            key = (route, method, status)
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def count_error(self, status_code):
+        """Record an HTTPError"""
+        with self._lock:
+            self._errors[status_code] = self._errors.get(status_code, 0) + 1
+
+    def render(self):
+        """Return all the metrics in Prometheus text format"""
+        lines = []
+
+        with self._lock:
+            lines.append("# HELP avalon_request_duration_seconds Latency of the requests")
+            lines.append("# TYPE avalon_request_duration_seconds histogram")
+            for (route, method), histogram in sorted(self._requests.items()):
+                lines.extend(histogram.render(
+                    "avalon_request_duration_seconds", {"route": route, "method": method}
+                ))
+
+            lines.append("# HELP avalon_request_phase_seconds Time spent in each phase of the requests")
+            lines.append("# TYPE avalon_request_phase_seconds histogram")
+            for (phase, route, method), histogram in sorted(self._phases.items()):
+                lines.extend(histogram.render(
+                    "avalon_request_phase_seconds", {"phase": phase, "route": route, "method": method}
+                ))
+
+            lines.append("# HELP avalon_responses_total Responses by route, method and status")
+            lines.append("# TYPE avalon_responses_total counter")
+            for (route, method, status), count in sorted(self._responses.items()):
+                lines.append("avalon_responses_total{} {}".format(
+                    format_labels({"route": route, "method": method, "status": status}), count
+                ))
+
+            lines.append("# HELP avalon_http_errors_total HTTPError raised by status code")
+            lines.append("# TYPE avalon_http_errors_total counter")
+            for status_code, count in sorted(self._errors.items()):
+                lines.append("avalon_http_errors_total{} {}".format(
+                    format_labels({"status_code": status_code}), count
+                ))
+
+        lines.append("# HELP avalon_db_pool Connections and waits of the pool of database connections")
+        lines.append("# TYPE avalon_db_pool gauge")
+        for key, value in sorted(DB_POOL.stats().items()):
+            lines.append("avalon_db_pool{} {}".format(format_labels({"stat": key}), value))
+
+        lines.append("# HELP avalon_game_subscribers Clients subscribed to the updates of a game")
+        lines.append("# TYPE avalon_game_subscribers gauge")
+        lines.append("avalon_game_subscribers {}".format(sum(GAME_FEED_HUB.stats().values())))
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+METRICS_BLUEPRINT = Blueprint("metrics", __name__)
+
+
+def timed_json_encoder(encoder_class):
+    """Return a subclass of <encoder_class> adding the time spent encoding to the phase 'serialization'"""
+
+    class TimedJSONEncoder(encoder_class):
+        """JSON encoder timing its calls"""
+
+        def encode(self, o):
+            with PHASE_TIMER.timed("serialization"):
+                return super().encode(o)
+
+    return TimedJSONEncoder
+
+
+@METRICS_BLUEPRINT.before_app_request
+def start_timer():
+    """Start timing the request"""
+    PHASE_TIMER.reset()
+    g.request_start = time.perf_counter()
+
+
+@METRICS_BLUEPRINT.after_app_request
+def record_request(response):
+    """Record the latency of the request (until its first byte for streamed responses)"""
+    start = g.get("request_start")
+    if start is not None:
+        METRICS.observe_request(
+            route=request.url_rule.rule if request.url_rule else "<unmatched>",
+            method=request.method,
+            status=response.status_code,
+            latency=time.perf_counter() - start,
+            phases=PHASE_TIMER.phases
+        )
+
+    return response
+
+
+@METRICS_BLUEPRINT.route("/metrics")
+def metrics():
+    """Fetch the metrics in Prometheus text format"""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
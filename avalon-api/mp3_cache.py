@@ -0,0 +1,232 @@
+"""This module contains the cache of mp3 files (one per combination of roles) used in the RESTful web service of Avalon"""
+
+import hashlib
+import importlib.resources as pkg_resources
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
+from itertools import combinations
+from pathlib import Path
+
+import rethinkdb as r
+
+from avalonBG.exception import AvalonBGError
+
+from db_pool import RDB
+
+
+# roles which are narrated in the mp3 file, the other ones don't change it
+MP3_ROLES = ("mordred", "morgan", "oberon")
+
+# seconds before a failed generation is tried again (doubled after each failure)
+RETRY_BACKOFF = 30.0
+MAX_RETRY_BACKOFF = 600.0
+
+Mp3File = namedtuple("Mp3File", ("path", "etag"))
+
+Mp3Failure = namedtuple("Mp3Failure", ("error", "attempts", "retry_at"))
+
+
+class Mp3NotReadyError(Exception):
+    """Class Mp3NotReadyError related to a mp3 file which is still being generated"""
+
+
+class Mp3GenerationError(Exception):
+    """Class Mp3GenerationError related to a mp3 file whose generation failed (tried again after <retry_after>
+    seconds)"""
+
+    def __init__(self, message, retry_after):
+        self.retry_after = retry_after
+        Exception.__init__(self, message)
+
+
+def mp3_roles_key(roles):
+    """Return the key of the mp3 file associated with <roles>"""
+    return "-".join(sorted({role for role in roles if role in MP3_ROLES}))
+
+
+def game_roles_query(game_id):
+    """Return the query of the roles of the players in the game <game_id>"""
+    return RDB.table("players").get_all(RDB.args(RDB.table("games").get(game_id)["players"]))["role"]
+
+
+def get_game_roles(game_id):
+    """Return the roles of the players in the game <game_id> (only one query)"""
+    try:
+        return list(game_roles_query(game_id).run())
+    except r.errors.ReqlNonExistenceError as error:
+        raise AvalonBGError("Game's id {} does not exist!".format(game_id)) from error
+
+
+def all_mp3_roles_keys():
+    """Return the keys of every combination of narrated roles"""
+    return [
+        mp3_roles_key(roles)
+        for nb_roles in range(len(MP3_ROLES) + 1)
+        for roles in combinations(MP3_ROLES, nb_roles)
+    ]
+
+
+def build_mp3(roles, mp3_path):
+    """Assemble the narration of <roles> and export it to <mp3_path>"""
+    # pydub is only needed to generate the files
+    from pydub import AudioSegment  # pylint: disable=C0415
+    from avalonBG.resources import audio  # pylint: disable=C0415
+
+    list_mp3 = ["init.mp3", "serv_mord.mp3"]
+    if "oberon" in roles:
+        list_mp3.append("oberon.mp3")
+    list_mp3.append("red_identi.mp3")
+
+    if "morgan" in roles:
+        list_mp3.append("add_per_mor.mp3")
+
+    list_mp3.append("serv_mord.mp3")
+    if "mordred" in roles:
+        list_mp3.append("mordred.mp3")
+    list_mp3.extend(["merlin_identi.mp3", "end.mp3"])
+
+    mp3_combined = AudioSegment.empty()
+    for mp3 in list_mp3:
+        with pkg_resources.path(audio, mp3) as path:
+            mp3_combined += AudioSegment.from_mp3(path)
+
+    # export to a temporary file so that a partial file is never served
+    tmp_path = mp3_path.with_name("{}.{}.tmp".format(mp3_path.name, os.getpid()))
+    mp3_combined.export(tmp_path.as_posix(), format="mp3")
+    os.replace(tmp_path, mp3_path)
+
+
+class Mp3Cache:
+    """Content-addressed mp3 files, generated once per combination of roles by a background worker"""
+
+    def __init__(self, output_mp3_path="resources", wait_timeout=2.0):
+        self.output_mp3_path = output_mp3_path
+        self.wait_timeout = wait_timeout
+        self._files = {}
+        self._pending = {}
+        self._failed = {}
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mp3")
+
+        # the worker thread of the executor doesn't survive a fork (gunicorn workers)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def path(self, key):
+        """Return the path of the mp3 file associated with the roles <key>"""
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return Path(self.output_mp3_path, "roles-{}.mp3".format(digest))
+
+    def get(self, roles, timeout=None):
+        """Return the mp3 file (and its ETag) of <roles>, waiting at most <timeout> seconds for its generation.
+        Concurrent requests for the same file share a single generation. Raise Mp3GenerationError if it failed."""
+        future = self.get_future(roles)
+
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError as error:
+            raise Mp3NotReadyError("Mp3 file is being generated, retry later!") from error
+
+    def get_future(self, roles):
+        """Return a future of the mp3 file (and its ETag) of <roles>, already done if the file is available
+        (or if its generation failed less than its backoff ago)"""
+        key = mp3_roles_key(roles)
+
+        mp3_file = self._files.get(key)
+        if mp3_file is None:
+            with self._lock:
+                mp3_file = self._files.get(key)
+                failure = self._failed.get(key)
+                backing_off = failure is not None and key not in self._pending and time.monotonic() < failure.retry_at
+                if mp3_file is None and not backing_off:
+                    return self._submit(key)
+
+        future = Future()
+        if mp3_file is None:
+            future.set_exception(self._generation_error(failure))
+        else:
+            future.set_result(mp3_file)
+
+        return future
+
+    def warm(self):
+        """Generate the mp3 files of every combination of roles"""
+        for key in all_mp3_roles_keys():
+            self.get(key.split("-"))
+
+    def warm_async(self):
+        """Generate the missing mp3 files in the background"""
+        with self._lock:
+            for key in all_mp3_roles_keys():
+                if key not in self._files:
+                    self._submit(key)
+
+    def status(self):
+        """Return how many mp3 files are available and the ones which failed to be generated"""
+        keys = all_mp3_roles_keys()
+        nb_generated = len([key for key in keys if key in self._files or self.path(key).exists()])
+
+        with self._lock:
+            failed = {key: failure.error for key, failure in self._failed.items()}
+
+        return {
+            "ready": nb_generated == len(keys),
+            "generated": nb_generated,
+            "total": len(keys),
+            "failed": failed
+        }
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mp3")
+        self._pending = {}
+
+    def _submit(self, key):
+        future = self._pending.get(key)
+        if future is None:
+            future = self._executor.submit(self._load, key)
+            self._pending[key] = future
+            future.add_done_callback(partial(self._done, key))
+
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception() is None:
+                self._files[key] = future.result()
+                self._failed.pop(key, None)
+
+    @staticmethod
+    def _generation_error(failure):
+        retry_after = max(1, math.ceil(failure.retry_at - time.monotonic()))
+        return Mp3GenerationError("Mp3 file could not be generated: {}".format(failure.error), retry_after)
+
+    def _load(self, key):
+        try:
+            mp3_path = self.path(key)
+            if not mp3_path.exists():
+                mp3_path.parent.mkdir(parents=True, exist_ok=True)
+                build_mp3(roles=key.split("-"), mp3_path=mp3_path)
+
+            sha256 = hashlib.sha256()
+            with open(mp3_path, "rb") as infile:
+                for chunk in iter(lambda: infile.read(1 << 16), b""):
+                    sha256.update(chunk)
+        except Exception as error:  # pylint: disable=W0703
+            # ffmpeg, pydub or the disk: recorded before the waiting requests get the error
+            with self._lock:
+                attempts = self._failed[key].attempts + 1 if key in self._failed else 1
+                backoff = min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+                failure = Mp3Failure(error=str(error), attempts=attempts, retry_at=time.monotonic() + backoff)
+                self._failed[key] = failure
+            raise self._generation_error(failure) from error
+
+        return Mp3File(path=mp3_path.as_posix(), etag=sha256.hexdigest())
+
+
+MP3_CACHE = Mp3Cache()
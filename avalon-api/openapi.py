@@ -0,0 +1,65 @@
+"""This module contains the OpenAPI (Swagger) specification of the RESTful web service of Avalon.
+flask-restx builds it on the first request of /swagger.json and encodes it again on each one; here it is built once
+(under a lock: concurrent first requests would build it together, and a failed build would be kept), encoded once
+and served from memory with an ETag."""
+
+import hashlib
+import threading
+
+from flask import Response, json, request
+from flask_restx import Api, Resource
+from flask_restx.swagger import Swagger
+
+
+class CachedSwaggerView(Resource):
+    """Serve the encoded specification"""
+
+    def get(self):
+        """Fetch the OpenAPI specification"""
+        body, etag = self.api.encoded_spec()
+
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+
+        return response.make_conditional(request)
+
+
+class AvalonApi(Api):
+    """flask-restx Api whose specification is built once and served from memory"""
+
+    def __init__(self, *args, **kwargs):
+        self._spec_lock = threading.Lock()
+        self._spec = None
+        self._encoded_spec = None
+        super().__init__(*args, **kwargs)
+
+    def _register_specs(self, app_or_blueprint):
+        # same route and endpoint as flask-restx (the documentation links to it), another view
+        if self._add_specs:
+            self._register_view(
+                app_or_blueprint,
+                CachedSwaggerView,
+                self.default_namespace,
+                "/swagger.json",
+                endpoint="specs",
+                resource_class_args=(self,),
+            )
+            self.endpoints.add("specs")
+
+    @property
+    def __schema__(self):
+        """Return the specification as a dict (built on the first call, in a request context)"""
+        if self._spec is None:
+            with self._spec_lock:
+                if self._spec is None:
+                    self._spec = Swagger(self).as_dict()
+
+        return self._spec
+
+    def encoded_spec(self):
+        """Return the specification encoded in JSON and its ETag"""
+        if self._encoded_spec is None:
+            body = json.dumps(self.__schema__).encode()
+            self._encoded_spec = (body, hashlib.sha1(body).hexdigest())
+
+        return self._encoded_spec
@@ -0,0 +1,115 @@
+"""This module contains the paginated and streamed listings of the tables used in the RESTful web service of Avalon"""
+
+import base64
+import binascii
+
+from flask import Response, json, jsonify, request, stream_with_context
+
+from avalonBG.db_utils import db_get_table
+from avalonBG.exception import AvalonBGError
+
+from db_pool import RDB
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+LISTING_PARAMS = {
+    "limit": "Maximum number of rows to return (between 1 and {})".format(MAX_LIMIT),
+    "after": "Token 'next' of the previous page",
+    "format": "'json' (default) or 'ndjson' to stream one row per line"
+}
+
+
+def encode_cursor(last_id):
+    """Return the token of the page starting after the row <last_id>"""
+    return base64.urlsafe_b64encode(last_id.encode()).decode()
+
+
+def decode_cursor(token):
+    """Return the id of the last row of the previous page"""
+    try:
+        return base64.urlsafe_b64decode(token.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError) as error:
+        raise AvalonBGError("Token 'after' is not valid!") from error
+
+
+def db_get_page(table_name, limit, after=None, selection=None, field_names=None):
+    """Return at most <limit> rows of the table (or of its <selection>) ordered by id, after the token <after>,
+    and the next token. The rows only have <field_names> (plucked by the database) if given."""
+    if selection is None:
+        query = RDB.table(table_name)
+        if after is not None:
+            query = query.between(decode_cursor(after), RDB.maxval, left_bound="open")
+        query = query.order_by(index="id")
+    else:
+        # the rows selected by a secondary index are sorted in memory
+        query = selection
+        if after is not None:
+            query = query.filter(RDB.row["id"].gt(decode_cursor(after)))
+        query = query.order_by("id")
+
+    # one more row tells if there is a next page
+    query = query.limit(limit + 1)
+    if field_names is not None:
+        query = query.pluck(*field_names)
+    rows = list(query.run())
+
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1]["id"])
+
+    return rows, None
+
+
+def db_stream_table(table_name, selection=None, field_names=None):
+    """Yield the rows of the table (or of its <selection>) as JSON lines, while they are fetched from the cursor"""
+    query = RDB.table(table_name) if selection is None else selection
+    if field_names is not None:
+        query = query.pluck(*field_names)
+
+    for row in query.run():
+        yield json.dumps(row) + "\n"
+
+
+def parse_limit(value):
+    """Check the query parameter 'limit'"""
+    try:
+        limit = int(value)
+    except ValueError as error:
+        raise AvalonBGError("'limit' should be an integer!") from error
+
+    if not 1 <= limit <= MAX_LIMIT:
+        raise AvalonBGError("'limit' should be between 1 and {}!".format(MAX_LIMIT))
+
+    return limit
+
+
+def table_response(table_name, selection=None, field_names=None):
+    """Return the table <table_name> (or the rows of its <selection>) as a whole, one page at a time or streamed,
+    depending on the query parameters, with only <field_names> if given"""
+    output_format = request.args.get("format", "json")
+    if output_format not in ("json", "ndjson"):
+        raise AvalonBGError("'format' should be 'json' or 'ndjson'!")
+
+    if output_format == "ndjson":
+        return Response(
+            stream_with_context(db_stream_table(table_name, selection, field_names)), mimetype="application/x-ndjson"
+        )
+
+    limit, after = request.args.get("limit"), request.args.get("after")
+    if limit is None and after is None:
+        if field_names is not None:
+            return jsonify(list((RDB.table(table_name) if selection is None else selection).pluck(*field_names).run()))
+        if selection is not None:
+            return jsonify(list(selection.run()))
+        return jsonify(db_get_table(table_name=table_name))
+
+    rows, next_token = db_get_page(
+        table_name=table_name,
+        limit=DEFAULT_LIMIT if limit is None else parse_limit(limit),
+        after=after,
+        selection=selection,
+        field_names=field_names
+    )
+
+    return jsonify({"items": rows, "next": next_token})
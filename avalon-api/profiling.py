@@ -0,0 +1,256 @@
+"""This module contains the request profiler of the RESTful web service of Avalon: when it is enabled, a fraction
+of the requests (and the ones sent with the header X-Avalon-Profile) are profiled with cProfile, including the time
+spent in avalonBG. The profiles are kept in a directory (the most recent ones only) shared by the workers, with the
+settings, so that the profiler is toggled at runtime for all of them (PUT /profiles/settings)."""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+
+import avalonBG
+from flask import Blueprint, g, jsonify, request, send_file
+
+from api_utils import HTTPError
+
+
+PROFILE_DIR = "profiles"
+
+# profiles kept on disk (the oldest ones are deleted)
+MAX_PROFILES = 200
+
+# requests sent with this header are profiled whatever the sample rate (when the profiler is enabled)
+PROFILE_HEADER = "X-Avalon-Profile"
+
+# seconds between two checks of the settings file by a worker
+SETTINGS_REFRESH_INTERVAL = 1.0
+
+# functions listed in the text report of a profile
+REPORT_LIMIT = 40
+
+REPORT_SORTS = ("cumulative", "tottime", "calls")
+
+AVALONBG_DIR = os.path.dirname(avalonBG.__file__)
+
+
+def avalonbg_seconds(profiler):
+    """Return the time spent in the functions of avalonBG (not counting their calls to other modules)"""
+    return sum(
+        total_time
+        for (filename, _, _), (_, _, total_time, _, _) in pstats.Stats(profiler).stats.items()
+        if filename.startswith(AVALONBG_DIR)
+    )
+
+
+class RequestProfiler:
+    """Profiler of the sampled requests and store of their profiles"""
+
+    def __init__(self, profile_dir=PROFILE_DIR, max_profiles=MAX_PROFILES):
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.enabled = False
+        self.sample_rate = 0.0
+        self._settings_mtime = None
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        """Change the settings given in <kwargs>"""
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    @property
+    def settings_path(self):
+        return os.path.join(self.profile_dir, "settings.json")
+
+    def settings(self):
+        """Return the settings shared by the workers"""
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate}
+
+    def save_settings(self, enabled, sample_rate):
+        """Change the settings of all the workers (each one reads them within SETTINGS_REFRESH_INTERVAL seconds)"""
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("'sample_rate' should be between 0 and 1!")
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        temporary_path = "{}.{}".format(self.settings_path, os.getpid())
+        with open(temporary_path, "w") as settings_file:
+            json.dump({"enabled": enabled, "sample_rate": sample_rate}, settings_file)
+        os.replace(temporary_path, self.settings_path)
+
+        self.configure(enabled=enabled, sample_rate=sample_rate)
+
+    def refresh(self):
+        """Read the settings file again if it changed (at most every SETTINGS_REFRESH_INTERVAL seconds)"""
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return
+
+        with self._lock:
+            self._next_refresh = now + SETTINGS_REFRESH_INTERVAL
+            try:
+                mtime = os.stat(self.settings_path).st_mtime_ns
+                if mtime == self._settings_mtime:
+                    return
+                with open(self.settings_path) as settings_file:
+                    settings = json.load(settings_file)
+            except (OSError, ValueError):
+                return
+
+            self._settings_mtime = mtime
+            self.configure(enabled=bool(settings["enabled"]), sample_rate=float(settings["sample_rate"]))
+
+    def sampled(self, headers):
+        """Return whether the request with <headers> is profiled"""
+        self.refresh()
+        if not self.enabled:
+            return False
+
+        return PROFILE_HEADER in headers or random.random() < self.sample_rate
+
+    def save(self, profiler, info):
+        """Store the profile of a request described by <info>, then delete the oldest profiles"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile_id = "{}-{}".format(time.strftime("%Y%m%dT%H%M%S", time.gmtime(info["at"])), uuid.uuid4().hex[:8])
+
+        profiler.dump_stats(os.path.join(self.profile_dir, profile_id + ".prof"))
+        with open(os.path.join(self.profile_dir, profile_id + ".json"), "w") as info_file:
+            json.dump(dict(info, id=profile_id, avalonbg_seconds=avalonbg_seconds(profiler)), info_file)
+
+        for old_id in self.profile_ids()[:-self.max_profiles]:
+            for extension in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(self.profile_dir, old_id + extension))
+                except FileNotFoundError:
+                    pass
+
+    def profile_ids(self):
+        """Return the ids of the stored profiles, from the oldest"""
+        if not os.path.isdir(self.profile_dir):
+            return []
+
+        return sorted(name[:-len(".prof")] for name in os.listdir(self.profile_dir) if name.endswith(".prof"))
+
+    def profiles(self, route=None):
+        """Return the descriptions of the stored profiles (of <route>), from the most recent"""
+        profiles = []
+        for profile_id in reversed(self.profile_ids()):
+            try:
+                with open(os.path.join(self.profile_dir, profile_id + ".json")) as info_file:
+                    info = json.load(info_file)
+            except (OSError, ValueError):
+                # being written or deleted by another worker
+                continue
+            if route is None or info["route"] == route:
+                profiles.append(info)
+
+        return profiles
+
+    def profile_path(self, profile_id):
+        """Return the file of the profile <profile_id>"""
+        if profile_id not in self.profile_ids():
+            raise HTTPError("Profile '{}' does not exist!".format(profile_id), status_code=404)
+
+        return os.path.join(self.profile_dir, profile_id + ".prof")
+
+    def report(self, profile_id, sort="cumulative"):
+        """Return the text report of the profile <profile_id>: its REPORT_LIMIT first functions by <sort>"""
+        if sort not in REPORT_SORTS:
+            raise HTTPError("'sort' should be {}!".format(" or ".join(REPORT_SORTS)), status_code=400)
+
+        output = io.StringIO()
+        pstats.Stats(self.profile_path(profile_id), stream=output).sort_stats(sort).print_stats(REPORT_LIMIT)
+
+        return output.getvalue()
+
+
+REQUEST_PROFILER = RequestProfiler()
+
+PROFILING_BLUEPRINT = Blueprint("profiling", __name__)
+
+
+@PROFILING_BLUEPRINT.before_app_request
+def start_profile():
+    """Profile the request if it is sampled (not the ones reading the profiles)"""
+    if request.blueprint != PROFILING_BLUEPRINT.name and REQUEST_PROFILER.sampled(request.headers):
+        g.profiler = cProfile.Profile()
+        g.profile_start = time.perf_counter()
+        g.profiler.enable()
+
+
+@PROFILING_BLUEPRINT.after_app_request
+def save_profile(response):
+    """Store the profile of the request (until its first byte for streamed responses)"""
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        REQUEST_PROFILER.save(profiler, {
+            "route": request.url_rule.rule if request.url_rule else "<unmatched>",
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code,
+            "seconds": time.perf_counter() - g.pop("profile_start"),
+            "at": time.time()
+        })
+
+    return response
+
+
+@PROFILING_BLUEPRINT.teardown_app_request
+def stop_profile(error=None):  # pylint: disable=W0613
+    """Stop the profiler of a request which ended without its after_request (an error propagated by the
+    application, an after_request failing before it): left enabled, it would keep profiling the thread"""
+    profiler = g.pop("profiler", None)
+    g.pop("profile_start", None)
+    if profiler is not None:
+        profiler.disable()
+
+
+@PROFILING_BLUEPRINT.route("/profiles")
+def get_profiles():
+    """Fetch the descriptions of the stored profiles, from the most recent"""
+    return jsonify({
+        "settings": REQUEST_PROFILER.settings(),
+        "profiles": REQUEST_PROFILER.profiles(route=request.args.get("route"))
+    })
+
+
+@PROFILING_BLUEPRINT.route("/profiles/<string:profile_id>")
+def get_profile(profile_id):
+    """Fetch a profile: its report (text), or its pstats file"""
+    if request.args.get("format", "text") == "pstats":
+        return send_file(
+            os.path.abspath(REQUEST_PROFILER.profile_path(profile_id)),
+            mimetype="application/octet-stream",
+            as_attachment=True,
+            download_name=profile_id + ".prof"
+        )
+
+    report = REQUEST_PROFILER.report(profile_id, sort=request.args.get("sort", "cumulative"))
+    return report, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+@PROFILING_BLUEPRINT.route("/profiles/settings", methods=["PUT"])
+def put_profile_settings():
+    """Enable or disable the profiler, and change its sample rate, in all the workers"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise HTTPError("Payload should be {'enabled': <bool>, 'sample_rate': <0 to 1>}!", status_code=400)
+
+    settings = dict(REQUEST_PROFILER.settings(), **payload)
+    sample_rate = settings["sample_rate"]
+    if set(settings) != {"enabled", "sample_rate"} or not isinstance(settings["enabled"], bool) \
+            or isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float)):
+        raise HTTPError("Payload should be {'enabled': <bool>, 'sample_rate': <0 to 1>}!", status_code=400)
+
+    try:
+        REQUEST_PROFILER.save_settings(enabled=settings["enabled"], sample_rate=float(sample_rate))
+    except ValueError as error:
+        raise HTTPError(str(error), status_code=400) from error
+
+    return jsonify(REQUEST_PROFILER.settings())
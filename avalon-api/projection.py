@@ -0,0 +1,51 @@
+"""This module contains the sparse fieldsets of the responses of the RESTful web service of Avalon (query parameter
+'fields'): the rows read from a table are projected by the database (pluck), the documents read from the caches
+are projected here"""
+
+import re
+
+from flask import request
+
+from avalonBG.exception import AvalonBGError
+
+
+FIELD_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+FIELDS_PARAMS = {
+    "fields": "Comma-separated fields to return, e.g. current_quest,current_id_player (id is always returned)"
+}
+
+
+def parse_fields(value):
+    """Check the query parameter 'fields' and return the field names (None: all the fields)"""
+    if value is None:
+        return None
+
+    names = {name.strip() for name in value.split(",")} - {""}
+    if not names or not all(FIELD_NAME.match(name) for name in names):
+        raise AvalonBGError("'fields' should be a comma-separated list of field names!")
+
+    # the id of the rows is kept: it is the cursor of the pages
+    return tuple(sorted(names | {"id"}))
+
+
+def request_fields():
+    """Return the field names of the current request (None: all the fields)"""
+    return parse_fields(request.args.get("fields"))
+
+
+def project(value, field_names):
+    """Return the document (or the documents) <value> with only <field_names> (all the fields if None)"""
+    if field_names is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, field_names) for item in value]
+    if isinstance(value, dict):
+        return {name: value[name] for name in field_names if name in value}
+
+    return value
+
+
+def fields_etag(field_names):
+    """Return the parts of the ETag of a projected document (none if all the fields)"""
+    return () if field_names is None else ("fields", ",".join(field_names))
@@ -1,17 +1,32 @@
 """This functions are used is the RESTful web service of Avalon"""
 
-from flask import Blueprint, jsonify, make_response, request, send_file
+from functools import partial
+
+from flask import Blueprint, Response, g, jsonify, make_response, request, send_file, stream_with_context
 from flask_cors import CORS
 from flask_restx import fields, marshal_with, Namespace, Resource
 
 from avalonBG import __version__ as api_version
-from avalonBG.db_utils import db_connect, db_get_game, db_get_table, restart_db
+from avalonBG.db_utils import restart_db
 from avalonBG.exception import AvalonBGError
-from avalonBG.games import game_put, game_guess_merlin
-from avalonBG.mp3 import get_mp3_roles_path
-from avalonBG.rules import get_rules
+from avalonBG.games import game_guess_merlin
 
 from api_utils import HTTPError
+from archive import GAME_ARCHIVE
+from db_indexes import GAMES_PARAMS, db_create_indexes, db_get_game_rows, db_tag_new_game, game_rows_selection, \
+                       games_selection
+from db_pool import db_checkin, db_checkout
+from game_cache import DELTA_PARAMS, GAME_CACHE, db_get_game_version, game_etag, game_events_since, \
+                       game_mutation, mutation_response, not_modified, versioned_response
+from game_events import EVENTS_PARAMS, db_append_event, db_restart_event_log
+from game_feed import GAME_FEED_HUB, TooManySubscribersError, game_events
+from metrics import METRICS
+from mp3_cache import MP3_CACHE, Mp3GenerationError, Mp3NotReadyError, get_game_roles
+from pagination import LISTING_PARAMS, table_response
+from projection import FIELDS_PARAMS, fields_etag, project, request_fields
+from rules_cache import RULES_CACHE, game_put
+from simulation import DEFAULT_STRATEGY, MAX_STORED_GAMES, games_bulk_put, games_simulate
+from validation import PayloadValidator, validate_payload
 
 # pylint: disable=R0201
 
@@ -19,7 +34,8 @@ from api_utils import HTTPError
 AVALON_BLUEPRINT = Blueprint("avalon", __name__)
 CORS(AVALON_BLUEPRINT)
 
-AVALON_BLUEPRINT.before_request(db_connect)
+AVALON_BLUEPRINT.before_request(db_checkout)
+AVALON_BLUEPRINT.teardown_request(db_checkin)
 
 DATABASE_NAMESPACE = Namespace("database", description="Database operations", path="/")
 GAMES_NAMESPACE = Namespace("games", description="Games operations", path="/games")
@@ -27,24 +43,162 @@ MP3_NAMESPACE = Namespace("mp3", description="Mp3 operations", path="/games/<str
 PLAYERS_NAMESPACE = Namespace("players", description="Players operations", path="/")
 RULES_NAMESPACE = Namespace("rules", description="Rules operations", path="/")
 
+# the mp3 file of a game never changes since its roles are fixed
+MP3_MAX_AGE = 24 * 3600
+MP3_RETRY_AFTER = 5
+
+# seconds between two keep-alive comments of a subscription: the thread of a client which disconnected is
+# freed when the second one is written
+SUBSCRIBE_HEARTBEAT = 5.0
+
+# seconds before a refused subscription is tried again
+SUBSCRIBE_RETRY_AFTER = 10
+
+# games created or simulated per request (and per number of players and roles)
+MAX_BULK_GAMES = 10000
+MAX_SIMULATED_GAMES = 1000000
+
+# role sets simulated per request: the subsets of the optional roles
+MAX_ROLE_SETS = 16
+
+NEWPLAYER_MODEL = GAMES_NAMESPACE.model(
+    "NewPlayer",
+    {
+        "name": fields.String(
+            required=True,
+            description="Name of the player",
+            example="Romain",
+            min_length=1
+        ),
+        "avatar_index": fields.Integer(
+            required=True,
+            description="Index of the avatar of the player",
+            example=0,
+            min=0
+        )
+    },
+    strict=True
+)
+
 NEWGAME_MODEL = GAMES_NAMESPACE.model(
     "NewGame",
     {
-        "names": fields.List(
-            fields.String(),
-            example=["Romain", "Mathieu", "Chacha", "Thomas", "Elsa", "Flo", "Eglantine", "Jordan"],
+        "players": fields.List(
+            fields.Nested(NEWPLAYER_MODEL),
+            required=True,
             min_items=5,
             max_items=10
         ),
         "roles": fields.List(
-            fields.String(),
+            fields.String(enum=["oberon", "morgan", "mordred", "perceval"]),
+            required=True,
             example=["oberon", "morgan", "mordred", "perceval"],
             min_items=0,
-            max_items=4
+            max_items=4,
+            unique=True
+        )
+    },
+    strict=True
+)
+
+NEWGAME_VALIDATOR = PayloadValidator(NEWGAME_MODEL)
+
+NEWGAMES_MODEL = GAMES_NAMESPACE.model(
+    "NewGames",
+    dict(
+        NEWGAME_MODEL,
+        nb_games=fields.Integer(
+            required=True,
+            description="Number of games to create",
+            example=100,
+            min=1,
+            max=MAX_BULK_GAMES
         )
+    ),
+    strict=True
+)
+
+NEWGAMES_VALIDATOR = PayloadValidator(NEWGAMES_MODEL)
+
+SIMULATION_MODEL = GAMES_NAMESPACE.model(
+    "Simulation",
+    {
+        "nb_games": fields.Integer(
+            required=True,
+            description="Number of games per number of players and roles (at most {} games in all)".format(
+                MAX_SIMULATED_GAMES
+            ),
+            example=10000,
+            min=1,
+            max=MAX_SIMULATED_GAMES
+        ),
+        "nb_players": fields.List(
+            fields.Integer(min=5, max=10),
+            required=True,
+            example=[5, 7, 10],
+            min_items=1,
+            unique=True
+        ),
+        "role_sets": fields.List(
+            fields.List(fields.String(enum=["oberon", "morgan", "mordred", "perceval"]), max_items=4),
+            required=True,
+            example=[[], ["oberon"], ["perceval", "morgan"]],
+            min_items=1,
+            max_items=MAX_ROLE_SETS
+        ),
+        "red_fail_rate": fields.Float(
+            description="Probability that a red player sent on a quest votes for its failure",
+            example=DEFAULT_STRATEGY["red_fail_rate"],
+            min=0,
+            max=1
+        ),
+        "unsend_rate": fields.Float(
+            description="Probability that a proposed team is refused",
+            example=DEFAULT_STRATEGY["unsend_rate"],
+            min=0,
+            max=1
+        ),
+        "merlin_influence": fields.Float(
+            description="Probability that Merlin keeps out of a team each red player he sees",
+            example=DEFAULT_STRATEGY["merlin_influence"],
+            min=0,
+            max=1
+        ),
+        "seed": fields.Integer(description="Seed of the random draws", min=0),
+        "store": fields.Boolean(description="Insert the simulated games in the database", default=False)
+    },
+    strict=True
+)
+
+SIMULATION_VALIDATOR = PayloadValidator(SIMULATION_MODEL)
+
+GUESS_MERLIN_MODEL = GAMES_NAMESPACE.schema_model(
+    "GuessMerlin",
+    {
+        "type": "object",
+        "description": "Id of the assassin mapped to the id of the player guessed as Merlin",
+        "minProperties": 1,
+        "maxProperties": 1,
+        "additionalProperties": {"type": "string", "minLength": 1},
+        "example": {"94ee4546-9358-4a68-a155-01876a7c583f": "2669a9fe-37c4-4139-ab78-8e3f0d0607d0"}
     }
 )
 
+GUESS_MERLIN_VALIDATOR = PayloadValidator(GUESS_MERLIN_MODEL)
+
+TABLES_MODEL = DATABASE_NAMESPACE.schema_model(
+    "Tables",
+    {
+        "type": "array",
+        "description": "Tables to restart",
+        "items": {"type": "string", "enum": ["games", "players", "quests", "users"]},
+        "uniqueItems": True,
+        "example": ["games", "players", "quests"]
+    }
+)
+
+TABLES_VALIDATOR = PayloadValidator(TABLES_MODEL)
+
 
 PLAYER_MODEL = GAMES_NAMESPACE.model(
     "Player",
@@ -185,21 +339,20 @@ class Database(Resource):
             204: "OK",
             400: "Invalid Argument"
         },
-        body=[
-            fields.String(
-                required=True,
-                description="Table to restart ('games', 'players', 'quests' or 'users')",
-                example="games"
-            )
-        ],
     )
+    @DATABASE_NAMESPACE.expect(TABLES_MODEL)
+    @validate_payload(TABLES_VALIDATOR)
     def put(self):
         """Restart the database"""
         try:
             response_msg = restart_db(payload_tables=request.json)
+            db_create_indexes(tables=request.json)
+            db_restart_event_log(tables=request.json)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
+        GAME_CACHE.clear()
+
         return make_response(response_msg, 204)
 
 
@@ -208,17 +361,24 @@ class Rules(Resource):
     @RULES_NAMESPACE.doc(
         responses={
             200: "OK",
+            304: "Not Modified",
             400: "Invalid Argument"
+        },
+        params={
+            "nb_player": "Only fetch the rules of the games with this number of players"
         }
     )
     def get(self):
         """Fetch the rules"""
         try:
-            rules = get_rules()
+            rules, etag = RULES_CACHE.get(nb_player=request.args.get("nb_player"))
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(rules)
+        response = jsonify(rules)
+        response.set_etag(etag)
+
+        return response.make_conditional(request)
 
 
 @PLAYERS_NAMESPACE.route("/players")
@@ -227,16 +387,45 @@ class Players(Resource):
         responses={
             200: "OK",
             400: "Invalid Argument"
-        }
+        },
+        params=dict(
+            LISTING_PARAMS,
+            game_id="Only fetch the players of this game",
+            **FIELDS_PARAMS
+        )
     )
     def get(self):
         """Fetch the players"""
+        game_id = request.args.get("game_id")
         try:
-            table_players = db_get_table(table_name="players")
+            response = table_response(
+                table_name="players",
+                selection=game_rows_selection("players", game_id) if game_id is not None else None,
+                field_names=request_fields()
+            )
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(table_players)
+        return response
+
+
+@AVALON_BLUEPRINT.teardown_request
+def end_subscription(error=None):  # pylint: disable=W0613
+    """Stop the subscription of the current request (GamesSubscribe), if any"""
+    subscription = g.pop("subscription", None)
+    if subscription is not None:
+        GAME_FEED_HUB.unsubscribe(*subscription)
+
+
+def retry_later(error, retry_after):
+    """Return a 503 response of <error> asking the client to retry after <retry_after> seconds"""
+    METRICS.count_error(503)
+
+    response = jsonify(HTTPError(str(error), status_code=503).__dict__)
+    response.status_code = 503
+    response.headers["Retry-After"] = retry_after
+
+    return response
 
 
 @MP3_NAMESPACE.route("/mp3")
@@ -244,17 +433,34 @@ class Mp3(Resource):
     @MP3_NAMESPACE.doc(
         responses={
             200: "OK",
-            400: "Invalid Argument"
+            206: "Partial Content",
+            304: "Not Modified",
+            400: "Invalid Argument",
+            503: "Mp3 file not generated yet, or its generation failed (retried after Retry-After)"
         }
     )
     def get(self, game_id):
         """Fetch mp3 file depending on roles in the game <game_id>"""
         try:
-            mp3_roles_path = get_mp3_roles_path(game_id=game_id)
+            mp3_file = MP3_CACHE.get(
+                roles=get_game_roles(game_id=game_id),
+                timeout=MP3_CACHE.wait_timeout
+            )
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
-
-        return send_file(mp3_roles_path, attachment_filename="roles.mp3", mimetype="audio/mpeg")
+        except Mp3NotReadyError as error:
+            return retry_later(error, MP3_RETRY_AFTER)
+        except Mp3GenerationError as error:
+            return retry_later(error, error.retry_after)
+
+        return send_file(
+            mp3_file.path,
+            mimetype="audio/mpeg",
+            download_name="roles.mp3",
+            conditional=True,
+            etag=mp3_file.etag,
+            max_age=MP3_MAX_AGE
+        )
 
 
 @GAMES_NAMESPACE.route("/<string:game_id>/guess_merlin")
@@ -263,16 +469,21 @@ class GuessMerlin(Resource):
         responses={
             200: "OK",
             400: "Invalid Argument"
-        }
+        },
+        params=DELTA_PARAMS
     )
+    @GAMES_NAMESPACE.expect(GUESS_MERLIN_MODEL)
+    @validate_payload(GUESS_MERLIN_VALIDATOR)
     def post(self, game_id):
         """Assassin try to guess merlin"""
         try:
-            updated_game = game_guess_merlin(game_id=game_id, payload=request.json)
+            with game_mutation(game_id):
+                updated_game = game_guess_merlin(game_id=game_id, payload=request.json)
+            response = mutation_response(game_id, updated_game, game=updated_game)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(updated_game)
+        return response
 
 
 @GAMES_NAMESPACE.route("")
@@ -281,16 +492,21 @@ class Games(Resource):
         responses={
             200: "OK",
             400: "Invalid Argument"
-        }
+        },
+        params=dict(LISTING_PARAMS, **GAMES_PARAMS, **FIELDS_PARAMS)
     )
     def get(self):
         """Fetch the games"""
         try:
-            game = db_get_game()
+            response = table_response(
+                table_name="games",
+                selection=games_selection(status=request.args.get("status"), since=request.args.get("since")),
+                field_names=request_fields()
+            )
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(game)
+        return response
 
 
     @GAMES_NAMESPACE.doc(
@@ -299,31 +515,193 @@ class Games(Resource):
             400: "Invalid Argument"
         }
     )
-    @GAMES_NAMESPACE.expect(NEWGAME_MODEL, validate=True)
+    @GAMES_NAMESPACE.expect(NEWGAME_MODEL)
     @GAMES_NAMESPACE.response(200, "OK", GAME_MODEL)
+    @validate_payload(NEWGAME_VALIDATOR)
     def put(self):
         """Add a new game"""
         try:
-            game = game_put(payload=request.json)
+            game = db_tag_new_game(game_put(payload=request.json))
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
+        game["version"] = 0
+        GAME_CACHE.put(game)
+        db_append_event(game["id"], 0, game=game, previous=None, kind="PUT /games")
+
         return jsonify(game)
 
 
+@GAMES_NAMESPACE.route("/bulk")
+class GamesBulk(Resource):
+    @GAMES_NAMESPACE.doc(
+        responses={
+            200: "OK",
+            400: "Invalid Argument"
+        }
+    )
+    @GAMES_NAMESPACE.expect(NEWGAMES_MODEL)
+    @validate_payload(NEWGAMES_VALIDATOR)
+    def put(self):
+        """Add <nb_games> new games of the same players and roles"""
+        try:
+            game_ids = games_bulk_put(payload=request.json)
+        except AvalonBGError as error:
+            raise HTTPError(str(error), status_code=400) from error
+
+        return jsonify({"games": game_ids})
+
+
+@GAMES_NAMESPACE.route("/simulations")
+class GamesSimulations(Resource):
+    @GAMES_NAMESPACE.doc(
+        responses={
+            200: "OK",
+            400: "Invalid Argument"
+        }
+    )
+    @GAMES_NAMESPACE.expect(SIMULATION_MODEL)
+    @validate_payload(SIMULATION_VALIDATOR)
+    def post(self):
+        """Simulate games and return the win rates per number of players and roles"""
+        payload = request.json
+        nb_games = payload["nb_games"] * len(payload["nb_players"]) * len(payload["role_sets"])
+        if nb_games > MAX_SIMULATED_GAMES:
+            raise HTTPError("At most {} games can be simulated at once!".format(MAX_SIMULATED_GAMES), status_code=400)
+        if payload.get("store") and nb_games > MAX_STORED_GAMES:
+            raise HTTPError("At most {} simulated games can be stored at once!".format(MAX_STORED_GAMES), status_code=400)
+
+        simulation = games_simulate(
+            nb_games=payload["nb_games"],
+            nb_players=payload["nb_players"],
+            role_sets=payload["role_sets"],
+            strategy={key: payload[key] for key in DEFAULT_STRATEGY if key in payload},
+            seed=payload.get("seed"),
+            store=payload.get("store", False)
+        )
+
+        return jsonify(simulation)
+
+
 @GAMES_NAMESPACE.route("/<string:game_id>")
 class GamesGamesId(Resource):
+    @GAMES_NAMESPACE.doc(
+        responses={
+            200: "OK",
+            304: "Not Modified",
+            400: "Invalid Argument"
+        },
+        params=FIELDS_PARAMS
+    )
+    def get(self, game_id):
+        """Fetch the game <game_id> (from the archive if it is completed and archived)"""
+        try:
+            field_names = request_fields()
+            version = db_get_game_version(game_id=game_id)
+        except AvalonBGError as error:
+            game = GAME_ARCHIVE.get(game_id)
+            if game is None:
+                raise HTTPError(str(error), status_code=400) from error
+            return versioned_response(
+                project(game, field_names), game_etag(game_id, game["version"], *fields_etag(field_names))
+            )
+
+        try:
+            etag = game_etag(game_id, version, *fields_etag(field_names))
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+            # the cache holds whole games: they are projected once read
+            game = GAME_CACHE.get(game_id=game_id, version=version)
+        except AvalonBGError as error:
+            raise HTTPError(str(error), status_code=400) from error
+
+        return versioned_response(project(game, field_names), etag)
+
+
+@GAMES_NAMESPACE.route("/<string:game_id>/players")
+class GamesPlayers(Resource):
     @GAMES_NAMESPACE.doc(
         responses={
             200: "OK",
             400: "Invalid Argument"
+        },
+        params=FIELDS_PARAMS
+    )
+    def get(self, game_id):
+        """Fetch the players of the game <game_id>"""
+        try:
+            players = project(db_get_game_rows(table_name="players", game_id=game_id), request_fields())
+        except AvalonBGError as error:
+            raise HTTPError(str(error), status_code=400) from error
+
+        return jsonify(players)
+
+
+@GAMES_NAMESPACE.route("/<string:game_id>/events")
+class GamesEvents(Resource):
+    @GAMES_NAMESPACE.doc(
+        responses={
+            200: "OK",
+            304: "Not Modified",
+            400: "Invalid Argument"
+        },
+        params=EVENTS_PARAMS
+    )
+    def get(self, game_id):
+        """Fetch the events of the game <game_id> since a version"""
+        since = request.args.get("since")
+        try:
+            if since is not None and not since.lstrip("-").isdigit():
+                raise AvalonBGError("'since' should be an integer!")
+            version, events = game_events_since(game_id, since=None if since is None else int(since))
+        except AvalonBGError as error:
+            raise HTTPError(str(error), status_code=400) from error
+
+        return versioned_response(
+            {"version": version, "events": events}, game_etag(game_id, version, "events", since)
+        )
+
+
+@GAMES_NAMESPACE.route("/<string:game_id>/subscribe")
+class GamesSubscribe(Resource):
+    @GAMES_NAMESPACE.doc(
+        responses={
+            200: "OK (text/event-stream)",
+            400: "Invalid Argument",
+            503: "Too many subscribers on this worker (each one holds a thread of -server production, "
+                 "see -max_subscribers; -server asgi has no limit)"
         }
     )
     def get(self, game_id):
-        """Fetch the game <game_id>"""
+        """Stream the game <game_id>, then each of its updates, as server-sent events"""
         try:
-            game = db_get_game(game_id=game_id)
+            db_get_game_version(game_id=game_id)
+            subscriber = GAME_FEED_HUB.subscribe(game_id)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
+        except TooManySubscribersError as error:
+            return retry_later(error, SUBSCRIBE_RETRY_AFTER)
 
-        return jsonify(game)
+        try:
+            # read after subscribing so that no update is missed
+            game = GAME_CACHE.get(game_id=game_id, version=db_get_game_version(game_id=game_id))
+        except AvalonBGError as error:
+            GAME_FEED_HUB.unsubscribe(game_id, subscriber)
+            raise HTTPError(str(error), status_code=400) from error
+
+        # the stream lasts as long as the game, its connection goes back to the pool now
+        db_checkin()
+
+        response = Response(
+            stream_with_context(game_events(game_id, game, subscriber, heartbeat=SUBSCRIBE_HEARTBEAT)),
+            mimetype="text/event-stream"
+        )
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        # the subscription ends with the response, even when it is closed before its first event (HEAD, client
+        # gone), or with the request when the response is replaced by an error
+        response.call_on_close(partial(GAME_FEED_HUB.unsubscribe, game_id, subscriber))
+        g.subscription = (game_id, subscriber)
+
+        return response
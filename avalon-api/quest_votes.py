@@ -0,0 +1,230 @@
+"""This module contains the votes of the quests used in the RESTful web service of Avalon.
+A vote is one atomic update of the quest, so that the players of a quest can vote at the same time
+without losing votes, and the game is updated by compare-and-swap when the last vote ends the quest."""
+
+import random
+import time
+
+import rethinkdb as r
+
+from avalonBG.exception import AvalonBGError
+from avalonBG.quests import check_quest_number, quest_put
+
+from db_pool import RDB
+from game_cache import game_exists, game_query
+
+
+# attempts to update a game changed by concurrent requests, and first backoff between them (seconds)
+CAS_RETRIES = 8
+CAS_BACKOFF = 0.002
+
+# fields updated after each mutation (game_cache.db_bump_game_version): they don't change the fields read by changes
+BOOKKEEPING_FIELDS = ("version", "status")
+
+CONFLICT = "The document has changed since it was read."
+
+
+class GameConflictError(Exception):
+    """Class GameConflictError related to a game changed by concurrent requests during all the attempts to update it"""
+
+
+def db_compare_and_update(table, ident, changes, retries=CAS_RETRIES):
+    """Update the document <ident> of <table> with changes(document) (a dict, or None to leave it as it is),
+    only if it has not changed since it was read (apart from its BOOKKEEPING_FIELDS). Retry on conflicts, and return
+    the updated document."""
+    for attempt in range(retries):
+        document = RDB.table(table).get(ident).run()
+        if document is None:
+            raise AvalonBGError("Game's id '{}' does not exist!".format(ident))
+
+        update = changes(document)
+        if not update:
+            return document
+
+        expected = {key: value for key, value in document.items() if key not in BOOKKEEPING_FIELDS}
+        result = RDB.table(table).get(ident).update(
+            lambda current: RDB.branch(
+                current.without(*BOOKKEEPING_FIELDS).eq(expected), update, RDB.error(CONFLICT)
+            ),
+            return_changes="always"
+        ).run()
+
+        if not result["errors"]:
+            return result["changes"][0]["new_val"]
+        if result["first_error"] != CONFLICT:
+            raise r.errors.ReqlOpFailedError(result["first_error"])
+
+        time.sleep(random.uniform(0, CAS_BACKOFF * 2 ** attempt))
+
+    raise GameConflictError("Game's id '{}' is updated by other requests, try again!".format(ident))
+
+
+def db_cast_votes(quest_id, quest_number, votes):
+    """Record <votes> (player's id: vote) in the quest <quest_id> in one write, checking atomically that all
+    the players can still vote. Return the quest before and after the votes."""
+    checks = [
+        RDB.row.has_fields("status").not_(),
+        RDB.error("Vote number '{}' is not established!".format(quest_number)),
+        RDB.row["status"].ne(None),
+        RDB.error("Vote number '{}' is finished!".format(quest_number))
+    ]
+    for player_id in votes:
+        checks += [
+            RDB.row["votes"].has_fields(player_id).not_(),
+            RDB.error("Player '{}' is not allowed to vote!".format(player_id)),
+            RDB.row["votes"][player_id].ne(None),
+            RDB.error("Player '{}' has already voted!".format(player_id))
+        ]
+
+    result = RDB.table("quests").get(quest_id).update(
+        RDB.branch(*checks, {"votes": votes}),
+        return_changes="always"
+    ).run()
+
+    if result["errors"]:
+        raise AvalonBGError(result["first_error"])
+
+    change = result["changes"][0]
+    return change["old_val"], change["new_val"]
+
+
+def next_quest_changes(game, quest_number, statuses):
+    """Return the changes of <game> when the quest <quest_number> ends, given the <statuses> of all its quests"""
+    if game["current_quest"] != quest_number:
+        return None
+
+    players = game["players"]
+    changes = {
+        "current_id_player": players[(players.index(game["current_id_player"]) + 1) % len(players)],
+        "nb_quest_unsend": 0,
+        "current_quest": quest_number + 1
+    }
+
+    if statuses.count(False) >= 3:
+        changes["result"] = {"status": False}
+    if statuses.count(True) >= 3:
+        changes["result"] = {"status": True}
+
+    return changes
+
+
+def check_vote_allowed(game, game_id, quest_number):
+    """Raise an AvalonBGError if the quest <quest_number> of <game> cannot be voted"""
+    if not game:
+        raise AvalonBGError("Game's id '{}' does not exist!".format(game_id))
+
+    if game["nb_quest_unsend"] == 5:
+        raise AvalonBGError("Game is over because 5 consecutive laps have been passed: Red team won!")
+
+    if "result" in game:
+        raise AvalonBGError("Game is over!")
+
+    if game["current_quest"] != quest_number:
+        raise AvalonBGError("Only vote number {} is allowed!".format(game["current_quest"]))
+
+
+def check_votes(votes):
+    """Raise an AvalonBGError if a vote of <votes> is not a boolean"""
+    for vote in votes.values():
+        if not isinstance(vote, bool):
+            raise AvalonBGError("Vote should be a boolean!")
+
+
+def end_quest(game, quest_number, old_quest, quest):
+    """End the quest <quest_number> of <game> if the votes which changed <old_quest> into <quest> completed it.
+    Return the quest and whether it ended."""
+    # only the write which completes the votes (one per quest, the updates being atomic) ends the quest
+    votes = list(quest["votes"].values())
+    if None in votes or None not in old_quest["votes"].values():
+        return quest, False
+
+    status = not votes.count(False) >= quest["nb_votes_to_fail"]
+    quest = RDB.table("quests").get(quest["id"]).update(
+        {"status": status}, return_changes="always"
+    ).run()["changes"][0]["new_val"]
+
+    statuses = [
+        other.get("status") for other in RDB.table("quests").get_all(RDB.args(game["quests"])).run()
+    ]
+    try:
+        db_compare_and_update(
+            "games", game["id"], lambda current: next_quest_changes(current, quest_number, statuses)
+        )
+    except GameConflictError:
+        # the game was not advanced: the quest is reopened, without the votes of this write, so that they can be
+        # sent again (nobody else can vote meanwhile, all the votes being recorded)
+        RDB.table("quests").get(quest["id"]).update({
+            "status": None,
+            "votes": {player_id: None for player_id, vote in old_quest["votes"].items() if vote is None}
+        }).run()
+        raise
+
+    return quest, True
+
+
+def quest_post(payload, game_id, quest_number):
+    """Same as avalonBG.quests.quest_post, safe for the concurrent votes of the players of the quest"""
+    check_quest_number(quest_number=quest_number)
+
+    game = RDB.table("games").get(game_id).run()
+    check_vote_allowed(game, game_id, quest_number)
+
+    if len(payload) != 1:
+        raise AvalonBGError("Only one vote allowed!")
+    check_votes(payload)
+
+    old_quest, quest = db_cast_votes(game["quests"][quest_number], quest_number, payload)
+
+    return end_quest(game, quest_number, old_quest, quest)[0]
+
+
+def check_next_team(game, quest_number, votes, next_team):
+    """Raise an AvalonBGError if <next_team> cannot be sent once <votes> are recorded, before recording them"""
+    if quest_number == 4:
+        raise AvalonBGError("Quest number '{}' is the last one!".format(quest_number))
+
+    quest_id, next_quest_id = game["quests"][quest_number], game["quests"][quest_number + 1]
+    quests = {quest["id"]: quest for quest in RDB.table("quests").get_all(quest_id, next_quest_id).run()}
+    quest, next_quest = quests[quest_id], quests[next_quest_id]
+
+    missing = [player_id for player_id, vote in (quest.get("votes") or {}).items() if vote is None]
+    if set(missing) - set(votes):
+        raise AvalonBGError("The next team can only be sent with the last votes of the quest!")
+
+    for player_id in next_team:
+        if player_id not in game["players"]:
+            raise AvalonBGError("Player '{}' is not in this game!".format(player_id))
+
+    if len(set(next_team)) != next_quest["nb_players_to_send"]:
+        raise AvalonBGError("Quest number '{}' needs '{}' votes!".format(
+            quest_number + 1, next_quest["nb_players_to_send"]
+        ))
+
+
+def quest_votes_post(payload, game_id, quest_number):
+    """Record all the votes of the quest <quest_number> of the game <game_id> at once (payload 'votes') and,
+    if they end the quest without ending the game, send the team of the next quest (payload 'next_team').
+    Return the updated game with its players and quests."""
+    check_quest_number(quest_number=quest_number)
+
+    game = RDB.table("games").get(game_id).run()
+    check_vote_allowed(game, game_id, quest_number)
+
+    votes = payload["votes"]
+    if not votes:
+        raise AvalonBGError("At least one vote is required!")
+    check_votes(votes)
+
+    next_team = payload.get("next_team")
+    if next_team is not None:
+        check_next_team(game, quest_number, votes, next_team)
+
+    old_quest, quest = db_cast_votes(game["quests"][quest_number], quest_number, votes)
+    ended = end_quest(game, quest_number, old_quest, quest)[1]
+
+    if ended and next_team is not None:
+        game_ended = RDB.table("games").get(game_id).has_fields("result").run()
+        if not game_ended:
+            quest_put(payload=next_team, game_id=game_id, quest_number=quest_number + 1)
+
+    return game_exists(game_id, game_query(game_id).run())
@@ -0,0 +1,132 @@
+"""This module contains the tests of the concurrent votes of a quest, on the in-memory and SQLite storage engines.
+
+    python -m unittest quest_votes_test
+"""
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import quest_votes
+from api import APP
+from db_pool import DB_POOL, RDB
+from storage import create_engine
+
+
+NB_PLAYERS = 10
+
+# games whose first quest is voted by all its players at the same time
+NB_ROUNDS = 20
+
+# seconds between two switches of the threads holding the GIL: short, so that the requests interleave
+SWITCH_INTERVAL = 1e-6
+
+
+class ConcurrentVotesTest(unittest.TestCase):
+    """Votes of the players of a quest sent at the same time (memory engine)"""
+
+    engine_name = "memory"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        DB_POOL.configure(
+            engine=create_engine(cls.engine_name, sqlite_path=Path(cls.tmp_dir, "avalon.db").as_posix()),
+            max_size=NB_PLAYERS + 2
+        )
+        cls.client = APP.test_client()
+        cls.client.put("/restart_db", json=["games", "players", "quests"])
+
+        cls.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(SWITCH_INTERVAL)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.setswitchinterval(cls.switch_interval)
+        DB_POOL.close()
+        shutil.rmtree(cls.tmp_dir)
+
+    def new_quest(self):
+        """Create a game and send the team of its first quest, return the id of the game and the team"""
+        game = self.client.put("/games", json={
+            "players": [{"name": "player{}".format(index), "avatar_index": index} for index in range(NB_PLAYERS)],
+            "roles": []
+        }).get_json()
+        team = [player["id"] for player in game["players"][:game["quests"][0]["nb_players_to_send"]]]
+        self.assertEqual(self.client.put("/games/{}/quests/0".format(game["id"]), json=team).status_code, 200)
+
+        return game["id"], team
+
+    @staticmethod
+    def vote_together(game_id, team):
+        """Send the vote of each player of <team> from its own thread, all at once, return the status codes"""
+        barrier = threading.Barrier(len(team))
+        statuses = {}
+
+        def vote(player_id):
+            client = APP.test_client()
+            barrier.wait()
+            response = client.post("/games/{}/quests/0".format(game_id), json={player_id: True})
+            statuses[player_id] = response.status_code
+
+        threads = [threading.Thread(target=vote, args=(player_id,)) for player_id in team]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return statuses
+
+    def test_concurrent_votes(self):
+        for _ in range(NB_ROUNDS):
+            game_id, team = self.new_quest()
+            with mock.patch("quest_votes.db_compare_and_update", wraps=quest_votes.db_compare_and_update) as update:
+                statuses = self.vote_together(game_id, team)
+
+            self.assertEqual(set(statuses.values()), {200})
+            # every vote is recorded, the quest ends once
+            quest = self.client.get("/games/{}/quests/0".format(game_id)).get_json()
+            self.assertEqual(quest["votes"], {player_id: True for player_id in team})
+            self.assertIs(quest["status"], True)
+            self.assertEqual(update.call_count, 1)
+            self.assertEqual(self.client.get("/games/{}".format(game_id)).get_json()["current_quest"], 1)
+
+    def test_stale_game(self):
+        game_id, team = self.new_quest()
+        next_quest_changes = quest_votes.next_quest_changes
+
+        def changed_meanwhile(game, quest_number, statuses):
+            # another request updates the game between each read and its compare-and-swap
+            RDB.table("games").get(game["id"]).update({"changed_at": time.perf_counter()}).run()
+            return next_quest_changes(game, quest_number, statuses)
+
+        for player_id in team[:-1]:
+            self.client.post("/games/{}/quests/0".format(game_id), json={player_id: True})
+        with mock.patch("quest_votes.next_quest_changes", changed_meanwhile):
+            response = self.client.post("/games/{}/quests/0".format(game_id), json={team[-1]: True})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get("/games/{}".format(game_id)).get_json()["current_quest"], 0)
+
+        # the vote refused by the conflict is sent again: it ends the quest and the game moves on
+        response = self.client.post("/games/{}/quests/0".format(game_id), json={team[-1]: True})
+        self.assertEqual(response.status_code, 200)
+        quest = self.client.get("/games/{}/quests/0".format(game_id)).get_json()
+        self.assertEqual(quest["votes"], {player_id: True for player_id in team})
+        self.assertIs(quest["status"], True)
+        self.assertEqual(self.client.get("/games/{}".format(game_id)).get_json()["current_quest"], 1)
+
+
+class SQLiteConcurrentVotesTest(ConcurrentVotesTest):
+    """Votes of the players of a quest sent at the same time (SQLite engine)"""
+
+    engine_name = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
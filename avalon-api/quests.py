@@ -1,55 +1,77 @@
 from flask import Blueprint, jsonify, request
 from flask_cors import CORS
-from flask_restx import Namespace, Resource, fields
+from flask_restx import Namespace, Resource
 
-from avalonBG.db_utils import db_connect, db_get_table
 from avalonBG.exception import AvalonBGError
-from avalonBG.quests import quest_delete, quest_get, quest_post, quest_put, quest_unsend
+from avalonBG.quests import quest_delete, quest_put, quest_unsend
 
 from api_utils import HTTPError
+from db_indexes import db_get_game_rows, game_rows_selection
+from db_pool import db_checkin, db_checkout
+from game_cache import DELTA_PARAMS, cached_quest_get, db_get_game_version, game_etag, game_mutation, \
+                       mutation_response, not_modified, versioned_response
+from pagination import LISTING_PARAMS, table_response
+from projection import FIELDS_PARAMS, fields_etag, project, request_fields
+from quest_votes import GameConflictError, quest_post, quest_votes_post
+from validation import PayloadValidator, validate_payload
 
 # pylint: disable=R0201
 
 
 QUESTS_BLUEPRINT = Blueprint("quests", __name__)
-CORS(QUESTS_BLUEPRINT)
+CORS(QUESTS_BLUEPRINT, expose_headers=["ETag", "X-Game-Version"])
 
-QUESTS_BLUEPRINT.before_request(db_connect)
+QUESTS_BLUEPRINT.before_request(db_checkout)
+QUESTS_BLUEPRINT.teardown_request(db_checkin)
 
 
 QUESTS_NAMESPACE = Namespace(name="quests", description="Quests operations", path="/games")
 
 
+QUEST_VOTES_MODEL = QUESTS_NAMESPACE.schema_model(
+    "QuestVotes",
+    {
+        "type": "object",
+        "description": "Id of the player mapped to its vote (true: success, false: fail)",
+        "minProperties": 1,
+        "maxProperties": 1,
+        "additionalProperties": {"type": "boolean"},
+        "example": {"94ee4546-9358-4a68-a155-01876a7c583f": True}
+    }
+)
+
+QUEST_VOTES_VALIDATOR = PayloadValidator(QUEST_VOTES_MODEL)
 
-wild = fields.Wildcard(fields.Integer)
-from collections import OrderedDict
-mod = OrderedDict()
-mod["*"] = wild
-quests_send_post = QUESTS_NAMESPACE.model(
-    "Quests send post",
-    mod
+QUEST_TEAM_MODEL = QUESTS_NAMESPACE.schema_model(
+    "QuestTeam",
+    {
+        "type": "array",
+        "description": "Ids of the players sent on the quest",
+        "items": {"type": "string", "minLength": 1},
+        "minItems": 2,
+        "maxItems": 5,
+        "uniqueItems": True,
+        "example": ["94ee4546-9358-4a68-a155-01876a7c583f", "2669a9fe-37c4-4139-ab78-8e3f0d0607d0"]
+    }
 )
 
-quests_send_post = QUESTS_NAMESPACE.model(
-    "Quests send post",
+QUEST_TEAM_VALIDATOR = PayloadValidator(QUEST_TEAM_MODEL)
+
+QUEST_BALLOT_MODEL = QUESTS_NAMESPACE.schema_model(
+    "QuestBallot",
     {
-        "": fields.Boolean(
-            required=True,
-            description="Vote of the player"
-        )
+        "type": "object",
+        "description": "Votes of several players of the quest and, optionally, the team of the next quest",
+        "required": ["votes"],
+        "properties": {
+            "votes": dict(QUEST_VOTES_MODEL.__schema__, maxProperties=5),
+            "next_team": QUEST_TEAM_MODEL.__schema__
+        },
+        "additionalProperties": False
     }
 )
 
-# quests_send_put = QUESTS_NAMESPACE.model(
-#     "Quests send put",
-#     [
-#         fields.String(
-#             required=True,
-#             description="Id of the player",
-#             example="94ee4546-9358-4a68-a155-01876a7c583f"
-#         )
-#     ]
-# )
+QUEST_BALLOT_VALIDATOR = PayloadValidator(QUEST_BALLOT_MODEL)
 
 
 @QUESTS_NAMESPACE.route("/quests")
@@ -59,18 +81,47 @@ class Quests(Resource):
             200: "OK",
             400: "Invalid Argument"
         },
-        params={
-            "game_id": "Specify the Id associated with the game"
-        }
+        params=dict(
+            LISTING_PARAMS,
+            game_id="Specify the Id associated with the game",
+            **FIELDS_PARAMS
+        )
     )
     def get(self):
         """Fetch the quests"""
+        game_id = request.args.get("game_id")
         try:
-            table_quests = db_get_table(table_name="quests")
+            response = table_response(
+                table_name="quests",
+                selection=game_rows_selection("quests", game_id) if game_id is not None else None,
+                field_names=request_fields()
+            )
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(table_quests)
+        return response
+
+
+@QUESTS_NAMESPACE.route("/<string:game_id>/quests")
+class GamesQuests(Resource):
+    @QUESTS_NAMESPACE.doc(
+        responses={
+            200: "OK",
+            400: "Invalid Argument"
+        },
+        params=dict(
+            FIELDS_PARAMS,
+            game_id="Specify the Id associated with the game"
+        )
+    )
+    def get(self, game_id):
+        """Fetch the quests of the game <game_id>, in their order"""
+        try:
+            quests = project(db_get_game_rows(table_name="quests", game_id=game_id), request_fields())
+        except AvalonBGError as error:
+            raise HTTPError(str(error), status_code=400) from error
+
+        return jsonify(quests)
 
 
 @QUESTS_NAMESPACE.route("/<string:game_id>/quest_unsend")
@@ -80,18 +131,21 @@ class QuestsUnsend(Resource):
             200: "OK",
             400: "Invalid Argument"
         },
-        params={
-            "game_id": "Specify the Id associated with the game"
-        }
+        params=dict(
+            DELTA_PARAMS,
+            game_id="Specify the Id associated with the game"
+        )
     )
     def post(self, game_id):
         """This function sends new quest of the game <game_id>"""
         try:
-            game_updated = quest_unsend(game_id=game_id)
+            with game_mutation(game_id):
+                game_updated = quest_unsend(game_id=game_id)
+            response = mutation_response(game_id, game_updated, game=game_updated)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(game_updated)
+        return response
 
 
 @QUESTS_NAMESPACE.route("/<string:game_id>/quests/<int:quest_number>")
@@ -101,89 +155,145 @@ class QuestsSend(Resource):
             200: "OK",
             400: "Invalid Argument"
         },
-        params={
-            "game_id": "Specify the Id associated with the game",
-            "quest_number": "Specify the number of the quest (between 0 and 4)"
-        }
+        params=dict(
+            DELTA_PARAMS,
+            game_id="Specify the Id associated with the game",
+            quest_number="Specify the number of the quest (between 0 and 4)"
+        )
     )
     def delete(self, game_id, quest_number):
         """This function sends new quest of the game <game_id>"""
         try:
-            game_updated = quest_delete(
-                game_id=game_id,
-                quest_number=quest_number
-            )
+            with game_mutation(game_id):
+                game_updated = quest_delete(
+                    game_id=game_id,
+                    quest_number=quest_number
+                )
+            response = mutation_response(game_id, game_updated)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(game_updated)
+        return response
 
     @QUESTS_NAMESPACE.doc(
         responses={
             200: "OK",
             400: "Invalid Argument"
         },
-        params={
-            "game_id": "Specify the Id associated with the game",
-            "quest_number": "Specify the number of the quest (between 0 and 4)"
-        }
+        params=dict(
+            FIELDS_PARAMS,
+            game_id="Specify the Id associated with the game",
+            quest_number="Specify the number of the quest (between 0 and 4)"
+        )
     )
     def get(self, game_id, quest_number):
         """This function sends new quest of the game <game_id>"""
         try:
-            game_updated = quest_get(
+            field_names = request_fields()
+            version = db_get_game_version(game_id=game_id)
+            etag = game_etag(game_id, version, "quests", quest_number, *fields_etag(field_names))
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+            quest = cached_quest_get(
                 game_id=game_id,
-                quest_number=quest_number
+                quest_number=quest_number,
+                version=version
             )
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
 
-        return jsonify(game_updated)
+        return versioned_response(project(quest, field_names), etag)
 
     @QUESTS_NAMESPACE.doc(
         responses={
             200: "OK",
-            400: "Invalid Argument"
+            400: "Invalid Argument",
+            409: "Conflict"
         },
-        params={
-            "game_id": "Specify the Id associated with the game",
-            "quest_number": "Specify the number of the quest (between 0 and 4)"
-        }
+        params=dict(
+            DELTA_PARAMS,
+            game_id="Specify the Id associated with the game",
+            quest_number="Specify the number of the quest (between 0 and 4)"
+        )
     )
-    @QUESTS_NAMESPACE.expect(quests_send_post)
+    @QUESTS_NAMESPACE.expect(QUEST_VOTES_MODEL)
+    @validate_payload(QUEST_VOTES_VALIDATOR)
     def post(self, game_id, quest_number):
         """This function sends new quest of the game <game_id>"""
         try:
-            game_updated = quest_post(
-                payload=request.json,
-                game_id=game_id,
-                quest_number=quest_number
-            )
+            with game_mutation(game_id):
+                game_updated = quest_post(
+                    payload=request.json,
+                    game_id=game_id,
+                    quest_number=quest_number
+                )
+            response = mutation_response(game_id, game_updated)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
+        except GameConflictError as error:
+            raise HTTPError(str(error), status_code=409) from error
 
-        return jsonify(game_updated)
+        return response
 
     @QUESTS_NAMESPACE.doc(
         responses={
             200: "OK",
             400: "Invalid Argument"
         },
-        params={
-            "game_id": "Specify the Id associated with the game",
-            "quest_number": "Specify the number of the quest (between 0 and 4)"
-        }
+        params=dict(
+            DELTA_PARAMS,
+            game_id="Specify the Id associated with the game",
+            quest_number="Specify the number of the quest (between 0 and 4)"
+        )
     )
-    # @QUESTS_NAMESPACE.expect(quests_send_put)
+    @QUESTS_NAMESPACE.expect(QUEST_TEAM_MODEL)
+    @validate_payload(QUEST_TEAM_VALIDATOR)
     def put(self, game_id, quest_number):
         """This function sends new quest of the game <game_id>"""
         try:
-            game_updated = quest_put(
-                payload=request.json,
-                game_id=game_id,
-                quest_number=quest_number
-            )
+            with game_mutation(game_id):
+                game_updated = quest_put(
+                    payload=request.json,
+                    game_id=game_id,
+                    quest_number=quest_number
+                )
+            response = mutation_response(game_id, game_updated)
+        except AvalonBGError as error:
+            raise HTTPError(str(error), status_code=400) from error
+
+        return response
+
+
+@QUESTS_NAMESPACE.route("/<string:game_id>/quests/<int:quest_number>/votes")
+class QuestsVotes(Resource):
+    @QUESTS_NAMESPACE.doc(
+        responses={
+            200: "OK",
+            400: "Invalid Argument",
+            409: "Conflict"
+        },
+        params=dict(
+            DELTA_PARAMS,
+            game_id="Specify the Id associated with the game",
+            quest_number="Specify the number of the quest (between 0 and 4)"
+        )
+    )
+    @QUESTS_NAMESPACE.expect(QUEST_BALLOT_MODEL)
+    @validate_payload(QUEST_BALLOT_VALIDATOR)
+    def post(self, game_id, quest_number):
+        """Record several votes of the quest <quest_number> of the game <game_id> (and send the next team)"""
+        try:
+            with game_mutation(game_id):
+                game_updated = quest_votes_post(
+                    payload=request.json,
+                    game_id=game_id,
+                    quest_number=quest_number
+                )
+            response = mutation_response(game_id, game_updated, game=game_updated)
         except AvalonBGError as error:
             raise HTTPError(str(error), status_code=400) from error
+        except GameConflictError as error:
+            raise HTTPError(str(error), status_code=409) from error
 
-        return jsonify(game_updated)
+        return response
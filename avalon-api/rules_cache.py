@@ -0,0 +1,116 @@
+"""This module contains the in-process cache of the rules used in the RESTful web service of Avalon.
+The rules are read from the JSON file packaged with avalonBG (not from the database), which doesn't change while
+the server runs: they are loaded once per process. The new games are checked against them and created with them
+(game_put), instead of avalonBG.games.game_put which reads the file for every game."""
+
+import hashlib
+import json
+import random
+import threading
+
+from avalonBG.db_utils import resolve_key_id
+from avalonBG.exception import AvalonBGError
+from avalonBG.games import roles_and_players
+from avalonBG.rules import get_rules
+
+from db_pool import RDB
+
+
+RED_ROLES = ("mordred", "morgan", "oberon")
+BLUE_ROLES = ("perceval",)
+
+
+class RulesCache:
+    """Rules loaded once per process, with their ETag"""
+
+    def __init__(self):
+        self._rules = None
+        self._etag = None
+        self._lock = threading.Lock()
+
+    def get(self, nb_player=None):
+        """Return the rules (of the games with <nb_player> players if specified) and their ETag"""
+        rules, etag = self._rules, self._etag
+        if rules is None:
+            with self._lock:
+                if self._rules is None:
+                    self._rules = get_rules()
+                    self._etag = hashlib.sha256(json.dumps(self._rules, sort_keys=True).encode()).hexdigest()
+                rules, etag = self._rules, self._etag
+
+        if nb_player is None:
+            return rules, etag
+
+        if str(nb_player) not in rules:
+            raise AvalonBGError("Player number should be between {} and {}!".format(
+                min(rules, key=int), max(rules, key=int))
+            )
+
+        return rules[str(nb_player)], "{}-{}".format(etag, nb_player)
+
+
+RULES_CACHE = RulesCache()
+
+
+def check_roles(nb_players, roles):
+    """Raise an AvalonBGError if the game of <nb_players> players with <roles> cannot be created (as game_put)"""
+    rules, _ = RULES_CACHE.get(nb_player=nb_players)
+
+    if len(roles) != len(set(roles)):
+        raise AvalonBGError("Players role should be unique!")
+
+    for role in roles:
+        if role not in RED_ROLES + BLUE_ROLES:
+            raise AvalonBGError("Players role should be oberon, morgan, mordred or perceval!")
+
+    if "morgan" in roles and "perceval" not in roles:
+        raise AvalonBGError("'morgan' is selected but 'perceval' is not!")
+
+    if "perceval" in roles and "morgan" not in roles:
+        raise AvalonBGError("'perceval' is selected but 'morgan' is not!")
+
+    if len([role for role in roles if role in RED_ROLES]) > rules["red"]:
+        raise AvalonBGError("Too many red roles chosen!")
+
+
+def check_new_game(players, roles):
+    """Raise an AvalonBGError if a game of <players> with <roles> cannot be created (as game_put, in its order)"""
+    RULES_CACHE.get(nb_player=len(players))
+
+    names = [player["name"] for player in players]
+    if len(names) != len(set(names)):
+        raise AvalonBGError("Players name should be unique!")
+    if any(not name.strip() for name in names):
+        raise AvalonBGError("Players' name cannot be empty!")
+
+    check_roles(len(players), roles)
+
+
+def game_put(payload):
+    """Same as avalonBG.games.game_put (the payload being checked by NEWGAME_VALIDATOR), with the cached rules:
+    the players get their roles from avalonBG.games.roles_and_players, then the players, quests and game are
+    inserted as game_put does. Return the game with its players and quests."""
+    check_new_game(payload["players"], payload["roles"])
+    game_rules, _ = RULES_CACHE.get(nb_player=len(payload["players"]))
+
+    players = roles_and_players(dict_names_roles=payload, max_red=game_rules["red"], max_blue=game_rules["blue"])
+    player_ids = RDB.table("players").insert(players).run()["generated_keys"]
+    # copies: the rules of the cache are shared by the requests
+    quest_ids = RDB.table("quests").insert([dict(quest) for quest in game_rules["quests"]]).run()["generated_keys"]
+
+    game = RDB.table("games").insert(
+        {
+            "players": player_ids,
+            "quests": quest_ids,
+            "current_id_player": random.choice(player_ids),
+            "current_quest": 0,
+            "nb_quest_unsend": 0
+        },
+        return_changes=True
+    ).run()["changes"][0]["new_val"]
+    game.update(
+        players=resolve_key_id(table="players", list_id=player_ids),
+        quests=resolve_key_id(table="quests", list_id=quest_ids)
+    )
+
+    return game
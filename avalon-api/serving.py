@@ -0,0 +1,65 @@
+"""This module contains the production server of the RESTful web service of Avalon"""
+
+from gunicorn.app.base import BaseApplication
+
+from archive import GAME_ARCHIVER
+from db_pool import DB_POOL
+
+
+def post_fork(server, worker):
+    """Drop the connections inherited from the master process and start the archiver of the worker"""
+    # pylint: disable=W0613
+    DB_POOL.close()
+    GAME_ARCHIVER.start()
+
+
+class AvalonServer(BaseApplication):
+    """Multi-process server (gunicorn) serving the Avalon application"""
+
+    # pylint: disable=W0223
+
+    def __init__(self, app, options=None):
+        self.application = app
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key.lower(), value)
+
+        self.cfg.set("post_fork", post_fork)
+
+    def load(self):
+        return self.application
+
+
+def run_production(app, host, port, workers, threads, keepalive, graceful_timeout):
+    """Serve the application with <workers> processes of <threads> threads each"""
+    options = {
+        "bind": "{}:{}".format(host, port),
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread",
+        "keepalive": keepalive,
+        "graceful_timeout": graceful_timeout,
+        "accesslog": "-",
+        "errorlog": "-"
+    }
+
+    AvalonServer(app, options).run()
+
+
+def run_asgi(app, host, port, workers, keepalive, graceful_timeout):
+    """Serve the ASGI application with <workers> processes running an event loop each (uvicorn)"""
+    options = {
+        "bind": "{}:{}".format(host, port),
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "keepalive": keepalive,
+        "graceful_timeout": graceful_timeout,
+        "accesslog": "-",
+        "errorlog": "-"
+    }
+
+    AvalonServer(app, options).run()
@@ -0,0 +1,304 @@
+"""This module contains the sharding of the RESTful web service of Avalon by game: a consistent hash ring over
+the nodes gives each game an owner node, which serves all the requests of the game (so its caches and feeds live
+in one place). A misrouted request is forwarded to the owner, or redirected to it (307). The nodes share the
+database: when nodes join or leave (PUT /nodes, with the admin token of the nodes), the games which change owner
+are read again from it by their new owner, and the old owner forgets them."""
+
+import bisect
+import hashlib
+import hmac
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import rethinkdb as r
+from flask import Blueprint, Response, jsonify, redirect, request
+from rethinkdb.ast import Repl
+
+from api_utils import HTTPError
+from db_pool import DB_POOL, RDB
+from game_cache import GAME_CACHE
+
+
+LOG = logging.getLogger(__name__)
+
+# table of the node list PUT on /nodes (shared by the nodes, like the games)
+NODES_TABLE = "nodes"
+NODES_KEY = "ring"
+
+# seconds between two reads of the node list by a worker
+NODES_REFRESH_INTERVAL = 5.0
+
+# points of each node on the ring (the more, the more even the shares of the games)
+VIRTUAL_NODES = 64
+
+SHARDING_MODES = ("forward", "redirect")
+
+# header of the forwarded requests: they are served by the node which receives them
+FORWARDED_HEADER = "X-Avalon-Forwarded"
+
+# seconds to wait for the owner of a forwarded request
+FORWARD_TIMEOUT = 10.0
+
+# schemes of the node urls
+NODE_SCHEMES = ("http", "https")
+
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+    "transfer-encoding", "upgrade", "content-length", "host"
+}
+
+# streamed responses cannot be forwarded (they would be buffered): they are always redirected
+STREAMED_SUFFIXES = ("/subscribe",)
+
+
+def ring_hash(key):
+    """Return the position of <key> on the ring"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring: adding or removing a node only moves the games of the neighbouring points"""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted(
+            (ring_hash("{}#{}".format(node, index)), node) for node in self.nodes for index in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        """Return the node owning <key>"""
+        index = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+def is_node_url(url):
+    """Return whether <url> is the url of a node: http(s)://host[:port], nothing else"""
+    try:
+        parts = urllib.parse.urlsplit(url)
+        parts.port  # pylint: disable=W0104
+    except ValueError:
+        return False
+
+    return parts.scheme in NODE_SCHEMES and bool(parts.hostname) and parts.path in ("", "/") \
+        and not (parts.query or parts.fragment or parts.username or parts.password)
+
+
+class ShardRouter:
+    """Owner node of each game, for the node <node_url> among <nodes> (sharding is off without nodes).
+    The node list PUT on any node with the admin <token> is stored in the database, and read again by every
+    worker every <refresh_interval> seconds."""
+
+    def __init__(self, node_url=None, nodes=(), mode="forward", refresh_interval=NODES_REFRESH_INTERVAL,
+                 token=None):
+        self.node_url = node_url
+        self.mode = mode
+        self.refresh_interval = refresh_interval
+        self.token = token
+        self.ring = None
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+        self.set_nodes(nodes)
+
+    def configure(self, node_url, nodes, mode="forward", refresh_interval=NODES_REFRESH_INTERVAL, token=None):
+        """Change the url of this node, the node list, the routing of the misrouted requests and the admin token
+        of PUT /nodes (None: the node list cannot be PUT)"""
+        if mode not in SHARDING_MODES:
+            raise ValueError("Unknown sharding mode '{}'!".format(mode))
+        if nodes and not node_url:
+            raise ValueError("The url of this node is needed to shard the games!")
+        for url in [node_url] + list(nodes) if node_url else nodes:
+            if not is_node_url(url):
+                raise ValueError("'{}' is not the url of a node (http(s)://host[:port])!".format(url))
+
+        self.node_url = node_url.rstrip("/") if node_url else None
+        self.mode = mode
+        self.refresh_interval = refresh_interval
+        self.token = token or None
+        self.set_nodes(nodes)
+
+    def authorized(self, authorization):
+        """Return whether the header Authorization <authorization> carries the admin token"""
+        if self.token is None or not authorization:
+            return False
+
+        scheme, _, token = authorization.partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self.token.encode())
+
+    @property
+    def enabled(self):
+        return self.ring is not None
+
+    @property
+    def nodes(self):
+        return self.ring.nodes if self.ring is not None else []
+
+    def set_nodes(self, nodes):
+        """Change the node list (nodes joining or leaving) and forget the games this node doesn't own anymore:
+        their new owner reads them from the database. The requests are only forwarded to node urls: the others
+        are ignored."""
+        nodes = sorted({node.rstrip("/") for node in nodes if is_node_url(node)})
+        if nodes == self.nodes:
+            return
+
+        self.ring = HashRing(nodes) if nodes else None
+        GAME_CACHE.retain(self.owns)
+
+    @property
+    def refresh_due(self):
+        return self.node_url is not None and time.monotonic() >= self._next_refresh
+
+    def refresh(self):
+        """Read the node list stored in the database if it has not been read for <refresh_interval> seconds"""
+        if not self.refresh_due:
+            return
+
+        with self._lock:
+            if time.monotonic() < self._next_refresh:
+                return
+            self._next_refresh = time.monotonic() + self.refresh_interval
+
+            connection = DB_POOL.checkout()
+            try:
+                nodes = db_get_nodes(connection)
+            except r.errors.ReqlError as error:
+                LOG.warning("Node list not read: %s", error)
+                nodes = None
+            finally:
+                DB_POOL.checkin(connection)
+
+        if nodes is not None:
+            self.set_nodes(nodes)
+
+    def owner(self, game_id):
+        """Return the url of the node owning the game <game_id>"""
+        return self.ring.owner(game_id) if self.ring is not None else self.node_url
+
+    def owns(self, game_id):
+        """Return whether this node owns the game <game_id> (a node out of the list owns none)"""
+        return self.ring is None or self.ring.owner(game_id) == self.node_url
+
+    def new_game_id(self):
+        """Return the id of a new game owned by this node (created where it is requested, it stays there)"""
+        while True:
+            game_id = str(uuid.uuid4())
+            if self.node_url not in self.nodes or self.owns(game_id):
+                return game_id
+
+    def stats(self):
+        """Return the node list and the routing of the misrouted requests"""
+        return {"node": self.node_url, "nodes": self.nodes, "mode": self.mode}
+
+
+SHARD_ROUTER = ShardRouter()
+
+
+def db_get_nodes(connection=None):
+    """Return the node list stored in the database, or None if no list was PUT"""
+    if NODES_TABLE not in RDB.table_list().run(connection):
+        return None
+
+    document = RDB.table(NODES_TABLE).get(NODES_KEY).run(connection)
+    return document["nodes"] if document is not None else None
+
+
+def db_put_nodes(nodes):
+    """Store the node list in the database, read by all the nodes"""
+    if NODES_TABLE not in RDB.table_list().run():
+        RDB.table_create(NODES_TABLE).run()
+
+    RDB.table(NODES_TABLE).insert({"id": NODES_KEY, "nodes": nodes}, conflict="replace").run()
+
+
+def forward(owner):
+    """Return the response of the node <owner> to the current request"""
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+    headers[FORWARDED_HEADER] = SHARD_ROUTER.node_url
+    forwarded = urllib.request.Request(
+        owner + request.full_path.rstrip("?"),
+        data=request.get_data() or None,
+        headers=headers,
+        method=request.method
+    )
+
+    try:
+        with urllib.request.urlopen(forwarded, timeout=FORWARD_TIMEOUT) as owner_response:
+            status, owner_headers, body = owner_response.status, owner_response.headers, owner_response.read()
+    except urllib.error.HTTPError as error:
+        status, owner_headers, body = error.code, error.headers, error.read()
+    except (urllib.error.URLError, OSError) as error:
+        raise HTTPError("Node {} of the game is unreachable: {}".format(owner, error), status_code=502) from error
+
+    response = Response(body, status=status)
+    for key, value in owner_headers.items():
+        if key.lower() not in HOP_BY_HOP_HEADERS:
+            response.headers[key] = value
+
+    return response
+
+
+def misrouted(game_id, forwarded):
+    """Return the owner of the game <game_id> if the request (<forwarded> by another node or not) should be
+    served there, else None"""
+    if game_id is None or not SHARD_ROUTER.enabled or forwarded:
+        return None
+
+    owner = SHARD_ROUTER.owner(game_id)
+    return owner if owner != SHARD_ROUTER.node_url else None
+
+
+SHARDING_BLUEPRINT = Blueprint("sharding", __name__)
+
+
+@SHARDING_BLUEPRINT.before_app_request
+def route_to_owner():
+    """Forward or redirect the requests of a game owned by another node"""
+    SHARD_ROUTER.refresh()
+
+    owner = misrouted((request.view_args or {}).get("game_id"), FORWARDED_HEADER in request.headers)
+    if owner is None:
+        return None
+
+    if SHARD_ROUTER.mode == "redirect" or request.path.endswith(STREAMED_SUFFIXES):
+        return redirect(owner + request.full_path.rstrip("?"), code=307)
+
+    return forward(owner)
+
+
+@SHARDING_BLUEPRINT.route("/nodes")
+def get_nodes():
+    """Fetch the node list of the sharding"""
+    return jsonify(SHARD_ROUTER.stats())
+
+
+@SHARDING_BLUEPRINT.route("/nodes", methods=["PUT"])
+def put_nodes():
+    """Replace the node list (payload: urls of the nodes), on all the nodes within NODES_REFRESH_INTERVAL seconds.
+    The request needs the admin token of the nodes (Authorization: Bearer <token>)."""
+    if SHARD_ROUTER.token is None:
+        raise HTTPError("The node list cannot be changed on this node (no -nodes_token)!", status_code=403)
+    if not SHARD_ROUTER.authorized(request.headers.get("Authorization")):
+        raise HTTPError("The admin token of the nodes is needed to change the node list!", status_code=401)
+
+    nodes = request.get_json(silent=True)
+    if not isinstance(nodes, list) or not all(isinstance(node, str) and is_node_url(node) for node in nodes):
+        raise HTTPError("Payload should be a list of node urls (http(s)://host[:port])!", status_code=400)
+    if SHARD_ROUTER.node_url is None:
+        raise HTTPError("This node has no url (-node_url): it cannot shard the games!", status_code=400)
+
+    nodes = sorted({node.rstrip("/") for node in nodes})
+    connection = DB_POOL.checkout().repl()
+    try:
+        db_put_nodes(nodes)
+    finally:
+        Repl.clear()
+        DB_POOL.checkin(connection)
+    SHARD_ROUTER.set_nodes(nodes)
+
+    return jsonify(SHARD_ROUTER.stats())
@@ -0,0 +1,362 @@
+"""This module contains the creation of games in batch and their simulation, for balance testing and capacity
+planning (a single game is created by rules_cache.game_put). The roles, teams and votes of all the games are drawn
+at once with NumPy, building the documents of game_put, and the games are written with bulk inserts. The players and
+quests are tagged with the id of their game, and the games with their status and creation time (secondary indexes of
+db_indexes). NumPy is imported by the functions using it: it is the slowest import of the server.
+
+    python simulation.py -games 100000 -nb_players 5 7 10 -role_sets "" oberon perceval,morgan
+"""
+
+import argparse
+import json
+import time
+import uuid
+
+import rethinkdb as r
+
+from avalonBG.exception import AvalonBGError
+
+from db_pool import RDB
+from rules_cache import BLUE_ROLES, RED_ROLES, RULES_CACHE, check_new_game, check_roles
+from sharding import SHARD_ROUTER
+
+
+# documents per insert query
+INSERT_CHUNK_SIZE = 1000
+
+# games drawn at once (bounds the memory of the arrays)
+SIMULATION_CHUNK_SIZE = 100000
+
+# simulated games stored per request of the web service
+MAX_STORED_GAMES = 100000
+
+# behaviour of the simulated players
+DEFAULT_STRATEGY = {
+    # probability that a red player sent on a quest votes for its failure
+    "red_fail_rate": 0.8,
+    # probability that a proposed team is refused (5 refusals in a row: red team wins)
+    "unsend_rate": 0.2,
+    # probability that Merlin keeps out of a team each red player he sees (all but mordred)
+    "merlin_influence": 0.3
+}
+
+
+def game_roles(nb_players, roles):
+    """Return the roles of the players of a game (in no particular order), completed with 'red' and 'blue'"""
+    game_rules, _ = RULES_CACHE.get(nb_player=nb_players)
+    nb_red = len([role for role in roles if role in RED_ROLES])
+    nb_blue = 1 + len([role for role in roles if role in BLUE_ROLES])
+
+    return ["merlin"] + list(roles) + ["red"] * (game_rules["red"] - nb_red) + ["blue"] * (game_rules["blue"] - nb_blue)
+
+
+def draw_roles(rng, nb_games, roles):
+    """Return the roles of the players of <nb_games> games, shuffled per game (array of shape games x players)"""
+    import numpy as np  # pylint: disable=C0415
+    roles = np.array(roles)
+    return roles[np.argsort(rng.random((nb_games, len(roles))), axis=1)]
+
+
+def simulate(rng, nb_games, nb_players, roles, strategy):
+    """Play <nb_games> games of <nb_players> players with <roles> and return their arrays (games on the first axis)"""
+    import numpy as np  # pylint: disable=C0415
+    quests = RULES_CACHE.get(nb_player=nb_players)[0]["quests"]
+    players_roles = draw_roles(rng, nb_games, game_roles(nb_players, roles))
+    red = np.isin(players_roles, RED_ROLES + ("red",))
+    seen_by_merlin = red & (players_roles != "mordred")
+    games = np.arange(nb_games)
+
+    teams, fail_votes = [], []
+    statuses = np.zeros((nb_games, len(quests)), dtype=bool)
+    for index, quest in enumerate(quests):
+        # the team is drawn at random, but Merlin keeps out some of the red players he sees
+        priority = rng.random(red.shape) + (seen_by_merlin & (rng.random(red.shape) < strategy["merlin_influence"]))
+        team = np.argsort(priority, axis=1)[:, :quest["nb_players_to_send"]]
+        fails = np.take_along_axis(red, team, axis=1) & (rng.random(team.shape) < strategy["red_fail_rate"])
+        statuses[:, index] = fails.sum(axis=1) < quest["nb_votes_to_fail"]
+        teams.append(team)
+        fail_votes.append(fails)
+
+    # teams refused before each quest: a quest is lost if the 5 teams are refused
+    refused = rng.random((nb_games, len(quests), 5)) < strategy["unsend_rate"]
+    nb_refused = np.where(refused.all(axis=2), 5, refused.argmin(axis=2))
+    lost_by_unsend = nb_refused == 5
+
+    nb_success = np.cumsum(statuses & ~lost_by_unsend, axis=1)
+    nb_fail = np.cumsum(~statuses & ~lost_by_unsend, axis=1)
+    last_quest = ((nb_success >= 3) | (nb_fail >= 3) | lost_by_unsend).argmax(axis=1)
+    blue_quests = (nb_success[games, last_quest] >= 3) & ~lost_by_unsend[games, last_quest]
+
+    # the assassin guesses Merlin among the blue players
+    guess = np.argmax(rng.random(red.shape) * ~red, axis=1)
+    merlin_found = blue_quests & (players_roles[games, guess] == "merlin")
+
+    return {
+        "roles": players_roles,
+        "red": red,
+        "teams": teams,
+        "fail_votes": fail_votes,
+        "statuses": statuses,
+        "nb_refused": nb_refused,
+        "lost_by_unsend": lost_by_unsend[games, last_quest],
+        "last_quest": last_quest,
+        "blue_quests": blue_quests,
+        "guess": guess,
+        "merlin_found": merlin_found,
+        "blue_wins": blue_quests & ~merlin_found
+    }
+
+
+def simulation_stats(simulations):
+    """Return the win rates of the simulated games (<simulations>: results of simulate)"""
+    nb_games = sum(len(simulation["blue_wins"]) for simulation in simulations)
+
+    def total(key):
+        return int(sum(simulation[key].sum() for simulation in simulations))
+
+    blue_wins = total("blue_wins")
+    red_wins_by_unsend = total("lost_by_unsend")
+    red_wins_by_merlin = total("merlin_found")
+
+    return {
+        "games": nb_games,
+        "blue_wins": blue_wins,
+        "blue_win_rate": blue_wins / nb_games,
+        "red_win_rate": 1 - blue_wins / nb_games,
+        "red_wins": {
+            "quests": nb_games - blue_wins - red_wins_by_unsend - red_wins_by_merlin,
+            "unsend": red_wins_by_unsend,
+            "merlin": red_wins_by_merlin
+        },
+        "mean_quests": float(sum((simulation["last_quest"] + 1).sum() for simulation in simulations) / nb_games)
+    }
+
+
+def new_id():
+    """Return a primary key (generated here, so that the documents can reference each other before being inserted)"""
+    return str(uuid.uuid4())
+
+
+def game_documents(players, players_roles, quests, first_player, created_at, simulation=None, index=None):
+    """Return the players, quests and game documents of a game (played if <simulation> is given, <index> being
+    the game in it). The game is owned by this node (sharding)."""
+    game_id = SHARD_ROUTER.new_game_id()
+    player_docs = []
+    assassin = True
+    for player, role in zip(players, players_roles):
+        player_doc = dict(player, id=new_id(), game_id=game_id, role=str(role), team="blue")
+        if role not in ("merlin",) + BLUE_ROLES + ("blue",):
+            player_doc["team"] = "red"
+            if assassin:
+                assassin = False
+                player_doc["assassin"] = True
+        player_docs.append(player_doc)
+
+    player_ids = [player_doc["id"] for player_doc in player_docs]
+    quest_docs = [
+        dict(quest, id=new_id(), game_id=game_id, quest_number=quest_number)
+        for quest_number, quest in enumerate(quests)
+    ]
+    game = {
+        "id": game_id,
+        "players": player_ids,
+        "quests": [quest_doc["id"] for quest_doc in quest_docs],
+        "current_id_player": player_ids[first_player],
+        "current_quest": 0,
+        "nb_quest_unsend": 0,
+        "status": "active",
+        "created_at": created_at
+    }
+
+    if simulation is None:
+        return player_docs, quest_docs, game
+
+    last_quest = int(simulation["last_quest"][index])
+    nb_played = last_quest if simulation["lost_by_unsend"][index] else last_quest + 1
+    for quest_index, quest_doc in enumerate(quest_docs[:nb_played]):
+        team = simulation["teams"][quest_index][index]
+        fail_votes = simulation["fail_votes"][quest_index][index]
+        quest_doc["votes"] = {player_ids[player]: not bool(fail) for player, fail in zip(team, fail_votes)}
+        quest_doc["status"] = bool(simulation["statuses"][index, quest_index])
+
+    game.update({
+        "current_id_player": player_ids[(first_player + nb_played) % len(player_ids)],
+        "current_quest": nb_played,
+        "nb_quest_unsend": 5 if simulation["lost_by_unsend"][index] else 0,
+        "result": {"status": bool(simulation["blue_wins"][index])},
+        "status": "finished",
+        "simulated": True
+    })
+    if simulation["blue_quests"][index]:
+        game["result"]["guess_merlin_id"] = player_ids[simulation["guess"][index]]
+
+    return player_docs, quest_docs, game
+
+
+def db_bulk_insert(table, documents):
+    """Insert <documents> in <table>, INSERT_CHUNK_SIZE per query"""
+    for start in range(0, len(documents), INSERT_CHUNK_SIZE):
+        result = RDB.table(table).insert(documents[start:start + INSERT_CHUNK_SIZE]).run()
+        if result["errors"]:
+            raise r.errors.ReqlOpFailedError(result["first_error"])
+
+
+def db_insert_games(documents):
+    """Insert the (players, quests, game) <documents> of several games and return the ids of the games"""
+    players, quests, games = [], [], []
+    for player_docs, quest_docs, game in documents:
+        players.extend(player_docs)
+        quests.extend(quest_docs)
+        games.append(game)
+
+    # the games last: they only reference inserted players and quests
+    db_bulk_insert("players", players)
+    db_bulk_insert("quests", quests)
+    db_bulk_insert("games", games)
+
+    return [game["id"] for game in games]
+
+
+def default_players(nb_players):
+    """Return the players of a simulated game"""
+    return [{"name": "player{}".format(index), "avatar_index": index} for index in range(nb_players)]
+
+
+def new_games(rng, nb_games, players, roles):
+    """Return the documents of <nb_games> new games of the same <players> and <roles>"""
+    check_new_game(players, roles)
+
+    quests = RULES_CACHE.get(nb_player=len(players))[0]["quests"]
+    players_roles = draw_roles(rng, nb_games, game_roles(len(players), roles))
+    first_players = rng.integers(len(players), size=nb_games)
+    created_at = time.time()
+
+    return [
+        game_documents(players, players_roles[index], quests, first_players[index], created_at)
+        for index in range(nb_games)
+    ]
+
+
+def games_bulk_put(payload, seed=None):
+    """Create payload['nb_games'] games of the same players and roles (payload of PUT /games) in batch,
+    and return their ids"""
+    import numpy as np  # pylint: disable=C0415
+    return db_insert_games(
+        new_games(np.random.default_rng(seed), payload["nb_games"], payload["players"], payload["roles"])
+    )
+
+
+def games_simulate(nb_games, nb_players, role_sets, strategy=None, seed=None, store=False):
+    """Simulate <nb_games> games for each number of players of <nb_players> and each roles of <role_sets>
+    (the invalid combinations are reported with their error), storing them if <store>.
+    Return the win rates per number of players and roles."""
+    import numpy as np  # pylint: disable=C0415
+    strategy = dict(DEFAULT_STRATEGY, **(strategy or {}))
+    rng = np.random.default_rng(seed)
+
+    start = time.perf_counter()
+    results = []
+    nb_stored = 0
+    for nb_player in nb_players:
+        for roles in role_sets:
+            result = {"nb_players": nb_player, "roles": list(roles)}
+            try:
+                check_roles(nb_player, roles)
+            except AvalonBGError as error:
+                results.append(dict(result, error=str(error)))
+                continue
+
+            simulations = []
+            for chunk_start in range(0, nb_games, SIMULATION_CHUNK_SIZE):
+                chunk_size = min(SIMULATION_CHUNK_SIZE, nb_games - chunk_start)
+                simulation = simulate(rng, chunk_size, nb_player, roles, strategy)
+                simulations.append(simulation)
+
+                if store:
+                    players = default_players(nb_player)
+                    quests = RULES_CACHE.get(nb_player=nb_player)[0]["quests"]
+                    first_players = rng.integers(nb_player, size=chunk_size)
+                    created_at = time.time()
+                    nb_stored += len(db_insert_games(
+                        game_documents(players, simulation["roles"][index], quests, first_players[index], created_at,
+                                       simulation=simulation, index=index)
+                        for index in range(chunk_size)
+                    ))
+
+            results.append(dict(result, **simulation_stats(simulations)))
+
+    return {
+        "strategy": strategy,
+        "stored_games": nb_stored,
+        "duration_s": time.perf_counter() - start,
+        "results": results
+    }
+
+
+def print_results(simulation):
+    """Print the win rates as a table"""
+    print("strategy: {}".format(", ".join("{}={}".format(key, value) for key, value in simulation["strategy"].items())))
+    print("{:>8}  {:<28}{:>10}{:>10}{:>12}{:>12}{:>12}{:>8}".format(
+        "players", "roles", "games", "blue", "red quests", "red unsend", "red merlin", "quests"
+    ))
+    for result in simulation["results"]:
+        roles = ",".join(result["roles"]) or "-"
+        if "error" in result:
+            print("{:>8}  {:<28}{}".format(result["nb_players"], roles, result["error"]))
+            continue
+        print("{:>8}  {:<28}{:>10}{:>10.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>8.2f}".format(
+            result["nb_players"], roles, result["games"], result["blue_win_rate"],
+            result["red_wins"]["quests"] / result["games"], result["red_wins"]["unsend"] / result["games"],
+            result["red_wins"]["merlin"] / result["games"], result["mean_quests"]
+        ))
+    print("{} games stored, {:.2f} s".format(simulation["stored_games"], simulation["duration_s"]))
+
+
+if __name__ == "__main__":
+
+    from db_pool import DB_POOL
+    from storage import STORAGE_ENGINES, create_engine
+
+    PARSER = argparse.ArgumentParser()
+
+    # optional arguments
+    PARSER.add_argument("-games", type=int, help="number of games per number of players and roles", default=10000)
+    PARSER.add_argument("-nb_players", type=int, nargs="+", help="numbers of players", default=[5, 6, 7, 8, 9, 10])
+    PARSER.add_argument(
+        "-role_sets",
+        type=str,
+        nargs="+",
+        help="roles of the games, comma separated ('' for none)",
+        default=["", "oberon", "perceval,morgan", "perceval,morgan,mordred"]
+    )
+    for KEY, VALUE in DEFAULT_STRATEGY.items():
+        PARSER.add_argument("-" + KEY, type=float, default=VALUE)
+    PARSER.add_argument("-seed", type=int, help="seed of the random draws")
+    PARSER.add_argument("-store", action="store_true", help="insert the simulated games in the database")
+    PARSER.add_argument("-storage", type=str, help="storage engine", choices=STORAGE_ENGINES, default="rethinkdb")
+    PARSER.add_argument("-host_db", type=str, help="database host", default="rethinkdb")
+    PARSER.add_argument("-port_db", type=int, help="database port", default=28015)
+    PARSER.add_argument("-sqlite_path", type=str, help="SQLite database file", default="avalon.db")
+    PARSER.add_argument("-output", type=str, help="write the results to this JSON file")
+
+    # parse arguments
+    ARGS = PARSER.parse_args()
+
+    if ARGS.store:
+        DB_POOL.configure(engine=create_engine(ARGS.storage, ARGS.host_db, ARGS.port_db, ARGS.sqlite_path))
+        DB_POOL.checkout().repl()
+
+    SIMULATION = games_simulate(
+        nb_games=ARGS.games,
+        nb_players=ARGS.nb_players,
+        role_sets=[[role for role in roles.split(",") if role] for roles in ARGS.role_sets],
+        strategy={key: getattr(ARGS, key) for key in DEFAULT_STRATEGY},
+        seed=ARGS.seed,
+        store=ARGS.store
+    )
+
+    print_results(SIMULATION)
+
+    if ARGS.output:
+        with open(ARGS.output, "w") as outfile:
+            json.dump(SIMULATION, outfile, indent=4)
@@ -0,0 +1,131 @@
+"""This module contains the tests of the games created in batch (simulation.new_games): they should be the games
+of PUT /games (rules_cache.game_put, tagged by db_indexes.db_tag_new_game), which should be the ones of
+avalonBG.games.game_put.
+
+    python -m unittest simulation_test
+"""
+
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from avalonBG.exception import AvalonBGError
+from avalonBG.games import game_put
+
+from api import APP
+from db_pool import DB_POOL
+from rules_cache import check_new_game
+from simulation import new_games
+from storage import create_engine
+
+
+ROLE_SETS = ([], ["oberon"], ["perceval", "morgan"], ["perceval", "morgan", "mordred"])
+
+INVALID_GAMES = (
+    (4, []),
+    (11, []),
+    (5, ["oberon", "oberon"]),
+    (5, ["merlin"]),
+    (5, ["morgan"]),
+    (5, ["perceval"]),
+    (5, ["perceval", "morgan", "mordred", "oberon"])
+)
+
+# players whose game cannot be created whatever its roles
+INVALID_PLAYERS = (
+    [{"name": "player", "avatar_index": index} for index in range(5)],
+    [{"name": " " * index, "avatar_index": index} for index in range(1, 6)]
+)
+
+
+def new_players(nb_players):
+    return [{"name": "player{}".format(index), "avatar_index": index} for index in range(nb_players)]
+
+
+def player_summary(players):
+    """Return what doesn't depend on the draws: the fields, roles and teams of the players and the team of the
+    assassin (the first red player of the draw)"""
+    return (
+        Counter((tuple(sorted(set(player) - {"assassin"})), player["role"], player["team"]) for player in players),
+        [player["team"] for player in players if player.get("assassin")]
+    )
+
+
+def quest_summary(quests):
+    return [{key: value for key, value in quest.items() if key not in ("id", "game_id")} for quest in quests]
+
+
+def untagged(rows, tags):
+    """Return the <rows> without their <tags> (db_indexes.db_tag_new_game)"""
+    return [{key: value for key, value in row.items() if key not in tags} for row in rows]
+
+
+class NewGamesTest(unittest.TestCase):
+    """Games of PUT /games and of PUT /games/bulk"""
+
+    @classmethod
+    def setUpClass(cls):
+        DB_POOL.configure(engine=create_engine("memory"), max_size=2)
+        cls.client = APP.test_client()
+        cls.client.put("/restart_db", json=["games", "players", "quests"])
+
+    def test_same_documents(self):
+        rng = np.random.default_rng(0)
+        for nb_players in range(5, 11):
+            for roles in ROLE_SETS:
+                with self.subTest(nb_players=nb_players, roles=roles):
+                    payload = {"players": new_players(nb_players), "roles": roles}
+                    game = self.client.put("/games", json=payload).get_json()
+                    player_docs, quest_docs, bulk_game = new_games(rng, 1, new_players(nb_players), roles)[0]
+
+                    self.assertEqual(set(game) - {"version"}, set(bulk_game))
+                    self.assertEqual(game["status"], bulk_game["status"])
+                    self.assertEqual(player_summary(game["players"]), player_summary(player_docs))
+                    self.assertEqual(quest_summary(game["quests"]), quest_summary(quest_docs))
+
+                    # the stored rows are tagged for the secondary indexes
+                    quests = self.client.get("/games/{}/quests".format(game["id"])).get_json()
+                    self.assertEqual([quest["id"] for quest in quests], [quest["id"] for quest in game["quests"]])
+                    self.assertEqual(quest_summary(quests), quest_summary(quest_docs))
+                    players = self.client.get("/games/{}/players".format(game["id"])).get_json()
+                    self.assertEqual(player_summary(players), player_summary(game["players"]))
+
+    def test_same_games_as_avalonbg(self):
+        connection = DB_POOL.checkout()
+        try:
+            for nb_players in range(5, 11):
+                for roles in ROLE_SETS:
+                    with self.subTest(nb_players=nb_players, roles=roles):
+                        payload = {"players": new_players(nb_players), "roles": roles}
+                        # the requests of the client clear the default connection
+                        connection.repl()
+                        expected = game_put(payload)
+                        game = self.client.put("/games", json=payload).get_json()
+
+                        self.assertEqual(set(game) - {"version", "status", "created_at"}, set(expected))
+                        self.assertEqual(
+                            player_summary(untagged(game["players"], ("game_id",))),
+                            player_summary(expected["players"])
+                        )
+                        self.assertEqual(
+                            quest_summary(untagged(game["quests"], ("quest_number",))),
+                            quest_summary(expected["quests"])
+                        )
+        finally:
+            DB_POOL.checkin(connection)
+
+    def test_same_errors(self):
+        cases = [(new_players(nb_players), roles) for nb_players, roles in INVALID_GAMES]
+        cases += [(players, roles) for players in INVALID_PLAYERS for roles in ([], ["merlin"])]
+        for players, roles in cases:
+            with self.subTest(players=players, roles=roles):
+                with self.assertRaises(AvalonBGError) as expected:
+                    game_put({"players": players, "roles": roles})
+                with self.assertRaises(AvalonBGError) as error:
+                    check_new_game(players, roles)
+                self.assertEqual(str(error.exception), str(expected.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+"""This module contains the SQLite store of the ReQL evaluator of memory_db: documents are kept as JSON,
+in a database file shared by the processes (WAL mode: readers don't block the writer)"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import rethinkdb as r
+
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS tables (name TEXT PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS indexes (tbl TEXT, name TEXT, PRIMARY KEY (tbl, name))",
+    "CREATE TABLE IF NOT EXISTS documents (tbl TEXT, id TEXT, doc TEXT, PRIMARY KEY (tbl, id)) WITHOUT ROWID"
+)
+
+# names of the secondary indexes (they are embedded in the SQL of their expression indexes)
+INDEX_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+# seconds to wait for the lock of another writer
+BUSY_TIMEOUT = 5.0
+
+# seconds between two reads of a watched document
+WATCH_INTERVAL = 0.1
+
+
+class PollingChangefeed:
+    """Changes of a document, found by reading it again (they can come from another process)"""
+
+    def __init__(self, store, table, key):
+        self.store = store
+        self.table = table
+        self.key = key
+        self._last = store.get(table, key)
+
+    def next(self, wait=True):
+        """Return the next change, waiting at most <wait> seconds (forever if True)"""
+        deadline = None if wait is True or wait is None else time.monotonic() + wait
+        while True:
+            doc = self.store.get(self.table, self.key)
+            if doc != self._last:
+                change = {"old_val": self._last, "new_val": doc}
+                self._last = doc
+                return change
+
+            if deadline is not None and time.monotonic() >= deadline:
+                raise r.errors.ReqlTimeoutError()
+            time.sleep(WATCH_INTERVAL)
+
+    def __iter__(self):
+        while True:
+            yield self.next()
+
+    def close(self):
+        """Stop reading the document"""
+
+
+class SQLiteStore:
+    """Tables of JSON documents in a SQLite database (one SQLite connection per thread)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # the threads of the process queue here rather than polling the lock of SQLite
+        self._write_lock = threading.Lock()
+
+        with self._transaction_connection() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+        # a SQLite connection must not be used after a fork (gunicorn workers)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # autocommit: the transactions are explicit
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.depth = 0
+        return connection
+
+    @contextmanager
+    def _transaction_connection(self):
+        with self.transaction():
+            yield self._connection()
+
+    def tables(self):
+        return [name for (name,) in self._connection().execute("SELECT name FROM tables")]
+
+    def create_table(self, name):
+        with self._transaction_connection() as connection:
+            connection.execute("INSERT OR IGNORE INTO tables (name) VALUES (?)", (name,))
+
+    def drop_table(self, name):
+        with self._transaction_connection() as connection:
+            connection.execute("DELETE FROM tables WHERE name = ?", (name,))
+            connection.execute("DELETE FROM indexes WHERE tbl = ?", (name,))
+            connection.execute("DELETE FROM documents WHERE tbl = ?", (name,))
+
+    def indexes(self, table):
+        return [name for (name,) in self._connection().execute("SELECT name FROM indexes WHERE tbl = ?", (table,))]
+
+    def create_index(self, table, name):
+        if not INDEX_NAME.match(name):
+            raise r.errors.ReqlQueryLogicError(
+                "Index name `{}` invalid (Use A-Z, a-z, 0-9, and _ only).".format(name)
+            )
+        try:
+            with self._transaction_connection() as connection:
+                connection.execute("INSERT INTO indexes (tbl, name) VALUES (?, ?)", (table, name))
+                # the expression index of the field is shared by the tables having an index of this name
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS field_{0} ON documents (tbl, json_extract(doc, '$.{0}'))".format(name)
+                )
+        except sqlite3.IntegrityError as error:
+            raise r.errors.ReqlOpFailedError(
+                "Index `{}` already exists on table `{}`.".format(name, table)
+            ) from error
+
+    def get(self, table, key, copy=True):
+        # pylint: disable=W0613
+        row = self._connection().execute(
+            "SELECT doc FROM documents WHERE tbl = ? AND id = ?", (table, json.dumps(key))
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_all(self, table, keys, index="id"):
+        if not keys:
+            return []
+
+        placeholders = ", ".join("?" * len(keys))
+        if index == "id":
+            rows = self._connection().execute(
+                "SELECT doc FROM documents WHERE tbl = ? AND id IN ({})".format(placeholders),
+                [table] + [json.dumps(key) for key in keys]
+            )
+            # get_all returns the documents in the order of the keys
+            docs = {doc["id"]: doc for doc in (json.loads(row) for (row,) in rows)}
+            return [docs[key] for key in keys if key in docs]
+
+        if index not in self.indexes(table):
+            raise r.errors.ReqlOpFailedError("Index `{}` was not found on table `{}`.".format(index, table))
+
+        # without statistics, the planner would prefer the primary key (tbl) to the expression index
+        rows = self._connection().execute(
+            "SELECT doc FROM documents INDEXED BY field_{0} "
+            "WHERE tbl = ? AND json_extract(doc, '$.{0}') IN ({1})".format(index, placeholders),
+            [table] + list(keys)
+        )
+        return [json.loads(row) for (row,) in rows]
+
+    def scan(self, table, copy=True):
+        # pylint: disable=W0613
+        rows = self._connection().execute("SELECT doc FROM documents WHERE tbl = ?", (table,))
+        return [json.loads(row) for (row,) in rows]
+
+    def put(self, table, doc):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO documents (tbl, id, doc) VALUES (?, ?, ?)",
+            (table, json.dumps(doc["id"]), json.dumps(doc))
+        )
+
+    def delete(self, table, key):
+        self._connection().execute("DELETE FROM documents WHERE tbl = ? AND id = ?", (table, json.dumps(key)))
+
+    @contextmanager
+    def transaction(self):
+        """Apply the writes of the block atomically (BEGIN IMMEDIATE locks out the writers of other processes)"""
+        connection = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        with self._write_lock:
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as error:
+                raise r.errors.ReqlOpFailedError("Cannot perform write: {}".format(error)) from error
+
+            self._local.depth = 1
+            try:
+                yield
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+            finally:
+                self._local.depth = 0
+
+    def watch(self, table, key=None):
+        if key is None:
+            raise r.errors.ReqlQueryLogicError("The SQLite engine only follows the changes of a single document.")
+        return PollingChangefeed(self, table, key)
+
+    def unwatch(self, changefeed):
+        # pylint: disable=W0613
+        return None
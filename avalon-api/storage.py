@@ -0,0 +1,88 @@
+"""This module contains the storage engines of the RESTful web service of Avalon.
+An engine opens the connections on which avalonBG and the API run their ReQL queries."""
+
+from rethinkdb.net import DefaultConnection, make_connection
+
+from api_utils import PHASE_TIMER
+from memory_db import MemoryStore, StoreConnection
+from sqlite_db import SQLiteStore
+
+
+class TimedConnection(DefaultConnection):
+    """RethinkDB connection adding the time spent in queries (and cursor batches) to the phase 'db'"""
+
+    def _start(self, term, **global_optargs):
+        with PHASE_TIMER.timed("db"):
+            return super()._start(term, **global_optargs)
+
+    def _continue(self, cursor):
+        with PHASE_TIMER.timed("db"):
+            return super()._continue(cursor)
+
+
+class StorageEngine:
+    """Interface of the storage engines"""
+
+    name = None
+
+    # whether the data is shared by several processes (gunicorn workers)
+    multi_process = True
+
+    def connect(self):
+        """Open a connection which can be made the default one of the thread with repl()"""
+        raise NotImplementedError
+
+
+class RethinkDBEngine(StorageEngine):
+    """RethinkDB server"""
+
+    name = "rethinkdb"
+
+    def __init__(self, host="rethinkdb", port=28015):
+        self.host = host
+        self.port = port
+
+    def connect(self):
+        return make_connection(TimedConnection, self.host, self.port)
+
+
+class MemoryEngine(StorageEngine):
+    """Documents kept in the memory of the process (lost when it stops)"""
+
+    name = "memory"
+    multi_process = False
+
+    def __init__(self):
+        self.store = MemoryStore()
+
+    def connect(self):
+        return StoreConnection(self.store)
+
+
+class SQLiteEngine(StorageEngine):
+    """Documents stored as JSON in a SQLite database (WAL mode)"""
+
+    name = "sqlite"
+
+    def __init__(self, path="avalon.db"):
+        self.store = SQLiteStore(path)
+
+    def connect(self):
+        return StoreConnection(self.store)
+
+
+STORAGE_ENGINES = (RethinkDBEngine.name, MemoryEngine.name, SQLiteEngine.name)
+
+
+def create_engine(name, host_db="rethinkdb", port_db=28015, sqlite_path="avalon.db"):
+    """Return the storage engine <name> ('rethinkdb', 'memory' or 'sqlite')"""
+    if name == RethinkDBEngine.name:
+        return RethinkDBEngine(host=host_db, port=port_db)
+
+    if name == MemoryEngine.name:
+        return MemoryEngine()
+
+    if name == SQLiteEngine.name:
+        return SQLiteEngine(path=sqlite_path)
+
+    raise ValueError("Unknown storage engine '{}'!".format(name))
@@ -0,0 +1,109 @@
+"""This module contains the validation of the payloads of the RESTful web service of Avalon.
+The JSON schemas of the request models are compiled once, on the first payload of each model (to Python code
+by fastjsonschema when it is installed, which would slow down the start of the server), instead of on each request
+as flask-restx does with expect(..., validate=True)."""
+
+import functools
+import threading
+
+from flask import request
+from flask_restx import fields
+from jsonschema import Draft4Validator, FormatChecker
+
+from api_utils import HTTPError, PHASE_TIMER
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+def nested_models(model):
+    """Return the models nested (at any depth) in <model>, by name"""
+    models = {}
+    for field in getattr(model, "values", list)():
+        while isinstance(field, fields.List):
+            field = field.container
+        if isinstance(field, fields.Nested):
+            models[field.model.name] = field.model
+            models.update(nested_models(field.model))
+
+    return models
+
+
+def format_error(error):
+    """Return the path of the invalid value (as flask-restx does) and the message of <error>"""
+    path = [str(item) for item in error.path]
+    if error.validator == "required":
+        path.append(error.message.split("'")[1])
+
+    return ".".join(path), error.message
+
+
+class PayloadValidator:
+    """Validator of the payloads of a request model"""
+
+    def __init__(self, model):
+        self.model = model
+        self._validator = None
+        self._is_valid = None
+        self._lock = threading.Lock()
+
+    def _compile(self):
+        """Compile the schema of the model (once, whatever the threads)"""
+        with self._lock:
+            if self._validator is not None:
+                return
+
+            schema = dict(self.model.__schema__)
+            definitions = nested_models(self.model)
+            if definitions:
+                schema["definitions"] = {name: nested.__schema__ for name, nested in definitions.items()}
+
+            Draft4Validator.check_schema(schema)
+            # jsonschema lists all the errors of the invalid payloads
+            validator = Draft4Validator(schema, format_checker=FormatChecker())
+            self._is_valid = validator.is_valid
+            if fastjsonschema is not None:
+                self._is_valid = self._compiled_is_valid(
+                    fastjsonschema.compile(dict(schema, **{"$schema": "http://json-schema.org/draft-04/schema#"}))
+                )
+            # set last: the other threads check it without the lock
+            self._validator = validator
+
+    @staticmethod
+    def _compiled_is_valid(compiled):
+        def is_valid(payload):
+            try:
+                compiled(payload)
+            except fastjsonschema.JsonSchemaException:
+                return False
+            return True
+
+        return is_valid
+
+    def validate(self, payload):
+        """Raise an HTTPError (400) with the errors of <payload>, if any"""
+        with PHASE_TIMER.timed("validation"):
+            if self._validator is None:
+                self._compile()
+            if self._is_valid(payload):
+                return
+            errors = dict(format_error(error) for error in self._validator.iter_errors(payload))
+
+        raise HTTPError("Input payload validation failed", status_code=400, payload=errors)
+
+
+def validate_payload(validator):
+    """Decorate a method of a resource to validate the JSON payload of the request before running it"""
+
+    def decorator(method):
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            validator.validate(request.get_json(silent=True))
+            return method(*args, **kwargs)
+
+        return wrapper
+
+    return decorator